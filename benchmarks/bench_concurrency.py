@@ -0,0 +1,253 @@
+"""Stress test of the mounted volume: many clients listing folders, looking up and reading files at once.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_concurrency --clients 32 --seconds 10
+    python -m benchmarks.bench_concurrency --clients 32 --seconds 10 --serialize
+
+Every client is a thread picking random operations the way Explorer windows and applications would,
+against ZpaqFileSystemOperations on an archive replayed by fake_zpaqfranz.py. Without winfspy (e.g. on
+Linux) the clients call the IndexNamespace and BlockReader the operations are built on instead.
+Reads favour a few "hot" files so concurrent reads of the same file are common.
+
+Prints operations per second, latency percentiles per operation (client.* as the clients see them,
+waiting included), and how many zpaqfranz extractions the reads started against how many files they read. --serialize puts every operation behind one lock,
+which is how the volume used to work, for comparison.
+"""
+import argparse
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+import zpaqtreeview as ztv
+from zpaq_cache import BlockCache, BlockReader
+from zpaq_metrics import metrics
+from zpaq_namespace import IndexNamespace, FILE_ATTRIBUTE_DIRECTORY
+from zpaq_prefetch import Prefetcher, DEFAULT_FILE_SIZE
+from benchmarks.bench_suite import Fixture, quiet
+
+READ_CHUNK = 64 * 1024
+
+
+class Volume:
+    """The operations the clients call, on ZpaqFileSystemOperations when winfspy is there."""
+
+    def __init__(self, fixture, cache_size, serialize=False, prefetch_budget=0, prefetch_file_size=DEFAULT_FILE_SIZE):
+        blocks = os.path.join(fixture.directory, "blocks")
+        try:
+            import zpaq_fileexplorer
+        except ImportError:
+            zpaq_fileexplorer = None
+        if zpaq_fileexplorer is not None:
+            self.kind = "ZpaqFileSystemOperations"
+            operations = zpaq_fileexplorer.ZpaqFileSystemOperations("bench", fixture.archive, blocks, cache_size,
+                                                                     fixture.config, prefetch_budget=prefetch_budget,
+                                                                     prefetch_file_size=prefetch_file_size)
+            operations.set_index(fixture.index)
+            self.namespace = operations._namespace
+            self.reader = operations._reader
+            self.prefetcher = operations._prefetcher
+            self.open = lambda name: operations.open(name, 0, 0)
+            self.close = operations.close
+            self.get_security_by_name = operations.get_security_by_name
+            self.get_file_info = operations.get_file_info
+            self.read_directory = operations.read_directory
+            self.read = operations.read
+        else:
+            self.kind = "IndexNamespace and BlockReader (winfspy is not installed)"
+            self.namespace = namespace = IndexNamespace(fixture.index)
+            self.reader = reader = BlockReader(BlockCache(blocks, cache_size),
+                                               lambda path, size, date: ztv.stream_file(fixture.config, fixture.archive,
+                                                                                             path))
+            self.prefetcher = prefetcher = Prefetcher(fixture.config, fixture.archive, reader.cache,
+                                                      os.path.join(fixture.directory, "prefetch"), prefetch_budget,
+                                                      prefetch_file_size)
+
+            def read_directory(handle, marker):
+                if marker is None:
+                    prefetcher.request(namespace, handle.file_obj.node)
+                return namespace.read_directory(handle.file_obj.node, marker)
+
+            def read(handle, offset, length):
+                entry = handle.file_obj
+                prefetcher.request(namespace, namespace.parent(entry.node))
+                prefetcher.wait(entry.path)
+                return reader.read(entry.path, entry.file_size, offset, length, namespace.index.dates[entry.node])
+
+            self.open = metrics.timed("fs.open")(lambda name: Handle(namespace.open(namespace.resolve(name))))
+            self.close = metrics.timed("fs.close")(lambda handle: namespace.close(handle.file_obj))
+            self.get_security_by_name = metrics.timed("fs.get_security_by_name")(
+                lambda name: namespace.attributes(namespace.resolve(name)))
+            self.get_file_info = metrics.timed("fs.get_file_info")(lambda handle: handle.file_obj.get_file_info())
+            self.read_directory = metrics.timed("fs.read_directory")(read_directory)
+            self.read = metrics.timed("fs.read")(read)
+
+        self.extractions = 0
+        self.extracted = set()
+        open_stream = self.reader.open_stream
+        counter = threading.Lock()
+
+        def counting(path, size, date):
+            with counter:
+                self.extractions += 1
+                self.extracted.add(path)
+            return open_stream(path, size, date)
+        self.reader.open_stream = counting
+
+        if serialize:
+            lock = threading.Lock()
+            for name in ("open", "close", "get_security_by_name", "get_file_info", "read_directory", "read"):
+                setattr(self, name, serialized(lock, getattr(self, name)))
+
+
+class Handle:
+    """Stand-in for zpaq_fileexplorer.OpenedObj."""
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+
+
+def serialized(lock, fn):
+    @wraps(fn)
+    def wrapper(*args):
+        with lock:
+            return fn(*args)
+    return wrapper
+
+
+def winfsp_path(namespace, node):
+    parts = []
+    while node != namespace.root:
+        parts.append(namespace.display_name(node))
+        node = namespace.index.parents[node]
+    return "\\" + "\\".join(reversed(parts))
+
+
+def client(volume, folders, files, hot, args, seed, deadline, counts):
+    """Runs random operations until the deadline, timed as a client sees them (waits included)."""
+    rng = random.Random(seed)
+    done = 0
+    while time.perf_counter() < deadline:
+        roll = rng.random()
+        if roll < 0.5:
+            with metrics.timer("client.browse"):  # list a folder
+                handle = volume.open(rng.choice(folders))
+                marker = None
+                while True:
+                    entries = volume.read_directory(handle, marker)
+                    names = [entry["file_name"] for entry in entries if entry["file_name"] not in (".", "..")]
+                    if len(names) < args.page or not names:
+                        break
+                    marker = names[-1]
+                volume.close(handle)
+        elif roll < 0.8:
+            with metrics.timer("client.stat"):  # look a file up and stat it
+                name = rng.choice(files)
+                volume.get_security_by_name(name)
+                handle = volume.open(name)
+                volume.get_file_info(handle)
+                volume.close(handle)
+        else:
+            with metrics.timer("client.read"):  # read the start of a file, a hot one half the time
+                name = rng.choice(hot) if rng.random() < 0.5 else rng.choice(files)
+                handle = volume.open(name)
+                size = min(handle.file_obj.file_size, args.read_bytes)
+                for offset in range(0, size, READ_CHUNK):
+                    if not len(volume.read(handle, offset, READ_CHUNK)):
+                        break
+                volume.close(handle)
+        done += 1
+    counts.append(done)
+
+
+def thumbnails_client(volume, folders, files, hot, args, seed, deadline, counts):
+    """Opens random folders and reads the start of every file in them in turn, like Explorer making thumbnails."""
+    rng = random.Random(seed)
+    done = 0
+    while time.perf_counter() < deadline:
+        with metrics.timer("client.folder"):
+            folder = rng.choice(folders)
+            handle = volume.open(folder)
+            entries = volume.read_directory(handle, None)
+            volume.close(handle)
+            for entry in entries:
+                if entry["file_name"] in (".", "..") or entry["file_attributes"] & FILE_ATTRIBUTE_DIRECTORY:
+                    continue
+                file_handle = volume.open(folder.rstrip("\\") + "\\" + entry["file_name"])
+                volume.read(file_handle, 0, READ_CHUNK)
+                volume.close(file_handle)
+        done += 1
+    counts.append(done)
+
+
+SCENARIOS = {"mixed": client, "thumbnails": thumbnails_client}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, default=50_000, help="listing lines (files and folders)")
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--fanout", type=int, default=12)
+    parser.add_argument("--max-size", type=int, default=10**9, help="largest listed file size")
+    parser.add_argument("--clients", type=int, default=32, help="threads calling the volume at once")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--hot", type=int, default=8, help="files half of all reads go to")
+    parser.add_argument("--read-bytes", type=int, default=256 * 1024, help="bytes each read reads from the start")
+    parser.add_argument("--page", type=int, default=10**9,
+                        help="entries per read_directory call before continuing from a marker")
+    parser.add_argument("--cache-size", type=int, default=30 * 10**6, help="memory for extracted blocks")
+    parser.add_argument("--serialize", action="store_true", help="one lock around every operation")
+    parser.add_argument("--scenario", choices=list(SCENARIOS), default="mixed",
+                        help="mixed: random browsing, stats and reads; thumbnails: read every file of random folders")
+    parser.add_argument("--prefetch-budget", type=int, default=0,
+                        help="bytes of small sibling files to extract ahead per folder (default: 0, off)")
+    parser.add_argument("--prefetch-file-size", type=int, default=DEFAULT_FILE_SIZE,
+                        help="largest file size the prefetch extracts")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    args.roots, args.name_length, args.versions = ["C:"], 0, 1
+
+    print(f"Building a {args.lines:,} line fixture...")
+    with quiet():
+        fixture = Fixture(args)
+    try:
+        volume = Volume(fixture, args.cache_size, args.serialize, args.prefetch_budget,
+                        args.prefetch_file_size)
+        namespace = volume.namespace
+        index = namespace.index
+        folders, files = [], []
+        for node in range(1, len(index)):
+            (folders if index.is_directory(node) else files).append(winfsp_path(namespace, node))
+        hot = random.Random(args.seed).sample(files, min(args.hot, len(files)))
+        print(f"{args.clients} {args.scenario} clients for {args.seconds:g} s on {volume.kind}"
+              f"{', every operation serialized' if args.serialize else ''}"
+              f"{f', prefetching up to {args.prefetch_budget:,} bytes' if args.prefetch_budget else ''}")
+
+        metrics.enable()
+        metrics.reset()
+        counts = []
+        deadline = time.perf_counter() + args.seconds
+        threads = [threading.Thread(target=SCENARIOS[args.scenario], args=(volume, folders, files, hot, args, args.seed + number,
+                                                         deadline, counts))
+                   for number in range(args.clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        volume.prefetcher.close()
+        volume.reader.close()
+
+        print(f"{sum(counts):,} client operations in {elapsed:.1f} s, {sum(counts) / elapsed:,.1f}/s "
+              f"(slowest client {min(counts):,}, fastest {max(counts):,})")
+        print(f"{volume.extractions:,} zpaqfranz extractions for {len(volume.extracted):,} files read")
+        print(metrics.report())
+    finally:
+        fixture.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Compares retained memory and build time of the treelib tree against ArchiveIndex.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_memory --lines 5000000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from treelib import Tree
+
+import zpaqtreeview as ztv
+from zpaq_index import ArchiveIndex
+from benchmarks.synthetic import generate_listing
+
+
+def measure(name, build, lines):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    tree = build(generate_listing(lines))
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10}: {len(tree) if isinstance(tree, ArchiveIndex) else tree.size():>10} nodes  "
+          f"{elapsed:8.2f} s  {current / 2**20:10.1f} MiB retained  {peak / 2**20:10.1f} MiB peak  "
+          f"{current / lines:8.1f} B/line")
+    del tree
+    gc.collect()
+
+
+def build_treelib(contents):
+    tree = Tree()
+    ztv.create_filetree(tree, contents)
+    return tree
+
+
+def build_index(contents):
+    index = ArchiveIndex()
+    ztv.create_index(index, contents)
+    index.drop_lookup()
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=5_000_000)
+    parser.add_argument("--skip-treelib", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_treelib:
+        measure("treelib", build_treelib, args.lines)
+    measure("index", build_index, args.lines)
+
+
+if __name__ == "__main__":
+    main()
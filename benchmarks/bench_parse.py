@@ -0,0 +1,106 @@
+"""Compares listing parse throughput of the old per-line treelib loop against the streaming parser.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_parse --lines 1000000
+
+Add `--workers 2 4 8` to also time parse_listing_parallel() with that many processes. `--merge N`
+times merging N lines of new versions into the listing loaded from the cache, as refreshing an archive
+does, against doing the same with the lookup table of the whole index built first.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from treelib import Tree
+
+import zpaqtreeview as ztv
+from zpaq_cache import load_index, save_index
+from zpaq_index import ArchiveIndex
+from zpaq_listing import parse_listing, parse_listing_parallel
+from benchmarks.synthetic import generate_listing
+
+
+def write_fixture(lines):
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.writelines(generate_listing(lines))
+    return path
+
+
+def time_it(name, run, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:>10}: {best:8.2f} s  {lines / best:12,.0f} lines/s")
+    return lines / best
+
+
+def time_merge(path, lines, repeat):
+    index = ArchiveIndex()
+    with open(path, "rb") as contents:
+        parse_listing(index, contents)
+    index.aggregate()
+    fd, cached = tempfile.mkstemp(suffix=".ztvidx")
+    os.close(fd)
+    delta = list(generate_listing(lines, seed=1))  # the same folders, mostly new files
+    try:
+        save_index(index, cached)
+        for name, full_lookup in (("merge", False), ("full table", True)):
+            best = None
+            for _ in range(repeat):
+                index, _ = load_index(cached)
+                start = time.perf_counter()
+                if full_lookup:
+                    index.lookup_table()  # what merging cost before it only indexed the folders it touches
+                parse_listing(index, delta)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{name:>10}: {best:8.2f} s  for {lines:,} lines into {len(index):,} nodes")
+    finally:
+        os.remove(cached)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-treelib", action="store_true")
+    parser.add_argument("--workers", type=int, nargs="*", default=[],
+                        help="worker process counts to time the parallel parser with")
+    parser.add_argument("--merge", type=int, default=10_000, help="lines of new versions to merge, 0 to skip")
+    args = parser.parse_args()
+
+    path = write_fixture(args.lines)
+    try:
+        def run_treelib():
+            with open(path, "r", encoding="utf-8") as contents:
+                ztv.create_filetree(Tree(), contents)
+
+        def run_streaming():
+            with open(path, "rb") as contents:
+                parse_listing(ArchiveIndex(), contents)
+
+        new = time_it("streaming", run_streaming, args.lines, args.repeat)
+        for workers in args.workers:
+            def run_parallel():
+                with open(path, "rb") as contents:
+                    parse_listing_parallel(ArchiveIndex(), contents, workers)
+
+            parallel = time_it(f"{workers} procs", run_parallel, args.lines, args.repeat)
+            print(f"scaling: {parallel / new:.1f}x")
+        if args.merge:
+            time_merge(path, args.merge, args.repeat)
+        if not args.skip_treelib:
+            old = time_it("treelib", run_treelib, args.lines, 1)
+            print(f"speedup: {new / old:.1f}x")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
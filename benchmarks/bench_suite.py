@@ -0,0 +1,340 @@
+"""Times and memory-profiles the main code paths on a synthetic archive and keeps a history of the results.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_suite --lines 200000 --versions 3
+
+Every run is appended to benchmarks/history.json (--history) with the commit it ran on, and compared
+with the last run that used the same options, so a change that makes something slower shows up as a
+REGRESSION line. --fail-on-regression makes that an exit code for scripts.
+
+The archive is replayed by fake_zpaqfranz.py, so the listing and extraction benchmarks include the
+zpaqfranz process and its pipe but not real decompression. Benchmarks whose dependencies are missing
+(treelib, textual, winfspy) are skipped.
+"""
+import argparse
+import configparser
+import gc
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from datetime import datetime, timezone
+
+import zpaqtreeview as ztv
+from zpaq_cache import ListingCache
+from zpaq_driver import ZPAQFRANZ_ENV
+from zpaq_index import ArchiveIndex
+from benchmarks.synthetic import generate_roots, write_archive
+from benchmarks.fake_zpaqfranz import MAX_SIZE_ENV
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_HISTORY = os.path.join(HERE, "history.json")
+FAKE_ZPAQFRANZ = os.path.join(HERE, "fake_zpaqfranz.py")
+DEFAULT_THRESHOLD = 0.10
+EXTRACTED_SIZE = 64 * 1024  # listed sizes go up to a GB, the fake writes at most this much per file
+
+
+class Skipped(Exception):
+    """A benchmark that cannot run here, e.g. for a missing optional dependency."""
+
+
+@contextmanager
+def quiet():
+    """Silences progress bars and status prints while a benchmark runs."""
+    with open(os.devnull, "w") as sink, redirect_stdout(sink), redirect_stderr(sink):
+        yield
+
+
+class Fixture:
+    """A listing file, the same files as a fake archive, and a config that runs fake_zpaqfranz.py."""
+
+    def __init__(self, args):
+        self.directory = tempfile.mkdtemp(prefix="ztv-bench-")
+        options = {"roots": args.roots, "depth": args.depth, "fanout": args.fanout, "name_length": args.name_length,
+                   "max_size": getattr(args, "max_size", 10**9)}
+        self.listing = os.path.join(self.directory, "listing.txt")
+        with open(self.listing, "w", encoding="utf-8") as f:
+            f.writelines(generate_roots(args.lines, **options))
+        self.archive = os.path.join(self.directory, "bench.zpaq")
+        write_archive(self.archive, args.lines, args.versions, **options)
+        self.extract_to = os.path.join(self.directory, "out")
+
+        self.config = configparser.ConfigParser()
+        self.config.read_dict({"config": {"zpaq_path": "zpaqfranz"}})
+        self.cache = ListingCache(os.path.join(self.directory, "cache"), max_size=0)  # always list
+        command = [sys.executable, FAKE_ZPAQFRANZ]
+        os.environ[ZPAQFRANZ_ENV] = subprocess.list2cmdline(command) if os.name == "nt" else shlex.join(command)
+        os.environ[MAX_SIZE_ENV] = str(EXTRACTED_SIZE)
+
+        with open(self.listing, "rb") as contents:
+            self.index = ArchiveIndex()
+            ztv.create_index(self.index, contents, progress=lambda lines: None)
+        self.index.drop_lookup()
+        self.index.aggregate()
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+# Benchmarks, each returns a function to time that returns what it built
+
+def bench_parse_index(fixture, args):
+    def run():
+        with open(fixture.listing, "rb") as contents:
+            index = ArchiveIndex()
+            ztv.create_index(index, contents, progress=lambda lines: None)
+        return index
+    return run
+
+
+def bench_create_filetree(fixture, args):
+    try:
+        from treelib import Tree
+    except ImportError:
+        raise Skipped("treelib is not installed")
+    if args.lines > args.treelib_lines:
+        raise Skipped(f"over --treelib-lines {args.treelib_lines:,}")
+
+    def run():
+        tree = Tree()
+        with open(fixture.listing, encoding="utf-8") as contents:
+            ztv.create_filetree(tree, contents)
+        return tree
+    return run
+
+
+def bench_list_archive(fixture, args):
+    def run():
+        return ztv.load_tree(fixture.config, fixture.archive, fixture.cache)[0]
+    return run
+
+
+def bench_all_versions(fixture, args):
+    def run():
+        tree, _ = ztv.load_tree(fixture.config, fixture.archive, fixture.cache, all_versions=True)
+        return tree.history.as_of(1)
+    return run
+
+
+def bench_tui_convert_filetree(fixture, args):
+    try:
+        import tree_tui
+    except ImportError as e:
+        raise Skipped(f"{e.name} is not installed")
+
+    def run():
+        return tree_tui.convert_filetree(fixture.config, fixture.archive, fixture.cache)
+    return run
+
+
+def fileexplorer():
+    try:
+        import zpaq_fileexplorer
+    except ImportError as e:
+        raise Skipped(f"{e.name} is not installed")
+    return zpaq_fileexplorer
+
+
+class FileSystem:
+    """What load_filetree needs of a mounted winfspy FileSystem: its operations, without mounting."""
+
+    def __init__(self, fixture):
+        self.operations = fileexplorer().ZpaqFileSystemOperations(
+            "bench", fixture.archive, os.path.join(fixture.directory, "blocks"), 30 * 10**6, fixture.config)
+
+
+def bench_explorer_load_filetree(fixture, args):
+    module = fileexplorer()
+
+    def run():
+        fs = FileSystem(fixture)
+        module.load_filetree(fixture.config, fixture.archive, fs, fixture.cache)
+        return fs
+    return run
+
+
+def bench_explorer_read_directory(fixture, args):
+    module = fileexplorer()
+    fs = FileSystem(fixture)
+    with quiet():
+        module.load_filetree(fixture.config, fixture.archive, fs, fixture.cache)
+    operations = fs.operations
+    index = operations._namespace.index
+    folders = [node for node in range(len(index)) if index.is_directory(node)]
+
+    def run():
+        count = 0
+        for folder in folders:
+            context = module.OpenedObj(operations._namespace.open(folder))
+            count += len(operations.read_directory(context, None))
+            operations.close(context)
+        return count
+    return run
+
+
+def bench_extraction_batches(fixture, args):
+    index = fixture.index
+    rng = random.Random(0)
+    nodes = rng.sample(range(1, len(index)), min(args.selection, len(index) - 1))
+    selection = [ztv.selection_entry(index, node) for node in nodes]
+
+    def run():
+        return list(ztv.extraction_batches(fixture.config, fixture.archive, selection, fixture.extract_to))
+    return run
+
+
+def bench_extract_files(fixture, args):
+    index = fixture.index
+    files = [node for node in range(1, len(index)) if not index.is_directory(node)]
+    nodes = random.Random(1).sample(files, min(args.extract_files, len(files)))
+    selection = [(index.full_path(node), False, EXTRACTED_SIZE) for node in nodes]
+
+    def run():
+        shutil.rmtree(fixture.extract_to, ignore_errors=True)
+        return ztv.extract_files(fixture.config, fixture.archive, selection, fixture.extract_to)
+    return run
+
+
+BENCHMARKS = {
+    "parse_index": bench_parse_index,
+    "create_filetree": bench_create_filetree,
+    "list_archive": bench_list_archive,
+    "all_versions": bench_all_versions,
+    "tui_convert_filetree": bench_tui_convert_filetree,
+    "explorer_load_filetree": bench_explorer_load_filetree,
+    "explorer_read_directory": bench_explorer_read_directory,
+    "extraction_batches": bench_extraction_batches,
+    "extract_files": bench_extract_files,
+}
+
+
+def measure(run, repeat):
+    """Best wall time of `repeat` runs, then the retained and peak traced memory of one more."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        with quiet():
+            start = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        del result
+    gc.collect()
+    tracemalloc.start()
+    with quiet():
+        result = run()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"seconds": round(best, 4), "retained_mib": round(current / 2**20, 2), "peak_mib": round(peak / 2**20, 2)}
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=HERE,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("+dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(filename):
+    try:
+        with open(filename, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def compare(results, previous, threshold):
+    """Prints every result next to the previous run's, returns the names that got slower or bigger."""
+    regressions = []
+    for name, result in results.items():
+        line = f"{name:>26}: "
+        if "skipped" in result:
+            print(line + f"skipped ({result['skipped']})")
+            continue
+        line += f"{result['seconds']:9.3f} s  {result['peak_mib']:9.1f} MiB peak  {result['retained_mib']:9.1f} MiB kept"
+        old = previous.get(name) if previous else None
+        if old and "seconds" in old:
+            time_change = result["seconds"] / max(old["seconds"], 1e-9) - 1
+            memory_change = result["peak_mib"] / max(old["peak_mib"], 1e-9) - 1
+            line += f"  {time_change:+7.1%} time  {memory_change:+7.1%} memory"
+            # tiny timings are mostly noise
+            if (time_change > threshold and result["seconds"] - old["seconds"] > 0.01) or \
+                    (memory_change > threshold and result["peak_mib"] - old["peak_mib"] > 1):
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--lines", type=int, default=200_000, help="listing lines (files and folders)")
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--fanout", type=int, default=12)
+    parser.add_argument("--name-length", type=int, default=0, help="pad every name to this many characters")
+    parser.add_argument("--roots", nargs="+", default=["C:"],
+                        help="drives to spread the files over, '' for POSIX paths (default: C:)")
+    parser.add_argument("--versions", type=int, default=1, help="versions in the fake archive")
+    parser.add_argument("--selection", type=int, default=10_000, help="entries for extraction_batches")
+    parser.add_argument("--extract-files", type=int, default=200, help="files for extract_files")
+    parser.add_argument("--treelib-lines", type=int, default=1_000_000,
+                        help="skip the treelib benchmark above this many lines")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=None)
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON file the results are appended to")
+    parser.add_argument("--no-record", action="store_true", help="compare with the history but don't add to it")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown or growth reported as a regression (default: 0.10)")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    params = {name: getattr(args, name) for name in ("lines", "depth", "fanout", "name_length", "roots",
+                                                      "versions", "selection", "extract_files")}
+    print(f"Building a {args.lines:,} line fixture...")
+    fixture = Fixture(args)
+    results = {}
+    try:
+        for name in args.only or BENCHMARKS:
+            try:
+                results[name] = measure(BENCHMARKS[name](fixture, args), args.repeat)
+            except Skipped as e:
+                results[name] = {"skipped": str(e)}
+    finally:
+        fixture.close()
+
+    history = load_history(args.history)
+    previous = next((run["results"] for run in reversed(history) if run.get("params") == params), None)
+    print(f"Compared with {'the last run with these options' if previous else 'nothing, first run with these options'}:")
+    regressions = compare(results, previous, args.threshold)
+
+    if not args.no_record:
+        history.append({
+            "commit": current_commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": params,
+            "results": results,
+        })
+        with open(args.history, "w", encoding="utf-8") as f:
+            json.dump(history, f, indent=1)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
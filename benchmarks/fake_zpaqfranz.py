@@ -0,0 +1,135 @@
+"""Stand-in zpaqfranz that replays archives written by synthetic.write_archive(), for benchmarks and tests.
+
+    python -c "from benchmarks.synthetic import write_archive; write_archive('bench.zpaq', 100000, versions=3)"
+    ZPAQFRANZ="python benchmarks/fake_zpaqfranz.py" python zpaqtreeview.py bench.zpaq
+
+Understands the commands ZpaqTreeView runs: `l` (with -all and -since) and `x` (with -to or -stdout,
+and -until). Extracted files are filled with bytes derived from their path, as long as the listing says
+or at most FAKE_ZPAQFRANZ_MAX_SIZE bytes when that is set.
+"""
+import hashlib
+import os
+import sys
+
+FILL_BLOCK = 64 * 1024
+MAX_SIZE_ENV = "FAKE_ZPAQFRANZ_MAX_SIZE"
+
+
+def read_archive(filename):
+    """[(version, path, fields)] of every record and {version: date line} of the archive's versions."""
+    records = []
+    headers = {}
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split(",", 5)
+            if len(fields) != 6:
+                continue
+            version, _, path = fields[5].strip("'").partition("/")
+            if not path:
+                headers[int(version)] = line
+            else:
+                records.append((int(version), path, fields))
+    return records, headers
+
+
+def state(records, first=1, last=None):
+    """{path: fields} of the newest record of every path within versions first..last, deleted ones left out."""
+    paths = {}
+    for version, path, fields in sorted(records, key=lambda record: record[0]):
+        if version < first or (last is not None and version > last):
+            continue
+        if fields[0].strip("'"):
+            paths[path] = fields
+        else:
+            paths.pop(path, None)
+    return paths
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def operands(args, start):
+    """Arguments from `start` up to the next option."""
+    values = []
+    for arg in args[start:]:
+        if arg.startswith("-"):
+            break
+        values.append(arg)
+    return values
+
+
+def list_archive(filename, args):
+    records, headers = read_archive(filename)
+    since = int(option(args, "-since", 1))
+    out = sys.stdout
+    if "-all" in args:
+        for version, header in sorted(headers.items()):
+            if version >= since:
+                out.write(header)
+        for version, path, fields in records:
+            if version >= since:
+                out.write(",".join(fields) + "\n")
+    else:
+        for path, fields in sorted(state(records, since).items()):
+            out.write(",".join(fields[:5]) + f",'{path}'\n")
+    out.write(f"\n{max(headers, default=0)} versions, {len(records)} files\n")
+
+
+def fill(out, path, size):
+    block = hashlib.blake2b(path.encode("utf-8")).digest() * (FILL_BLOCK // 64)
+    while size > 0:
+        out.write(block[:size])
+        size -= len(block)
+
+
+def extract(filename, args):
+    records, _ = read_archive(filename)
+    until = option(args, "-until")
+    files = state(records, last=int(until) if until is not None else None)
+    sources = operands(args, 2)
+    targets = operands(args, args.index("-to") + 1) if "-to" in args else []
+    selected = []
+    for number, source in enumerate(sources):
+        target = targets[number] if number < len(targets) else (targets[0] if targets else None)
+        if source.endswith("/"):
+            for path in sorted(files):
+                if path.startswith(source) and path != source:
+                    selected.append((path, target and target.rstrip("/") + "/" + path[len(source):]))
+        elif source in files:
+            selected.append((source, target))
+    if not selected:
+        sys.stderr.write("Nothing to extract\n")
+        return 2
+    limit = int(os.environ.get(MAX_SIZE_ENV, 0)) or None
+    sizes = [min(int(files[path][2].strip("'")), limit or 2**63) for path, _ in selected]
+    total = sum(sizes) or 1
+    done = 0
+    for (path, target), size in zip(selected, sizes):
+        if "-stdout" in args:
+            fill(sys.stdout.buffer, path, size)
+        elif not path.endswith("/"):
+            os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+            with open(target, "wb") as f:
+                fill(f, path, size)
+        done += size
+        sys.stderr.write(f"\r{done * 100 / total:.2f}%")
+    sys.stderr.write("\n")
+    return 0
+
+
+def main(args):
+    if not args:
+        print("zpaqfranz (fake, replaying synthetic archives)")
+        return 0
+    if args[0] == "l":
+        list_archive(args[1], args)
+        return 0
+    if args[0] == "x":
+        return extract(args[1], args)
+    sys.stderr.write(f"Unsupported command {args[0]}\n")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,77 @@
+"""Synthetic zpaqfranz `l -longpath -terse -csv` listings for benchmarking."""
+import random
+
+VERSION_DATE = "2023-01-{day:02} 00:00:00"
+
+
+def padded(name, length):
+    """`name` lengthened to `length` characters before its extension, for benchmarks of long paths."""
+    if len(name) >= length:
+        return name
+    stem, dot, extension = name.rpartition(".")
+    if not dot:
+        return name + "_" * (length - len(name))
+    return stem + "_" * (length - len(name)) + dot + extension
+
+
+def generate_listing(lines, depth=6, fanout=12, root="C:", seed=0, name_length=0, max_size=10**9):
+    """Yields `lines` listing lines shaped like a real archive: sorted paths, folders before their files.
+
+    `root` is a drive like "C:" for a Windows archive or "" for POSIX paths starting with "/", and
+    `name_length` pads every file and folder name to at least that many characters, file sizes go up
+    to `max_size` bytes.
+    """
+    rng = random.Random(seed)
+    emitted = 0
+    stack = [(root, 0)]
+    while emitted < lines:
+        if not stack:
+            stack = [(f"{root}/more{emitted}", 0)]
+        directory, level = stack.pop()
+        yield f"'2023-01-01 00:00:00','D','0','0.000','0','{directory}/'\n"
+        emitted += 1
+        for i in range(fanout):
+            if emitted >= lines:
+                return
+            fields = f"'2023-{rng.randint(1, 12):02}-{rng.randint(1, 28):02} 12:34:56','A','{rng.randint(0, max_size)}'"
+            name = padded(f"file_{i:04}_{rng.randint(0, 10**6)}.dat", name_length)
+            yield f"{fields},'0.500','1','{directory}/{name}'\n"
+            emitted += 1
+        if level < depth:
+            stack.extend((f"{directory}/{padded(f'folder_{i:03}', name_length)}", level + 1)
+                         for i in range(fanout - 1, -1, -1))
+
+
+def generate_roots(lines, roots=("C:",), seed=0, **options):
+    """generate_listing() split evenly over several drives (or "" for POSIX), one after the other."""
+    for number, root in enumerate(roots):
+        share = lines // len(roots) + (1 if number < lines % len(roots) else 0)
+        yield from generate_listing(share, root=root, seed=seed + number, **options)
+
+
+def generate_versions(lines, versions=1, changed=0.1, deleted=0.02, seed=0, max_size=10**9, **options):
+    """Yields an `l -all` listing: version 1 holds generate_roots(lines), each later version changes and
+    deletes a share of the files that are still there. Every path is prefixed with its version number.
+    """
+    rng = random.Random(seed)
+    for version in range(1, versions + 1):
+        yield f"'{VERSION_DATE.format(day=version)}','','0','0.000','0','{version:04}/'\n"
+    for line in generate_roots(lines, seed=seed, max_size=max_size, **options):
+        date, attribute, size, ratio, x, path = line.rstrip("\n").split(",", 5)
+        yield f"{date},{attribute},{size},{ratio},{x},'0001/{path[1:]}\n"
+        if "D" in attribute:
+            continue
+        for version in range(2, versions + 1):
+            roll = rng.random()
+            if roll < deleted:
+                yield f"'',{attribute},'0',{ratio},{x},'{version:04}/{path[1:]}\n"
+                break
+            if roll < deleted + changed:
+                yield (f"'{VERSION_DATE.format(day=version)[:11]}12:00:00',{attribute},'{rng.randint(0, max_size)}',"
+                       f"{ratio},{x},'{version:04}/{path[1:]}\n")
+
+
+def write_archive(filename, lines, versions=1, **options):
+    """Writes a stand-in archive for fake_zpaqfranz.py, which is simply its `l -all` listing."""
+    with open(filename, "w", encoding="utf-8") as f:
+        f.writelines(generate_versions(lines, versions, **options))
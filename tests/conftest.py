@@ -0,0 +1,48 @@
+"""Shared fixtures: the modules live at the repository root, zpaqfranz is benchmarks/fake_zpaqfranz.py."""
+import configparser
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_zpaqfranz import MAX_SIZE_ENV  # noqa: E402
+from zpaq_driver import ZPAQFRANZ_ENV  # noqa: E402
+
+FAKE_ZPAQFRANZ = os.path.join(ROOT, "benchmarks", "fake_zpaqfranz.py")
+VERSION_HEADER = "'2023-01-{day:02} 00:00:00','','0','0.000','0','{version:04}/'\n"
+
+
+@pytest.fixture
+def fake_zpaqfranz(monkeypatch):
+    """Makes every ZpaqDriver.from_config() run fake_zpaqfranz.py."""
+    monkeypatch.setenv(ZPAQFRANZ_ENV, f'"{sys.executable}" "{FAKE_ZPAQFRANZ}"')
+    monkeypatch.delenv(MAX_SIZE_ENV, raising=False)
+    return [sys.executable, FAKE_ZPAQFRANZ]
+
+
+@pytest.fixture
+def config():
+    config = configparser.ConfigParser()
+    config.add_section("config")
+    return config
+
+
+def write_archive(filename, versions, records):
+    """Writes an archive for fake_zpaqfranz.py with `versions` versions.
+
+    records are (version, path, size, date) with date as "YYYY-MM-DD HH:MM:SS", a path ending in "/" is a
+    folder and a size of None deletes the path in that version.
+    """
+    with open(filename, "w", encoding="utf-8") as f:
+        for version in range(1, versions + 1):
+            f.write(VERSION_HEADER.format(day=version, version=version))
+        for version, path, size, date in records:
+            if size is None:
+                f.write(f"'','A','0','0.000','0','{version:04}/{path}'\n")
+            else:
+                attribute = "D" if path.endswith("/") else "A"
+                f.write(f"'{date}','{attribute}','{size}','0.500','1','{version:04}/{path}'\n")
+    return filename
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+
+import zpaq_listing
+import zpaqtreeview as ztv
+from conftest import write_archive
+from zpaq_async import AsyncZpaq
+from zpaq_cache import ListingCache
+
+RECORDS = [(1, "C:/", 0, "2023-01-01 00:00:00"), (1, "C:/dir/", 0, "2023-01-01 00:00:00")]
+RECORDS += [(1 + i % 2, f"C:/dir/file_{i:05}.txt", 100 + i, "2023-01-02 00:00:00") for i in range(3000)]
+
+
+def test_list_archive_parses_off_the_event_loop(tmp_path, fake_zpaqfranz, config, monkeypatch):
+    archive = write_archive(str(tmp_path / "backup.zpaq"), 2, RECORDS)
+    threads = set()
+    feed = zpaq_listing.ListingParser.feed
+
+    def recording_feed(self, lines):
+        threads.add(threading.get_ident())
+        return feed(self, lines)
+
+    monkeypatch.setattr(zpaq_listing.ListingParser, "feed", recording_feed)
+    monkeypatch.setattr(zpaq_listing, "CHUNK_SIZE", 4096)
+    monkeypatch.setattr("zpaq_async.CHUNK_SIZE", 4096)
+    lines = []
+
+    async def list_archive():
+        return threading.get_ident(), await AsyncZpaq(config).list_archive(archive, progress=lines.append)
+
+    loop_thread, index = asyncio.run(list_archive())
+    assert loop_thread not in threads
+    assert sum(lines) > 3000
+    expected, _ = ztv.load_tree(config, archive, ListingCache(str(tmp_path / "cache"), max_size=0))
+    assert len(index) == len(expected)
+    assert index.total_size(index.find("C:/dir")) == expected.total_size(expected.find("C:/dir"))
+
+
+def test_cancelled_listing_waits_for_its_parse(tmp_path, fake_zpaqfranz, config, monkeypatch):
+    archive = write_archive(str(tmp_path / "backup.zpaq"), 2, RECORDS)
+    started = threading.Event()
+    release = threading.Event()
+    running = []
+    feed = zpaq_listing.ListingParser.feed
+
+    def slow_feed(self, lines):
+        running.append(True)
+        started.set()
+        release.wait(10)
+        feed(self, lines)
+        running.pop()
+
+    monkeypatch.setattr(zpaq_listing.ListingParser, "feed", slow_feed)
+
+    async def cancel():
+        task = asyncio.ensure_future(AsyncZpaq(config).list_archive(archive))
+        await asyncio.to_thread(started.wait, 10)
+        task.cancel()
+        asyncio.get_running_loop().call_later(0.2, release.set)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return list(running)
+
+    assert asyncio.run(cancel()) == []
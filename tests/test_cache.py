@@ -0,0 +1,266 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+import zpaq_cache
+import zpaqtreeview as ztv
+from benchmarks.fake_zpaqfranz import fill
+from conftest import write_archive
+from zpaq_cache import APPENDED, HIT, MISS, BlockCache, BlockReader, ContentCache, ListingCache
+from zpaq_catalog import default_catalog
+from zpaq_driver import ZPAQFRANZ_ENV, ZpaqError
+from zpaq_index import ArchiveIndex
+
+
+def small_index(*paths):
+    index = ArchiveIndex()
+    for path in paths:
+        index.add(path, 10, 1672531200, "A")
+    return index
+
+
+def write(filename, data, mode="wb"):
+    with open(filename, mode) as f:
+        f.write(data)
+
+
+def test_listing_cache_hit_appended_miss(tmp_path):
+    archive = str(tmp_path / "backup.zpaq")
+    write(archive, b"version one" * 1000)
+    cache = ListingCache(str(tmp_path / "cache"))
+    assert cache.load(archive)[2] == MISS
+
+    stored = small_index("C:/a.txt")
+    stored.versions = 1
+    cache.store(archive, stored)
+    index, header, state, identity = cache.load(archive)
+    assert state == HIT and index.versions == 1
+    assert index.find("C:/a.txt") is not None and index.identity == identity
+
+    write(archive, b"version two", "ab")
+    index, _, state, identity = cache.load(archive)
+    assert state == APPENDED and index.find("C:/a.txt") is not None
+    assert index.identity != identity  # still the listing of the shorter archive
+    cache.store(archive, small_index("C:/a.txt", "C:/b.txt"), identity)
+    assert cache.load(archive)[2] == HIT
+
+    write(archive, b"rewritten" * 2000)
+    assert cache.load(archive)[:3] == (None, None, MISS)
+    assert not os.path.exists(cache.entry_path(archive))
+
+
+def test_listing_cache_evicts_least_recently_used(tmp_path):
+    archives = []
+    for i in range(3):
+        archives.append(str(tmp_path / f"{i}.zpaq"))
+        write(archives[-1], bytes([i]) * 100)
+    cache = ListingCache(str(tmp_path / "cache"))
+    for i, archive in enumerate(archives):
+        cache.store(archive, small_index(*(f"C:/{i}/{n}.txt" for n in range(50))))
+        os.utime(cache.entry_path(archive), (1000 + i, 1000 + i))
+    write(cache.companion_path(archives[0], ".ztvsrch"), b"search")
+    write(os.path.join(cache.location, "catalog.ztvcat"), b"x" * 100_000)  # not an entry, never counted
+    entry = os.path.getsize(cache.entry_path(archives[0]))
+
+    cache.max_size = 2 * entry + 100
+    cache.evict(keep=cache.entry_path(archives[0]))
+    assert [os.path.exists(cache.entry_path(archive)) for archive in archives] == [True, False, True]
+    cache.max_size = entry
+    cache.evict()
+    assert not os.path.exists(cache.entry_path(archives[0]))
+    assert not os.path.exists(cache.companion_path(archives[0], ".ztvsrch"))
+    assert os.path.exists(os.path.join(cache.location, "catalog.ztvcat"))
+
+
+def test_listing_cache_eviction_skips_vanished_entries(tmp_path, monkeypatch):
+    archive = str(tmp_path / "backup.zpaq")
+    write(archive, b"data")
+    cache = ListingCache(str(tmp_path / "cache"), max_size=1)
+    os.makedirs(os.path.join(cache.location, "folder"))
+    listdir = os.listdir
+    # another process evicting at the same time removed an entry between listing and stat
+    monkeypatch.setattr(zpaq_cache.os, "listdir", lambda path: listdir(path) + ["gone" + zpaq_cache.EXTENSION])
+    cache.store(archive, small_index("C:/a.txt"))
+    assert os.path.exists(cache.entry_path(archive))
+    assert os.path.isdir(os.path.join(cache.location, "folder"))
+
+
+def test_caches_default_to_separate_directories(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setenv("LOCALAPPDATA", str(tmp_path))
+    listings = ListingCache().location
+    content = ContentCache().location
+    assert os.path.dirname(listings) == os.path.dirname(content) == str(tmp_path)
+    assert listings != content
+    catalog = default_catalog(ListingCache())
+    assert os.path.dirname(os.path.dirname(catalog)) == str(tmp_path) and not catalog.startswith(listings + os.sep)
+
+
+class FakeExtraction:
+    """Stands in for a zpaqfranz process streaming one file, `gate` holds back its first read."""
+
+    def __init__(self, data, gate=None, returncode=None):
+        self.stdout = self
+        self._data = io.BytesIO(data)
+        self._gate = gate
+        self.returncode = None
+        self._exit = returncode  # exit code once killed or at the end, None to just be killed
+
+    def read(self, size):
+        if self._gate is not None:
+            assert self._gate.wait(10)
+            self._gate = None
+        return self._data.read(size)
+
+    def close(self):
+        pass
+
+    def poll(self):
+        return self.returncode
+
+    def kill(self):
+        self.returncode = -9
+
+    def wait(self):
+        if self._exit is not None:
+            self.returncode = self._exit
+        return self.returncode
+
+
+def content(path, size):
+    return bytes((hash(path) + i) % 251 for i in range(size))
+
+
+def test_block_reader_shares_one_extraction_per_file(tmp_path):
+    size = 10 * 1000 + 17
+    gate = threading.Event()
+    opened = []
+
+    def open_stream(path, size, date):
+        opened.append(path)
+        return FakeExtraction(content(path, size), gate)
+
+    reader = BlockReader(BlockCache(str(tmp_path), 1024**2, block_size=1000), open_stream)
+    results = {}
+
+    def read(offset):
+        results[offset] = bytes(reader.read("C:/big.bin", size, offset, 1500))
+
+    threads = [threading.Thread(target=read, args=(offset,)) for offset in range(0, size, 700)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)  # every reader is waiting for the one extraction
+    gate.set()
+    for thread in threads:
+        thread.join()
+    expected = content("C:/big.bin", size)
+    assert results == {offset: expected[offset:offset + 1500] for offset in range(0, size, 700)}
+    assert opened == ["C:/big.bin"]
+
+
+def test_block_reader_extracts_different_files_in_parallel(tmp_path):
+    gate = threading.Event()
+    streams = {"C:/slow.bin": lambda: FakeExtraction(content("C:/slow.bin", 3000), gate),
+               "C:/fast.bin": lambda: FakeExtraction(content("C:/fast.bin", 3000))}
+    reader = BlockReader(BlockCache(str(tmp_path), 1024**2, block_size=1000),
+                         lambda path, size, date: streams[path]())
+    slow = threading.Thread(target=reader.read, args=("C:/slow.bin", 3000, 0, 10))
+    slow.start()
+    # the slow file's extraction is stuck, the other file does not queue behind it
+    assert bytes(reader.read("C:/fast.bin", 3000, 2500, 500)) == content("C:/fast.bin", 3000)[2500:]
+    gate.set()
+    slow.join()
+
+
+def test_block_reader_raises_for_a_short_extraction(tmp_path):
+    data = content("C:/big.bin", 3500)
+    streams = [FakeExtraction(data[:2300], returncode=2), FakeExtraction(data)]
+    reader = BlockReader(BlockCache(str(tmp_path), 1024**2, block_size=1000), lambda path, size, date: streams.pop(0))
+    with pytest.raises(ZpaqError):
+        reader.read("C:/big.bin", 3500, 2100, 100)
+    assert ("C:/big.bin", 1) in reader.cache and ("C:/big.bin", 2) not in reader.cache
+    assert bytes(reader.read("C:/big.bin", 3500, 2100, 1400)) == data[2100:]
+    assert not streams
+
+
+def expected(path, size):
+    out = io.BytesIO()
+    fill(out, path, size)
+    return out.getvalue()
+
+
+def test_content_cache_round_trip(tmp_path):
+    archive = str(tmp_path / "backup.zpaq")
+    write(archive, b"archive" * 10_000)
+    cache = ContentCache(str(tmp_path / "content"), max_size=10_000)
+    assert cache.get(archive, "C:/a.txt", 5, 100) is None
+    cache.put(archive, "C:/a.txt", 5, 100, b"hello")
+    assert cache.get(archive, "C:/a.txt", 5, 100) == b"hello"
+    assert (cache.hits, cache.misses) == (1, 1)
+    # another version of the file, or the file as of an earlier version, has an entry of its own
+    assert cache.get(archive, "C:/a.txt", 5, 200) is None
+    assert cache.get(archive, "C:/a.txt", 5, 100, until="1") is None
+    # kept across sessions, and appending to the archive does not change its key
+    write(archive, b"more", "ab")
+    assert ContentCache(cache.location).get(archive, "C:/a.txt", 5, 100) == b"hello"
+
+    cache.put(archive, "C:/big.bin", 3000, 100, b"x" * 3000)  # over a quarter of max_size
+    assert (archive, "C:/big.bin", 3000, 100, None) not in cache
+    cache.put(archive, "C:/short.txt", 10, 100, b"short")  # not every byte, never an entry
+    assert (archive, "C:/short.txt", 10, 100, None) not in cache
+
+
+def test_content_cache_keeps_streamed_files(tmp_path, fake_zpaqfranz, config, monkeypatch):
+    archive = write_archive(str(tmp_path / "backup.zpaq"), 1, [
+        (1, "C:/", 0, "2023-01-01 00:00:00"), (1, "C:/a.bin", 200_000, "2023-01-01 00:00:00")])
+    cache = ContentCache(str(tmp_path / "content"))
+    key = (archive, "C:/a.bin", 200_000, 1672531200, None)
+    data = expected("C:/a.bin", 200_000)
+
+    partial = ztv.iter_file(config, archive, "C:/a.bin", 1000, content=cache, size=200_000, date=1672531200)
+    next(partial)
+    partial.close()  # stopped early, what was read is not kept
+    assert key not in cache
+    assert b"".join(ztv.iter_file(config, archive, "C:/a.bin", content=cache, size=200_000,
+                                  date=1672531200)) == data
+    assert key in cache
+
+    monkeypatch.setenv(ZPAQFRANZ_ENV, str(tmp_path / "missing"))  # a hit never starts zpaqfranz
+    out = io.BytesIO()
+    assert ztv.copy_file(config, archive, "C:/a.bin", out, content=cache, size=200_000, date=1672531200) == 200_000
+    assert out.getvalue() == data
+    assert not [name for _, _, names in os.walk(cache.location) for name in names if name.endswith(".tmp")]
+
+
+def test_content_cache_does_not_keep_failed_extractions(tmp_path, fake_zpaqfranz, config):
+    archive = write_archive(str(tmp_path / "backup.zpaq"), 1, [(1, "C:/", 0, "2023-01-01 00:00:00")])
+    cache = ContentCache(str(tmp_path / "content"))
+    with pytest.raises(ZpaqError):
+        b"".join(ztv.iter_file(config, archive, "C:/missing.bin", content=cache, size=10, date=1))
+    assert (archive, "C:/missing.bin", 10, 1, None) not in cache
+
+
+def test_content_cache_eviction(tmp_path):
+    archive = str(tmp_path / "backup.zpaq")
+    write(archive, b"archive")
+    cache = ContentCache(str(tmp_path / "content"), max_size=1000)
+    for i in range(3):
+        cache.put(archive, f"C:/{i}.bin", 250, 100, b"x" * 250)
+        filename = cache.entry_path(archive, f"C:/{i}.bin", 250, 100)
+        os.utime(filename, (1000 + i, 1000 + i))
+    stale = os.path.join(os.path.dirname(filename), "crashed.tmp")
+    fresh = os.path.join(os.path.dirname(filename), "writing.tmp")
+    write(stale, b"partial")
+    write(fresh, b"partial")
+    os.utime(stale, (time.time() - 2 * zpaq_cache.STALE_TEMP,) * 2)
+
+    cache.get(archive, "C:/0.bin", 250, 100)  # now the most recently used
+    cache.put(archive, "C:/3.bin", 250, 100, b"x" * 250)
+    cache.put(archive, "C:/4.bin", 250, 100, b"x" * 250)
+    kept = [(archive, f"C:/{i}.bin", 250, 100, None) in cache for i in range(5)]
+    assert kept == [True, False, True, True, True]
+    assert cache.size == 1000
+    assert not os.path.exists(stale) and os.path.exists(fresh)
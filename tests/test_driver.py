@@ -0,0 +1,97 @@
+import io
+import time
+
+import pytest
+
+from benchmarks.fake_zpaqfranz import fill
+from zpaq_driver import (ZpaqDriver, ZpaqFailed, ZpaqNotFound, ZpaqOutputTooLarge, ZpaqTimeout, collect,
+                         parse_progress)
+
+from conftest import write_archive
+
+HUGE = 10**12
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return write_archive(str(tmp_path / "a.zpaq"), 1, [
+        (1, "C:/", 0, "2023-01-01 00:00:00"),
+        (1, "C:/small.txt", 5000, "2023-01-01 12:00:00"),
+        (1, "C:/huge.bin", HUGE, "2023-01-01 12:00:00"),
+    ])
+
+
+@pytest.fixture
+def driver(fake_zpaqfranz):
+    return ZpaqDriver(fake_zpaqfranz)
+
+
+def small():
+    out = io.BytesIO()
+    fill(out, "C:/small.txt", 5000)
+    return out.getvalue()
+
+
+def test_run(driver, archive):
+    assert driver.run("x", archive, "C:/small.txt", "-stdout") == small()
+
+
+def test_from_config_uses_environment(fake_zpaqfranz, config):
+    assert ZpaqDriver.from_config(config).executable == fake_zpaqfranz
+
+
+def test_nonzero_exit_is_typed_with_stderr(driver, archive):
+    with pytest.raises(ZpaqFailed) as failed:
+        driver.run("x", archive, "C:/missing.txt", "-stdout")
+    assert failed.value.returncode == 2
+    assert "Nothing to extract" in failed.value.stderr
+    assert "Nothing to extract" in str(failed.value)
+    assert failed.value.command[-3:] == ["x", archive, "C:/missing.txt", "-stdout"][-3:]
+
+    with pytest.raises(ZpaqFailed) as failed:
+        driver.run("nonsense")
+    assert failed.value.returncode == 1 and "Unsupported command" in failed.value.stderr
+
+
+def test_failure_surfaces_when_a_stream_is_closed(driver, archive):
+    process = driver.stream("x", archive, "C:/missing.txt", "-stdout")
+    assert process.read() == b""
+    with pytest.raises(ZpaqFailed):
+        process.close()
+
+
+def test_timeout_kills_the_process(driver, archive):
+    started = time.perf_counter()
+    process = driver.stream("x", archive, "C:/huge.bin", "-stdout", timeout=0.5)
+    with pytest.raises(ZpaqTimeout):
+        collect(process, keep_tail=True)  # never finishes on its own, HUGE bytes
+    assert time.perf_counter() - started < 30
+    assert process.timed_out and process.poll() is not None
+
+
+def test_output_cap(driver, archive):
+    with pytest.raises(ZpaqOutputTooLarge):
+        driver.run("x", archive, "C:/small.txt", "-stdout", max_output=1000)
+    tail = driver.run("x", archive, "C:/small.txt", "-stdout", max_output=1000, keep_tail=True)
+    assert len(tail) <= 1000 and small().endswith(tail)
+
+
+def test_output_cap_stops_the_process(driver, archive):
+    process = driver.stream("x", archive, "C:/huge.bin", "-stdout")
+    with pytest.raises(ZpaqOutputTooLarge):
+        collect(process, max_output=10 * 1024 * 1024)
+    assert process.poll() is not None
+
+
+def test_check(driver, tmp_path):
+    assert b"zpaqfranz" in driver.check()
+    with pytest.raises(ZpaqNotFound):
+        ZpaqDriver(str(tmp_path / "no-zpaqfranz")).check()
+
+
+def test_progress(driver, archive):
+    seen = []
+    driver.run("x", archive, "C:/small.txt", "-stdout", progress=seen.append)
+    assert seen and seen[-1] == 100.0
+    assert parse_progress(b"\r12.50%\r99,5%") == 99.5
+    assert parse_progress(b"no progress") is None
@@ -0,0 +1,170 @@
+"""ZpaqFileSystemOperations driven directly, with a stand-in winfspy where the real one is not installed."""
+import io
+import sys
+import types
+
+import pytest
+
+import zpaqtreeview as ztv
+from benchmarks.fake_zpaqfranz import MAX_SIZE_ENV, fill
+from zpaq_cache import ListingCache, BLOCK_SIZE
+from zpaq_namespace import FILE_ATTRIBUTE_ARCHIVE, FILE_ATTRIBUTE_READONLY
+
+from conftest import write_archive
+
+
+def install_winfspy_stub():
+    winfspy = types.ModuleType("winfspy")
+
+    class NTStatusError(Exception):
+        pass
+
+    for name in ("NTStatusObjectNameNotFound", "NTStatusDirectoryNotEmpty", "NTStatusNotADirectory",
+                 "NTStatusObjectNameCollision", "NTStatusAccessDenied", "NTStatusEndOfFile",
+                 "NTStatusMediaWriteProtected", "NTStatusIoDeviceError"):
+        setattr(winfspy, name, type(name, (NTStatusError,), {}))
+
+    class BaseFileSystemOperations:
+        pass
+
+    winfspy.BaseFileSystemOperations = BaseFileSystemOperations
+    winfspy.FileSystem = object
+    winfspy.enable_debug_log = lambda: None
+    winfspy.FILE_ATTRIBUTE = types.SimpleNamespace()
+    winfspy.CREATE_FILE_CREATE_OPTIONS = types.SimpleNamespace()
+    plumbing = types.ModuleType("winfspy.plumbing")
+    win32_filetime = types.ModuleType("winfspy.plumbing.win32_filetime")
+    win32_filetime.filetime_now = lambda: 0
+    security_descriptor = types.ModuleType("winfspy.plumbing.security_descriptor")
+    security_descriptor.SecurityDescriptor = types.SimpleNamespace(
+        from_string=lambda string: types.SimpleNamespace(handle=None, size=0))
+    sys.modules.update({"winfspy": winfspy, "winfspy.plumbing": plumbing,
+                        "winfspy.plumbing.win32_filetime": win32_filetime,
+                        "winfspy.plumbing.security_descriptor": security_descriptor})
+
+
+try:
+    import winfspy
+except ImportError:
+    install_winfspy_stub()
+    import winfspy
+
+import zpaq_fileexplorer  # noqa: E402
+
+SIZES = {"C:/docs/a.txt": 1000, "C:/docs/b.txt": 5000, "C:/docs/big.bin": 2 * BLOCK_SIZE + 123, "C:/empty.txt": 0}
+
+
+def contents(path):
+    out = io.BytesIO()
+    fill(out, path, SIZES[path])
+    return out.getvalue()
+
+
+@pytest.fixture
+def operations(tmp_path, fake_zpaqfranz, config):
+    records = [(1, "C:/", 0, "2023-01-01 00:00:00"), (1, "C:/docs/", 0, "2023-01-01 00:00:00")]
+    records += [(1, path, size, "2023-01-01 12:00:00") for path, size in SIZES.items()]
+    archive = write_archive(str(tmp_path / "a.zpaq"), 1, records)
+    operations = zpaq_fileexplorer.ZpaqFileSystemOperations("test", archive, str(tmp_path / "cache"), 10**7, config,
+                                                            prefetch_budget=0)
+    operations.set_index(ztv.load_tree(config, archive, ListingCache(str(tmp_path / "listings")))[0])
+    yield operations
+    operations._prefetcher.close()
+    operations._reader.close()
+
+
+def read_all(operations, name, length=64 * 1024):
+    handle = operations.open(name, 0, 0)
+    data = b""
+    try:
+        while True:
+            try:
+                data += bytes(operations.read(handle, len(data), length))
+            except winfspy.NTStatusEndOfFile:
+                return data
+    finally:
+        operations.close(handle)
+
+
+def test_get_security_by_name(operations):
+    attributes, _, _ = operations.get_security_by_name("\\docs\\a.txt")
+    assert attributes == FILE_ATTRIBUTE_ARCHIVE | FILE_ATTRIBUTE_READONLY
+    with pytest.raises(winfspy.NTStatusObjectNameNotFound):
+        operations.get_security_by_name("\\docs\\missing.txt")
+
+
+def test_read_directory(operations):
+    handle = operations.open("\\docs", 0, 0)
+    entries = operations.read_directory(handle, None)
+    assert [entry["file_name"] for entry in entries] == [".", "..", "a.txt", "b.txt", "big.bin"]
+    assert [entry["file_name"] for entry in operations.read_directory(handle, "a.txt")] == ["b.txt", "big.bin"]
+    assert operations.get_dir_info_by_name(handle, "b.txt")["file_size"] == SIZES["C:/docs/b.txt"]
+    with pytest.raises(winfspy.NTStatusObjectNameNotFound):
+        operations.get_dir_info_by_name(handle, "c.txt")
+    operations.close(handle)
+    handle = operations.open("\\docs\\a.txt", 0, 0)
+    with pytest.raises(winfspy.NTStatusNotADirectory):
+        operations.read_directory(handle, None)
+    operations.close(handle)
+
+
+def test_read(operations):
+    assert read_all(operations, "\\docs\\a.txt") == contents("C:/docs/a.txt")
+    assert read_all(operations, "\\empty.txt") == b""
+    # across block boundaries, in reads of odd sizes and out of order
+    expected = contents("C:/docs/big.bin")
+    assert read_all(operations, "\\docs\\big.bin", 300_000) == expected
+    handle = operations.open("\\docs\\big.bin", 0, 0)
+    for offset in (BLOCK_SIZE * 2 + 100, 10, BLOCK_SIZE - 5):
+        assert bytes(operations.read(handle, offset, 50)) == expected[offset:offset + 50]
+    operations.close(handle)
+
+
+def test_failed_extraction_is_a_read_error(operations, monkeypatch):
+    monkeypatch.setenv(MAX_SIZE_ENV, str(BLOCK_SIZE + 10))  # zpaqfranz stops early in the second block
+    handle = operations.open("\\docs\\big.bin", 0, 0)
+    assert bytes(operations.read(handle, 0, 100)) == contents("C:/docs/big.bin")[:100]
+    with pytest.raises(zpaq_fileexplorer.NTStatusReadFailed):
+        operations.read(handle, BLOCK_SIZE + 5, 100)
+    monkeypatch.delenv(MAX_SIZE_ENV)
+    # the short block was not cached, reading again extracts it in full
+    offset = BLOCK_SIZE + 5
+    assert bytes(operations.read(handle, offset, BLOCK_SIZE)) == contents("C:/docs/big.bin")[offset:offset + BLOCK_SIZE]
+    operations.close(handle)
+
+
+def test_handles_are_released(operations):
+    namespace = operations._namespace
+    handles = [operations.open("\\docs\\a.txt", 0, 0) for _ in range(3)]
+    handles.append(operations.open("\\docs", 0, 0))
+    assert namespace.open_handles() == 4
+    for handle in handles:
+        operations.close(handle)
+    assert namespace.open_handles() == 0
+    with pytest.raises(winfspy.NTStatusObjectNameNotFound):
+        operations.open("\\nothing", 0, 0)
+
+
+def test_read_only(operations):
+    handle = operations.open("\\docs\\a.txt", 0, 0)
+    with pytest.raises(winfspy.NTStatusMediaWriteProtected):
+        operations.write(handle, b"x", 0, False, False)
+    with pytest.raises(winfspy.NTStatusMediaWriteProtected):
+        operations.can_delete(handle, "\\docs\\a.txt")
+    with pytest.raises(winfspy.NTStatusMediaWriteProtected):
+        operations.create("\\new.txt", 0, 0, 0, None, 0, None)
+    operations.close(handle)
+
+
+def test_handles_keep_their_index(operations, config, tmp_path):
+    handle = operations.open("\\docs\\a.txt", 0, 0)
+    old = operations._namespace
+    archive = write_archive(str(tmp_path / "b.zpaq"), 1, [(1, "C:/", 0, "2023-01-01 00:00:00"),
+                                                         (1, "C:/other.txt", 7, "2023-01-01 00:00:00")])
+    operations.set_index(ztv.load_tree(config, archive, ListingCache(str(tmp_path / "listings")))[0])
+    assert handle.file_obj.namespace is old
+    assert bytes(operations.read(handle, 0, 10)) == contents("C:/docs/a.txt")[:10]
+    operations.close(handle)
+    assert old.open_handles() == 0
+    with pytest.raises(winfspy.NTStatusObjectNameNotFound):
+        operations.open("\\docs\\a.txt", 0, 0)
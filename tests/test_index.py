@@ -0,0 +1,39 @@
+import io
+
+from benchmarks.synthetic import generate_roots
+from zpaq_index import ArchiveIndex
+from zpaq_listing import parse_listing
+
+
+def record(date, path, size=0, attribute="A"):
+    return f"'{date}','{attribute}','{size}','0.500','1','{path}'\n"
+
+
+def aggregates(index):
+    return {column: list(getattr(index, column)) for column in ArchiveIndex.AGGREGATE_COLUMNS}
+
+
+def test_update_aggregates_matches_full_aggregate():
+    index = ArchiveIndex()
+    parse_listing(index, io.BytesIO("".join(generate_roots(2000, roots=("C:", "D:"), depth=3, fanout=4)).encode()))
+    index.aggregate()
+    files = [node for node in range(1, len(index)) if not index.is_directory(node)]
+    changed = [index.full_path(node) for node in files[::97]]
+    folder = index.full_path(index.parents[files[0]])
+
+    delta = [record("2024-02-01 10:00:00", path, 1234 + i) for i, path in enumerate(changed)]
+    delta += [record("2024-02-02 10:00:00", f"{folder}/new_{i}.dat", 10 * i) for i in range(5)]
+    delta += [record("2024-02-03 10:00:00", "C:/fresh/", attribute="D"),
+              record("2024-02-03 10:00:00", "C:/fresh/deeper/", attribute="D"),
+              record("2024-02-04 10:00:00", "C:/fresh/deeper/a.bin", 7),
+              record("2024-02-05 10:00:00", "C:/fresh/b.bin", 8),
+              record("2024-02-06 10:00:00", "E:/other/c.bin", 9)]
+    parse_listing(index, delta)
+    assert index.aggregated
+    merged = aggregates(index)
+
+    index.drop_aggregates()
+    index.aggregate()
+    assert merged == aggregates(index)
+    assert index.file(index.find("C:/fresh")).size == 15
+    assert index.find(changed[0]) is not None and index.sizes[index.find(changed[0])] == 1234
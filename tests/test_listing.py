@@ -0,0 +1,94 @@
+import io
+
+import pytest
+
+import zpaq_listing
+from benchmarks.synthetic import generate_roots
+from zpaq_cache import load_index, save_index
+from zpaq_index import ArchiveIndex
+from zpaq_listing import parse_listing, parse_listing_parallel
+
+
+def listing(lines, **options):
+    return "".join(generate_roots(lines, **options)).encode("utf-8")
+
+
+def parse(data, **options):
+    index = ArchiveIndex()
+    parse_listing(index, io.BytesIO(data), **options)
+    return index
+
+
+def snapshot(index):
+    """Everything an index holds, names by value so differently interned indexes compare equal."""
+    columns = {column: list(getattr(index, column)) for column in ArchiveIndex.COLUMNS if column != "name_ids"}
+    columns["names"] = [index.name(node) for node in range(len(index))]
+    columns["attributes"] = [index.attributes[attribute] for attribute in index.attribute_ids]
+    return columns
+
+
+def test_chunked_parse_matches_line_by_line():
+    data = listing(3000, roots=("C:", "D:"), depth=3, fanout=4)
+    whole = parse(data)
+    lines = ArchiveIndex()
+    parse_listing(lines, data.decode("utf-8").splitlines(keepends=True))
+    assert snapshot(parse(data, chunk_size=777)) == snapshot(whole) == snapshot(lines)
+    assert whole.find("C:") is not None and whole.find("D:") is not None
+
+
+@pytest.mark.parametrize("workers, chunk_size", [(2, 4096), (3, 10_000), (2, 100_000)])
+def test_parallel_parse_matches_serial(monkeypatch, workers, chunk_size):
+    monkeypatch.setattr(zpaq_listing, "PARALLEL_MIN_SIZE", 1)
+    data = listing(20_000, roots=("C:", "D:", ""), depth=4, fanout=5, name_length=12)
+    serial = parse(data)
+    parallel = ArchiveIndex()
+    merger = parse_listing_parallel(parallel, io.BytesIO(data), workers, chunk_size)
+    assert isinstance(merger, zpaq_listing.ParallelMerge)
+    assert snapshot(parallel) == snapshot(serial)
+    serial.aggregate()
+    parallel.aggregate()
+    assert list(parallel.total_sizes) == list(serial.total_sizes)
+    assert list(parallel.file_counts) == list(serial.file_counts)
+
+
+def test_small_listing_is_parsed_serially():
+    data = listing(500)
+    index = ArchiveIndex()
+    parser = parse_listing_parallel(index, io.BytesIO(data), workers=4)
+    assert isinstance(parser, zpaq_listing.ListingParser)
+    assert snapshot(index) == snapshot(parse(data))
+
+
+def test_merge_into_cached_index_indexes_only_touched_folders(tmp_path):
+    old = listing(5000, roots=("C:", "D:"), depth=3, fanout=4).decode("utf-8").splitlines(keepends=True)
+    index = parse(listing(5000, roots=("C:", "D:"), depth=3, fanout=4))
+    files = [node for node in range(1, len(index)) if not index.is_directory(node)]
+    folder = index.full_path(index.parents[files[0]])
+    other = index.full_path(index.parents[files[-1]])
+    first = index.name(files[0])
+    delta = ["'2024-02-01 10:00:00','A','1','0.500','1','%s'\n" % index.full_path(files[0]),
+             "'2024-02-01 10:00:00','A','2','0.500','1','%s/new.txt'\n" % folder,
+             # a name the folder's uninterned file also has, in a folder that does not have it yet
+             "'2024-02-01 10:00:00','A','3','0.500','1','%s/%s'\n" % (other, first),
+             "'2024-02-01 10:00:00','D','0','0.000','0','C:/fresh/'\n",
+             "'2024-02-01 10:00:00','A','4','0.500','1','C:/fresh/%s'\n" % first]
+    index.aggregate()
+    save_index(index, str(tmp_path / "index.ztvidx"))
+    cached, _ = load_index(str(tmp_path / "index.ztvidx"))
+
+    parse_listing(cached, delta)
+    assert not cached.interned and len(cached._lookup) < len(cached) // 10
+    full = ArchiveIndex()
+    parse_listing(full, old + delta)
+    assert snapshot(cached) == snapshot(full)
+    assert cached.sizes[cached.find(f"{folder}/{first}")] == 1
+    assert cached.sizes[cached.find(f"{other}/{first}")] == 3
+    assert cached.find(f"C:/fresh/{first}") is not None
+
+
+def test_dates_are_the_same_when_the_date_cache_turns_over(monkeypatch):
+    data = listing(3000)
+    whole = parse(data)
+    monkeypatch.setattr(zpaq_listing, "DATE_CACHE_SIZE", 3)
+    assert snapshot(parse(data)) == snapshot(whole)
+    assert whole.dates[whole.find("C:")] == 1672531200
@@ -0,0 +1,114 @@
+from zpaq_index import ArchiveIndex, VIRTUAL_ROOT
+from zpaq_namespace import (IndexNamespace, split_path, filetime, FILE_ATTRIBUTE_ARCHIVE, FILE_ATTRIBUTE_DIRECTORY,
+                            FILE_ATTRIBUTE_READONLY)
+
+DATE = 1672531200  # 2023-01-01
+
+
+def index_of(*paths):
+    """Index of the paths, those ending in "/" are folders."""
+    index = ArchiveIndex()
+    for number, path in enumerate(paths):
+        index.add(path, 0 if path.endswith("/") else number + 1, DATE + number, "D" if path.endswith("/") else "A")
+    index.aggregate()
+    return index
+
+
+def names(entries):
+    return [entry["file_name"] for entry in entries]
+
+
+def test_split_path():
+    assert split_path("\\") == []
+    assert split_path("\\a\\b.txt") == ["a", "b.txt"]
+
+
+def test_resolve_single_root():
+    index = index_of("C:/", "C:/docs/", "C:/docs/a.txt", "C:/docs/b.txt")
+    namespace = IndexNamespace(index)
+    assert namespace.root == index.find("C:")
+    assert namespace.resolve("\\") == namespace.root
+    assert namespace.resolve("\\docs\\a.txt") == index.find("C:/docs/a.txt")
+    assert namespace.resolve("\\docs\\missing.txt") is None
+    assert namespace.resolve("\\docs\\a.txt\\below") is None  # a.txt is no folder
+
+
+def test_resolve_several_roots():
+    index = index_of("C:/a.txt", "D:/b.txt")
+    namespace = IndexNamespace(index)
+    assert namespace.root == VIRTUAL_ROOT
+    assert names(namespace.read_directory(namespace.root)) == ["C", "D"]
+    assert namespace.resolve("\\D\\b.txt") == index.find("D:/b.txt")
+
+
+def test_read_directory_markers():
+    index = index_of("C:/", "C:/d/", "C:/d/c.txt", "C:/d/a.txt", "C:/d/b/", "C:/d/e.txt")
+    namespace = IndexNamespace(index)
+    folder = namespace.resolve("\\d")
+    assert names(namespace.read_directory(folder)) == [".", "..", "a.txt", "b", "c.txt", "e.txt"]
+    assert names(namespace.read_directory(folder, ".")) == ["..", "a.txt", "b", "c.txt", "e.txt"]
+    assert names(namespace.read_directory(folder, "..")) == ["a.txt", "b", "c.txt", "e.txt"]
+    assert names(namespace.read_directory(folder, "b")) == ["c.txt", "e.txt"]
+    assert names(namespace.read_directory(folder, "bb")) == ["c.txt", "e.txt"]  # no longer there
+    assert names(namespace.read_directory(folder, "e.txt")) == []
+    # the volume root has no "." and ".."
+    assert names(namespace.read_directory(namespace.root)) == ["d"]
+
+
+def test_file_info():
+    index = index_of("C:/", "C:/d/", "C:/d/a.txt")
+    namespace = IndexNamespace(index)
+    node = namespace.resolve("\\d\\a.txt")
+    info = namespace.file_info(node)
+    assert info["file_size"] == index.sizes[node]
+    assert info["last_write_time"] == filetime(index.dates[node])
+    assert info["file_attributes"] == FILE_ATTRIBUTE_ARCHIVE | FILE_ATTRIBUTE_READONLY
+    folder = namespace.file_info(namespace.resolve("\\d"))
+    assert folder["file_attributes"] == FILE_ATTRIBUTE_DIRECTORY | FILE_ATTRIBUTE_READONLY
+    assert folder["file_size"] == 0
+
+
+def test_open_close_refcount():
+    index = index_of("C:/", "C:/a.txt", "C:/b.txt")
+    namespace = IndexNamespace(index)
+    node = namespace.resolve("\\a.txt")
+    first = namespace.open(node)
+    second = namespace.open(node)
+    assert first is second and first.handles == 2
+    assert first.path == "C:/a.txt" and first.file_size == index.sizes[node] and not first.is_directory
+    other = namespace.open(namespace.resolve("\\b.txt"))
+    assert namespace.open_handles() == 3
+    namespace.close(first)
+    assert namespace.open_handles() == 2
+    namespace.close(second)
+    namespace.close(other)
+    assert namespace.open_handles() == 0
+    assert namespace.open(node) is not first  # released on the last close
+
+
+def test_folder_cache_is_bounded():
+    index = index_of(*(f"C:/f{number}/x.txt" for number in range(5)))
+    namespace = IndexNamespace(index, max_folders=2)
+    for number in range(5):
+        assert namespace.resolve(f"\\f{number}\\x.txt") is not None
+    assert len(namespace._folders) == 2
+
+
+def test_read_directory_pages_through_a_big_folder():
+    paths = [f"C:/big/file_{number:04}.txt" for number in reversed(range(1000))]
+    namespace = IndexNamespace(index_of("C:/", "C:/big/", *paths))
+    folder = namespace.resolve("\\big")
+    # WinFsp asks again from the last name it got until nothing is left
+    seen = []
+    marker = ".."
+    while True:
+        page = names(namespace.read_directory(folder, marker))[:64]
+        if not page:
+            break
+        seen += page
+        marker = page[-1]
+    assert seen == sorted(path.split("/")[-1] for path in paths)
+    assert names(namespace.read_directory(folder, "a")) == seen  # sorts before every name
+    assert names(namespace.read_directory(folder, "file_0499.txx")) == seen[500:]
+    assert names(namespace.read_directory(folder, "z")) == []
+    assert namespace.folder(folder) is namespace.folder(folder)  # sorted once, then looked up
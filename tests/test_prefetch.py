@@ -0,0 +1,49 @@
+import threading
+import time
+
+import zpaqtreeview as ztv
+from conftest import write_archive
+from zpaq_cache import BlockCache, ListingCache
+from zpaq_namespace import IndexNamespace
+from zpaq_prefetch import Prefetcher
+
+PHOTOS = [f"C:/photos/{n}.jpg" for n in range(4)]
+
+
+def test_reads_wait_only_for_their_own_file(tmp_path, fake_zpaqfranz, config, monkeypatch):
+    records = [(1, "C:/", 0, "2023-01-01 00:00:00"), (1, "C:/photos/", 0, "2023-01-01 00:00:00")]
+    records += [(1, path, 3000, "2023-01-01 12:00:00") for path in PHOTOS]
+    archive = write_archive(str(tmp_path / "a.zpaq"), 1, records)
+    namespace = IndexNamespace(ztv.load_tree(config, archive, ListingCache(str(tmp_path / "listings")))[0])
+    cache = BlockCache(str(tmp_path / "blocks"), 10**7)
+    prefetcher = Prefetcher(config, archive, cache, str(tmp_path / "prefetch"), batch_size=6000)
+    started = threading.Event()
+    release = threading.Event()
+    load_file = Prefetcher._load_file
+
+    def held_load_file(self, filename, path, size, dates):
+        if path == PHOTOS[1]:
+            started.set()
+            assert release.wait(10)
+        load_file(self, filename, path, size, dates)
+
+    monkeypatch.setattr(Prefetcher, "_load_file", held_load_file)
+    prefetcher.request(namespace, namespace.resolve("\\photos"))
+    try:
+        assert started.wait(10)
+        # the first photo is in, the second is held and the second batch has not started
+        prefetcher.wait(PHOTOS[0])
+        assert (PHOTOS[0], 0) in cache and PHOTOS[1] in prefetcher._pending
+        prefetcher.wait(PHOTOS[2])
+        assert (PHOTOS[2], 0) not in cache
+        release.set()
+        prefetcher.wait(PHOTOS[1])
+        assert (PHOTOS[1], 0) in cache
+        deadline = time.monotonic() + 10
+        while (PHOTOS[3], 0) not in cache and time.monotonic() < deadline:
+            prefetcher.wait(PHOTOS[3])
+            time.sleep(0.01)
+        assert all((path, 0) in cache for path in PHOTOS)
+    finally:
+        release.set()
+        prefetcher.close()
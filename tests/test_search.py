@@ -0,0 +1,81 @@
+import os
+
+import zpaqtreeview as ztv
+from zpaq_cache import ListingCache
+from zpaq_index import ArchiveIndex
+from zpaq_search import SearchIndex, load_search_index, EXTENSION
+
+from conftest import write_archive
+
+
+def paths(index, search, query):
+    return sorted(index.full_path(node) for node in search.search(query))
+
+
+def index_of(paths_and_sizes):
+    index = ArchiveIndex()
+    for path, size in paths_and_sizes:
+        index.add(path, size, 1672531200, "A")
+    index.aggregate()
+    return index
+
+
+def test_queries():
+    index = index_of([("C:/docs/report.pdf", 1), ("C:/docs/notes.txt", 2), ("C:/src/report.py", 3)])
+    search = SearchIndex(index)
+    assert paths(index, search, "report") == ["C:/docs/report.pdf", "C:/src/report.py"]
+    assert paths(index, search, "*.pdf") == ["C:/docs/report.pdf"]
+    assert paths(index, search, "docs/*.txt") == ["C:/docs/notes.txt"]
+    assert paths(index, search, r"re:report\.p[dy]") == ["C:/docs/report.pdf", "C:/src/report.py"]
+    assert paths(index, search, "missing") == []
+
+
+def test_save_load(tmp_path):
+    index = index_of([("C:/a/b.txt", 1), ("C:/a/c.txt", 2)])
+    filename = str(tmp_path / ("index" + EXTENSION))
+    SearchIndex(index).save(filename, {"path": "x"})
+    loaded = SearchIndex.load(filename, index, {"path": "x"})
+    assert paths(index, loaded, "c.txt") == ["C:/a/c.txt"]
+    assert SearchIndex.load(filename, index, {"path": "y"}) is None
+    assert SearchIndex.load(filename, index) is None
+
+
+def test_snapshot_does_not_use_or_overwrite_cached_search(tmp_path, fake_zpaqfranz, config):
+    archive = write_archive(str(tmp_path / "a.zpaq"), 2, [
+        (1, "C:/", 0, "2023-01-01 00:00:00"),
+        (1, "C:/a/", 0, "2023-01-01 00:00:00"),
+        (1, "C:/a/zeta.txt", 10, "2023-01-01 12:00:00"),
+        (2, "C:/a/alpha.txt", 20, "2023-01-02 12:00:00"),
+    ])
+    cache = ListingCache(str(tmp_path / "cache"))
+
+    # -f zzzz: the cached listing's search index is saved next to it
+    tree, _ = ztv.load_tree(config, archive, cache)
+    assert list(load_search_index(tree, cache, archive).search("zzzz")) == []
+    companion = cache.companion_path(archive, EXTENSION)
+    assert os.path.exists(companion)
+    saved = os.path.getmtime(companion), os.path.getsize(companion)
+
+    # --as-of 1 -f alpha, the snapshot numbers its nodes differently
+    tree, _ = ztv.load_tree(config, archive, cache, all_versions=True)
+    snapshot = tree.history.as_of(1)
+    assert paths(snapshot, load_search_index(snapshot, cache, archive), "alpha") == []
+    assert paths(tree, load_search_index(tree, cache, archive), "alpha") == ["C:/a/alpha.txt"]
+    assert (os.path.getmtime(companion), os.path.getsize(companion)) == saved
+
+    tree, _ = ztv.load_tree(config, archive, cache)
+    assert paths(tree, load_search_index(tree, cache, archive), "alpha") == ["C:/a/alpha.txt"]
+    assert paths(tree, load_search_index(tree, cache, archive), "zeta") == ["C:/a/zeta.txt"]
+
+
+def test_stale_companion_is_rebuilt(tmp_path, fake_zpaqfranz, config):
+    records = [(1, "C:/", 0, "2023-01-01 00:00:00"), (1, "C:/old.txt", 1, "2023-01-01 12:00:00")]
+    archive = write_archive(str(tmp_path / "a.zpaq"), 1, records)
+    cache = ListingCache(str(tmp_path / "cache"))
+    tree, _ = ztv.load_tree(config, archive, cache)
+    load_search_index(tree, cache, archive)
+    # the same number of nodes, but another listing
+    write_archive(archive, 1, [(1, "C:/", 0, "2023-01-01 00:00:00"), (1, "C:/new.txt", 1, "2023-01-01 12:00:00")])
+    os.utime(archive, ns=(0, 0))
+    tree, _ = ztv.load_tree(config, archive, cache)
+    assert paths(tree, load_search_index(tree, cache, archive), "txt") == ["C:/new.txt"]
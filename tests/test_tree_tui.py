@@ -0,0 +1,113 @@
+import asyncio
+
+from textual.app import App
+
+from tree_tui import ArchiveTree
+from zpaq_index import ArchiveIndex
+
+
+def sample_index():
+    index = ArchiveIndex()
+    for folder in range(3):
+        for file in range(4):
+            index.add(f"C:/folder_{folder}/sub/file_{file}.txt", 10 ** folder + file, 1672531200, "A")
+    index.aggregate()
+    return index
+
+
+class TreeApp(App):
+    def __init__(self, tree):
+        super().__init__()
+        self.archive_tree = tree
+
+    def compose(self):
+        yield self.archive_tree
+
+
+def run(tree, steps):
+    async def main():
+        async with TreeApp(tree).run_test() as pilot:
+            await pilot.pause()
+            await steps(tree, pilot)
+    asyncio.run(main())
+
+
+def labels(tx_node):
+    return [str(child.label) for child in tx_node.children]
+
+
+def test_lazy_folders_unload_sort_and_reveal():
+    index = sample_index()
+
+    async def steps(tree, pilot):
+        assert labels(tree.root) == ["folder_0", "folder_1", "folder_2"]
+        folder = tree.root.children[2]
+        folder.expand()
+        await pilot.pause()
+        assert labels(folder) == ["sub"] and tree.loaded_nodes == 4
+
+        tree.reveal(folder.data)
+        await pilot.pause()
+        tree.sort_by_size(True)
+        await pilot.pause()
+        assert [child.data for child in tree.root.children] == [index.find(f"C:/folder_{n}") for n in (2, 1, 0)]
+        folder = tree.root.children[0]
+        assert str(folder.label).endswith("folder_2 (4 files)")
+        # rebuilt in the new order, the open folder is still open and the cursor still on it
+        assert folder.is_expanded and labels(folder)[0].endswith("sub (4 files)")
+        assert tree.cursor_node.data == folder.data
+        tree.sort_by_size(False)
+        assert labels(tree.root) == ["folder_0", "folder_1", "folder_2"]
+
+        tree.unload(tree.root.children[2])
+        folder = tree.root.children[2]
+        assert labels(folder) == [] and tree.loaded_nodes == 3
+        assert sum(1 for _ in tree.loaded()) == 4
+
+        target = index.find("C:/folder_1/sub/file_3.txt")
+        tree.reveal(target)
+        await pilot.pause()
+        assert tree.cursor_node.data == target
+
+    run(ArchiveTree(index), steps)
+
+
+def test_new_children_appear_in_populated_folders():
+    index = ArchiveIndex()
+    index.add("C:/a/one.txt", 1, 1672531200, "A")
+
+    async def steps(tree, pilot):
+        folder = tree.root.children[0]
+        folder.expand()
+        await pilot.pause()
+        with tree.index_lock:
+            index.add("C:/a/two.txt", 2, 1672531200, "A")
+            index.add("C:/b/three.txt", 3, 1672531200, "A")
+        tree.add_new_children()
+        assert labels(tree.root) == ["a", "b"]
+        assert labels(folder) == ["one.txt", "two.txt"]
+
+    run(ArchiveTree(index), steps)
+
+
+def test_least_recently_collapsed_folders_are_unloaded():
+    index = sample_index()
+
+    async def steps(tree, pilot):
+        for folder in tree.root.children:
+            folder.expand()
+            await pilot.pause()
+            folder.children[0].expand()
+            await pilot.pause()
+        assert tree.loaded_nodes == 3 + 3 * (1 + 4)
+        tree.max_loaded_nodes = 13
+        for n in (0, 1):
+            tree.root.children[n].collapse()
+            await pilot.pause()
+        # folder_0 went first, folder_1 still fits and stays loaded while collapsed
+        assert [labels(folder) for folder in tree.root.children] == [[], ["sub"], ["sub"]]
+        assert tree.loaded_nodes == 13
+        assert [folder.is_expanded for folder in tree.root.children] == [False, False, True]
+        assert labels(tree.root.children[2].children[0])[0] == "file_0.txt"
+
+    run(ArchiveTree(index), steps)
@@ -0,0 +1,35 @@
+from zpaq_index import ArchiveIndex
+from zpaq_versions import DELETED, VersionHistory
+
+YEAR_9999 = 253402300799
+YEAR_1900 = -2208988800
+
+
+def test_dates_far_from_the_base_are_kept_exactly():
+    index = ArchiveIndex()
+    node = index.add("C:/a.txt", 1, 1672531200, "A")
+    other = index.add("C:/b.txt", 1, 1672531200, "A")
+    history = VersionHistory(index)
+    history.record(node, 1, 10, 1672531200)
+    history.record(other, 1, 20, YEAR_1900)
+    history.record(node, 2, 11, YEAR_9999)
+    history.record(node, 3, DELETED, 0)
+    history.record(node, 4, 12, 1672531300)
+    history.close()
+
+    assert history.history(node) == [(4, 12, 1672531300), (3, DELETED, YEAR_9999), (2, 11, YEAR_9999),
+                                     (1, 10, 1672531200)]
+    assert history.history(other) == [(1, 20, YEAR_1900)]
+    assert history.as_of(2).dates[history.as_of(2).find("C:/a.txt")] == YEAR_9999
+    first = history.as_of(1)
+    assert [first.dates[first.find(path)] for path in ("C:/a.txt", "C:/b.txt")] == [1672531200, YEAR_1900]
+
+
+def test_small_deltas_stay_in_a_32_bit_column():
+    index = ArchiveIndex()
+    node = index.add("C:/a.txt", 1, 1672531200, "A")
+    history = VersionHistory(index)
+    for version in range(1, 4):
+        history.record(node, version, version, 1672531200 + version * 86400)
+    assert history.date_deltas.typecode == "i"
+    assert [date for _, _, date in history.history(node)] == [1672531200 + v * 86400 for v in (3, 2, 1)]
@@ -5,43 +5,262 @@ Run with:
 
     python code_browser.py PATH
 """
+import argparse
+import re
+import threading
+from collections import OrderedDict
 from sys import argv
 from os import getcwd
+from time import perf_counter
+from textual import work
 from textual.app import App, ComposeResult
 from textual.containers import Container
+from textual.message import Message
 from textual.reactive import var
-from textual.widgets import Tree, Footer, Header, Input
-from tqdm import tqdm
+from textual.widgets import Tree, Footer, Header, Input, OptionList
+from textual.widgets.option_list import Option
+from textual.worker import get_current_worker, WorkerCancelled
 from tkinter import filedialog
 import zpaqtreeview as ztv
+from zpaq_index import ArchiveIndex, NO_NODE, format_date, format_size
+from zpaq_cache import add_cache_arguments, cache_from_args
+from zpaq_jobs import ExtractionQueue, DEFAULT_JOBS, FAILED, RUNNING
+from zpaq_search import load_search_index
+from zpaq_versions import DELETED
+from zpaq_metrics import metrics, add_metrics_arguments, metrics_from_args
 
 
-def convert_filetree(config=None, file_path=None):
-    tl_tree = ztv.main(config, file_path)
-    tx_tree = Tree(label=tl_tree.root, data=tl_tree.get_node(tl_tree.root).data)
-    tl_node_stack = [tl_tree.get_node(tl_tree.root)]
-    tx_stack = [tx_tree.root]
-
-    print("Converting file tree to textual...")
-    bar = tqdm(total=tl_tree.size(), unit="nodes", colour="green", leave=False)
-    while len(tl_node_stack) > 0:
-        tl_node = tl_node_stack.pop()
-        tx_node = tx_stack.pop()
-
-        children_sorted = tl_tree.children(tl_node.tag)
-        children_sorted.sort(key=lambda x: (x.is_leaf(), x.data.name.lower()))
-        for tl_child_node in children_sorted:
-            if tl_child_node.data.is_directory():  # not tl_child_node.is_leaf():  # If directory, true
-                tl_node_stack.append(tl_child_node)
-                tx_stack.append(
-                    tx_node.add(tl_child_node.data.name, data=tl_child_node.data))
+MAX_LOADED_NODES = 200_000
+MAX_SEARCH_RESULTS = 10_000
+
+
+class ArchiveTree(Tree):
+    """Textual tree over an ArchiveIndex that only creates a folder's nodes when it is first expanded.
+
+    Node data is the index node id. Once more than `max_loaded_nodes` nodes exist, the contents of the
+    least recently collapsed folders are dropped again and rebuilt if they are reopened.
+
+    The index may still be growing in a worker thread, which holds `index_lock` while it adds entries.
+    add_new_children() then brings the already populated folders up to date.
+
+    With `by_size` folders are sorted largest first and labelled with the size and file count of
+    everything below them, read straight from the index's aggregates.
+    """
+
+    def __init__(self, index, max_loaded_nodes=MAX_LOADED_NODES, **kwargs):
+        super().__init__(label=index.name(index.root) or "/", data=index.root, **kwargs)
+        self.index = index
+        self.index_lock = threading.RLock()
+        self.max_loaded_nodes = max_loaded_nodes
+        self.loaded_nodes = 0
+        self._populated = {}  # textual node id -> number of children created for it
+        self._newest = {}  # textual node id -> newest index child it was populated with
+        self._collapsed = OrderedDict()  # populated but collapsed nodes, least recently collapsed first
+        self.marked = set()  # index node ids selected for extraction
+        self.by_size = False
+        self.populate(self.root)
+
+    def _add_entries(self, tx_node, children):
+        index = self.index
+        for child in children:
+            if index.is_directory(child):
+                tx_node.add(self.label_for(child), data=child)
             else:
-                tx_node.add_leaf(tl_child_node.data.name, data=tl_child_node.data)
+                tx_node.add_leaf(self.label_for(child), data=child)
+        self._populated[tx_node.id] = self._populated.get(tx_node.id, 0) + len(children)
+        self.loaded_nodes += len(children)
+
+    def label_for(self, node):
+        index = self.index
+        name = index.name(node) or "/"
+        if self.by_size and index.aggregated:
+            name = f"{format_size(index.total_sizes[node]):>10}  {name}"
+            if index.is_directory(node):
+                name += f" ({index.file_counts[node]:,} files)"
+        return "* " + name if node in self.marked else name
+
+    def sort_key(self, node):
+        index = self.index
+        if self.by_size and index.aggregated:
+            return -index.total_sizes[node]
+        return index.is_leaf(node), index.name(node).lower()
+
+    def sort_by_size(self, by_size):
+        """Re-sorts and relabels every loaded folder, largest first or by name."""
+        self.by_size = by_size
+        self.rebuild()
+
+    def toggle_mark(self, tx_node):
+        """Marks or unmarks a node for batch extraction."""
+        if tx_node.data in self.marked:
+            self.marked.remove(tx_node.data)
+        else:
+            self.marked.add(tx_node.data)
+        tx_node.set_label(self.label_for(tx_node.data))
+
+    def clear_marks(self):
+        marked = self.marked
+        self.marked = set()
+        for tx_node in self.loaded():
+            if tx_node.data in marked:
+                tx_node.set_label(self.label_for(tx_node.data))
+
+    def loaded(self):
+        """Yields every node the tree has created, the root first."""
+        stack = [self.root]
+        while stack:
+            tx_node = stack.pop()
+            yield tx_node
+            stack.extend(tx_node.children)
+
+    @metrics.timed("tree_build")
+    def populate(self, tx_node):
+        index = self.index
+        with self.index_lock:
+            children_sorted = index.children(tx_node.data)
+            children_sorted.sort(key=self.sort_key)
+            self._add_entries(tx_node, children_sorted)
+            self._newest[tx_node.id] = index.first_child[tx_node.data]
+
+    def add_new_children(self):
+        """Adds the entries the index gained since each populated folder was filled.
+
+        Children are chained newest first, so a folder's new entries are the ones in front of the
+        newest child it already shows. They are appended in listing order rather than sorted in.
+        """
+        index = self.index
+        with self.index_lock:
+            if self.root.data != index.root:
+                # the first top level entry arrived, or a second one replaced it with the virtual root
+                self.unload(self.root)
+                self.root.data = index.root
+                self.root.set_label(self.label_for(index.root))
+                self.populate(self.root)
+                return
+            for node_id, newest in list(self._newest.items()):
+                tx_node = self.get_node_by_id(node_id)
+                children = []
+                child = index.first_child[tx_node.data]
+                while child != newest and child != NO_NODE:
+                    children.append(child)
+                    child = index.next_sibling[child]
+                if children:
+                    children.reverse()
+                    self._add_entries(tx_node, children)
+                    self._newest[node_id] = index.first_child[tx_node.data]
+
+    def set_index(self, index):
+        """Shows another index, e.g. a cached listing that finished loading."""
+        self._clear_loaded()
+        self.index = index
+        self.marked = set()
+        self.root.data = index.root
+        self.root.set_label(self.label_for(index.root))
+        self.populate(self.root)
+
+    def unload(self, tx_node):
+        """Drops every node below tx_node, it is populated again on the next expand.
+
+        Other folders are rebuilt too, so nodes taken from the tree before are stale afterwards.
+        """
+        if tx_node.is_root:
+            self._clear_loaded()
+        else:
+            self.rebuild(drop={tx_node.data})
+
+    def _loaded_below(self, tx_node):
+        """Number of nodes populate() created below tx_node."""
+        count = 0
+        stack = [tx_node]
+        while stack:
+            node = stack.pop()
+            count += self._populated.get(node.id, 0)
+            stack.extend(child for child in node.children if child.id in self._populated)
+        return count
+
+    def _clear_loaded(self):
+        self.clear()
+        self._populated.clear()
+        self._newest.clear()
+        self._collapsed.clear()
+        self.loaded_nodes = 0
+
+    def rebuild(self, drop=()):
+        """Recreates the loaded folders in the current sort order, leaving out those in `drop` (index nodes).
+
+        Textual has no public way to reorder a node's children, and TreeNode.remove_children() finds
+        every child with list.index(), quadratic for a big folder. Clearing the tree and adding back
+        what was loaded is linear in the loaded nodes instead. Open folders stay open, collapsed ones
+        stay loaded and the cursor stays on the entry it was on.
+        """
+        with self.index_lock:
+            loaded = {tx_node.data: tx_node.is_expanded for tx_node in self.loaded()
+                      if tx_node.id in self._populated and tx_node.data not in drop}
+            collapsed = [tx_node.data for tx_node in self._collapsed.values() if tx_node.data in loaded]
+            cursor = self.cursor_node.data if self.cursor_node is not None else None
+            self._clear_loaded()
+            self.root.set_label(self.label_for(self.root.data))
+            self.populate(self.root)
+            nodes = {}
+            stack = [self.root]
+            while stack:
+                for child in stack.pop().children:
+                    nodes[child.data] = child
+                    if child.data in loaded:
+                        self.populate(child)
+                        if loaded[child.data]:
+                            child.expand()
+                        stack.append(child)
+            for node in collapsed:
+                self._collapsed[nodes[node].id] = nodes[node]
+        if cursor in nodes:
+            self.call_after_refresh(self.move_to, nodes[cursor])
+
+    def reveal(self, node):
+        """Expands the folders above an index node and moves the cursor onto it."""
+        ancestors = []
+        while node != self.root.data and node > 0:
+            ancestors.append(node)
+            node = self.index.parents[node]
+        tx_node = self.root
+        for node in reversed(ancestors):
+            if tx_node.id not in self._populated:
+                self.populate(tx_node)
+            tx_node.expand()
+            tx_node = next(child for child in tx_node.children if child.data == node)
+        # the node only has a line number once the expanded folders are laid out
+        self.call_after_refresh(self.move_to, tx_node)
+        self.focus()
 
-            bar.update()
+    def move_to(self, tx_node):
+        self.select_node(tx_node)
+        self.scroll_to_node(tx_node)
 
-    bar.close()
-    return tx_tree
+    def on_tree_node_expanded(self, event: Tree.NodeExpanded) -> None:
+        node = event.node
+        self._collapsed.pop(node.id, None)
+        if node.id not in self._populated:
+            self.populate(node)
+
+    def on_tree_node_collapsed(self, event: Tree.NodeCollapsed) -> None:
+        node = event.node
+        if node.id in self._populated and not node.is_root:
+            self._collapsed[node.id] = node
+            self._collapsed.move_to_end(node.id)
+        drop = set()
+        loaded_nodes = self.loaded_nodes
+        for oldest in self._collapsed.values():
+            if loaded_nodes <= self.max_loaded_nodes:
+                break
+            drop.add(oldest.data)
+            loaded_nodes -= self._loaded_below(oldest)
+        if drop:
+            self.rebuild(drop)
+
+
+def convert_filetree(config=None, file_path=None, cache=None):
+    """Blocking alternative to TreeTUI.load_listing, returns the tree once the whole listing is parsed."""
+    return ArchiveTree(ztv.main(config, file_path, cache))
 
 
 class TreeTUI(App):
@@ -49,14 +268,24 @@ class TreeTUI(App):
 
     CSS_PATH = "tree_tui.tcss"
     BINDINGS = [
-        ("f", "toggle_files", "Toggle Files"),
+        ("f", "find", "Find"),
+        ("t", "toggle_files", "Toggle Files"),
+        ("escape", "close_find", "Close Find"),
+        ("m", "toggle_mark", "Mark"),
         ("x", "extract_menu", "Extract"),
+        ("c", "cancel_extraction", "Cancel Extract"),
+        ("l", "toggle_largest", "Largest First"),
+        ("v", "travel", "Version"),
+        ("h", "history", "History"),
         ("q", "quit", "Quit"),
-    ]  # TODO: f = find, x = extract, s = save, q = quit, i = file info, maybe something about file selection?
+    ]  # TODO: s = save, i = file info
 
     show_tree = var(True)
     show_file_input = var(False)
     current_node = var(None)
+    search_index = None
+    input_mode = "find"  # what the input box is asking for, "find" or "version"
+    history_path = None  # path whose versions the results list shows
 
     def watch_show_tree(self, show_tree: bool) -> None:
         """Called when show_tree is modified."""
@@ -76,16 +305,212 @@ class TreeTUI(App):
         yield Input(id="file-input", classes="hidden")
         with Container():
             yield tree
+        yield OptionList(id="search-results", classes="hidden")
         yield Footer()
 
     def on_mount(self) -> None:
         self.query_one(Tree).focus()
+        self.load_listing()
+
+    @work(thread=True, exclusive=True)
+    def load_listing(self) -> None:
+        """Parses the listing in the background, the tree shows the entries as each block comes in."""
+        worker = get_current_worker()
+        started = perf_counter()
+        lines = 0
+
+        def progress(count):
+            nonlocal lines
+            if worker.is_cancelled:
+                raise WorkerCancelled("app closed while loading")  # closes the listing and stops zpaqfranz
+            lines += count
+            rate = lines / max(perf_counter() - started, 1e-6)
+            self.call_from_thread(self.show_progress, f"Loading: {lines:,} lines, {rate:,.0f} lines/s")
+
+        self.call_from_thread(self.show_progress, "Loading...")
+        try:
+            index, _ = ztv.load_tree(config, input_file, cache, tree.index, progress, tree.index_lock, all_versions)
+        except WorkerCancelled:
+            return
+        except Exception as e:
+            self.call_from_thread(self.show_progress, f"Loading failed: {e}")
+            return
+        self.call_from_thread(self.finish_loading, index, perf_counter() - started)
 
+    def show_progress(self, text) -> None:
+        tree.add_new_children()
+        self.sub_title = text
+
+    def finish_loading(self, index, elapsed) -> None:
+        if index is not tree.index:
+            tree.set_index(index)
+        else:
+            tree.add_new_children()
+        if tree.by_size:  # sizes only exist once the whole listing is in
+            tree.sort_by_size(True)
+        self.sub_title = f"{len(index) - 1:,} entries loaded in {elapsed:.1f} s"
+
+
+    def action_toggle_mark(self) -> None:
+        if tree.cursor_node is not None:  # current_node may be from before the tree was rebuilt
+            tree.toggle_mark(tree.cursor_node)
 
     def action_extract_menu(self) -> None:
+        """Queues the marked nodes for extraction, or the highlighted node when nothing is marked."""
+        if not tree.marked and self.current_node is None:
+            return
         out_directory = filedialog.askdirectory(initialdir=getcwd(), mustexist=True, title="Select output directory")
-        ztv.extract_file(config, input_file, self.current_node.data.fullPath, out_directory, self.current_node.data.is_directory())
-        # TODO: Toast notification of extraction result
+        if not out_directory:
+            return
+        index = tree.index
+        nodes = tree.marked or {self.current_node.data}
+        jobs = ztv.extraction_jobs(config, input_file, [ztv.selection_entry(index, node) for node in nodes],
+                                   out_directory, extractions.max_jobs, until=index.until)
+        tree.clear_marks()
+        extractions.submit(jobs)
+        self.notify(f"Queued {len(nodes)} entries as {len(jobs)} extraction jobs")
+
+    def action_cancel_extraction(self) -> None:
+        extractions.cancel()
+
+    class JobUpdated(Message):
+        def __init__(self, job) -> None:
+            super().__init__()
+            self.job = job
+
+    def on_tree_tui_job_updated(self, message: JobUpdated) -> None:
+        job = message.job
+        extracted, total, finished, count = extractions.progress()
+        if job.status == FAILED:
+            self.notify(f"Extraction failed: {job.output.strip()[-200:]}", severity="error")
+        if finished < count:
+            self.sub_title = f"Extracting: {finished}/{count} jobs, {extracted / max(total, 1):.0%} of {total / 1024**2:,.1f} MiB"
+        elif job.status != RUNNING:
+            self.sub_title = f"Extracted {extracted / 1024**2:,.1f} of {total / 1024**2:,.1f} MiB in {count} jobs"
+            self.notify(self.sub_title)
+
+    def on_unmount(self) -> None:
+        extractions.cancel()
+
+    def action_find(self) -> None:
+        search_input = self.query_one(Input)
+        search_input.placeholder = "Find: text, glob (*.pdf, docs/*.txt) or re:regex"
+        search_input.remove_class("hidden")
+        self.input_mode = "find"
+        self.show_file_input = True
+
+    def action_travel(self) -> None:
+        history = tree.index.history
+        if history is None:
+            self.notify("Start with --all-versions to browse older versions", severity="warning")
+            return
+        search_input = self.query_one(Input)
+        search_input.placeholder = (f"Showing {history.describe(tree.index.until)}, go to version number or "
+                                    f"YYYY-MM-DD (latest is {history.latest})")
+        search_input.value = ""
+        search_input.remove_class("hidden")
+        self.input_mode = "version"
+        self.show_file_input = True
+
+    def action_history(self) -> None:
+        """Lists the versions of the highlighted entry, selecting one shows the archive as of that version."""
+        history = tree.index.history
+        if history is None:
+            self.notify("Start with --all-versions to see the versions of a file", severity="warning")
+            return
+        if self.current_node is None:
+            return
+        self.history_path = tree.index.full_path(self.current_node.data)
+        node = history.index.find(self.history_path)
+        results = self.query_one(OptionList)
+        results.clear_options()
+        for version, size, date in history.history(node) if node is not None else []:
+            change = "deleted" if size == DELETED else format_size(size)
+            results.add_option(Option(f"{history.describe(version)}  {format_date(date)}  {change}", id=f"v{version}"))
+        results.remove_class("hidden")
+        results.focus()
+        self.sub_title = f"Versions of {self.history_path}"
+
+    def action_close_find(self) -> None:
+        self.query_one(Input).add_class("hidden")
+        self.query_one(OptionList).add_class("hidden")
+        self.show_file_input = False
+        tree.focus()
+
+    def on_input_submitted(self, event: Input.Submitted) -> None:
+        if self.input_mode == "version":
+            version = tree.index.history.resolve(event.value)
+            if version is None:
+                self.notify(f"{event.value!r} is not a version or date", severity="error")
+                return
+            self.action_close_find()
+            self.travel(version, tree.index.full_path(self.current_node.data) if self.current_node else None)
+            return
+        results = self.query_one(OptionList)
+        results.clear_options()
+        results.remove_class("hidden")
+        self.find(event.value)
+
+    @work(thread=True, exclusive=True, group="find")
+    def find(self, query) -> None:
+        """Searches in the background and adds the matches to the results list as they are found."""
+        worker = get_current_worker()
+        started = perf_counter()
+        with tree.index_lock:
+            index = tree.index
+            search_index = self.search_index
+            if search_index is None or search_index.index is not index or search_index.stale:
+                self.call_from_thread(setattr, self, "sub_title", "Indexing paths for search...")
+                search_index = self.search_index = load_search_index(index, cache, input_file)
+        batch = []
+        found = 0
+        last_flush = perf_counter()
+        try:
+            for node in search_index.search(query, limit=MAX_SEARCH_RESULTS):
+                if worker.is_cancelled:
+                    return
+                batch.append(Option(index.full_path(node), id=str(node)))
+                found += 1
+                if len(batch) >= 1000 or perf_counter() - last_flush > 0.1:
+                    self.call_from_thread(self.query_one(OptionList).add_options, batch)
+                    batch = []
+                    last_flush = perf_counter()
+        except re.error as e:
+            self.call_from_thread(setattr, self, "sub_title", f"Invalid regex: {e}")
+            return
+        if batch:
+            self.call_from_thread(self.query_one(OptionList).add_options, batch)
+        more = "+" if found == MAX_SEARCH_RESULTS else ""
+        self.call_from_thread(setattr, self, "sub_title",
+                              f"{found:,}{more} matches for {query!r} in {(perf_counter() - started) * 1000:,.0f} ms")
+
+    def on_option_list_option_selected(self, event: OptionList.OptionSelected) -> None:
+        if event.option.id.startswith("v"):
+            self.travel(int(event.option.id[1:]), self.history_path)
+            return
+        tree.reveal(int(event.option.id))
+
+    @work(thread=True, exclusive=True, group="travel")
+    def travel(self, version, path=None) -> None:
+        """Builds the index of an earlier version from the history, without listing the archive again."""
+        history = tree.index.history
+        self.call_from_thread(setattr, self, "sub_title", f"Going to {history.describe(version)}...")
+        started = perf_counter()
+        snapshot = history.as_of(version)
+        self.call_from_thread(self.show_version, snapshot, path, perf_counter() - started)
+
+    def show_version(self, snapshot, path, elapsed) -> None:
+        tree.set_index(snapshot)
+        node = snapshot.find(path) if path else None
+        if node is not None:
+            tree.reveal(node)
+        self.sub_title = f"Showing {snapshot.history.describe(snapshot.until)}, {len(snapshot) - 1:,} entries in {elapsed:.1f} s"
+
+    def action_toggle_largest(self) -> None:
+        """Switches between sorting by name and an ncdu style largest first view with folder sizes."""
+        tree.sort_by_size(not tree.by_size)
+        if tree.by_size and not tree.index.aggregated:
+            self.notify("Folder sizes are shown once the listing has finished loading")
 
     def action_toggle_files(self) -> None:
         """Called in response to key binding."""
@@ -96,15 +521,25 @@ class TreeTUI(App):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", nargs="?", default=None, help="zpaq archive or saved .txt listing")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help=f"zpaqfranz extractions to run at once (default: extract_jobs in config.ini or {DEFAULT_JOBS})")
+    parser.add_argument("--all-versions", action="store_true",
+                        help="list every version (slower, not cached) so older versions can be browsed with 'v'")
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics_from_args(args)
+
     config = ztv.load_create_config()
-    if len(argv) == 1:
-        input_file = None
-        while input_file is None:
-            input_file = filedialog.askopenfilename(initialdir=getcwd(), title="Select a zpaq file",)
-    elif len(argv) == 2:
-        input_file = argv[1]
-    else:
-        print("Too many arguments.", file=stderr)
-        exit(1)
-    tree = convert_filetree(config, input_file)
-    TreeTUI().run()
+    input_file = args.file
+    all_versions = args.all_versions
+    while not input_file:
+        input_file = filedialog.askopenfilename(initialdir=getcwd(), title="Select a zpaq file",)
+    cache = cache_from_args(args, config)
+    tree = ArchiveTree(ArchiveIndex())  # filled in by TreeTUI.load_listing once the app is up
+    app = TreeTUI()
+    extractions = ExtractionQueue(args.jobs or config.getint('config', 'extract_jobs', fallback=DEFAULT_JOBS),
+                                  on_update=lambda job: app.post_message(TreeTUI.JobUpdated(job)))
+    app.run()
@@ -0,0 +1,212 @@
+"""asyncio interface for listing, reading and extracting, for services that serve many archives at once.
+
+Every call runs zpaqfranz with asyncio.create_subprocess_exec, so one event loop drives any number of
+them without a thread each. At most `max_processes` zpaqfranz run at the same time, and cancelling a
+call (or closing a read_file() iterator early) kills its zpaqfranz.
+
+    zpaq = AsyncZpaq(config)
+    index = await zpaq.list_archive("backup.zpaq")
+    async for chunk in zpaq.read_file("backup.zpaq", "C:/dir/file.txt"):
+        ...
+"""
+import asyncio
+from collections import deque
+from time import perf_counter
+
+import zpaqtreeview as ztv
+from zpaq_driver import (ZpaqDriver, ZpaqFailed, ZpaqNotFound, ZpaqTimeout, STREAM_BUFFER, STDERR_TAIL,
+                         parse_progress)
+from zpaq_index import ArchiveIndex
+from zpaq_listing import ListingParser, CHUNK_SIZE, split_lines
+from zpaq_versions import VersionHistory
+
+DEFAULT_MAX_PROCESSES = 8
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class AsyncRun:
+    """One zpaqfranz run, an async context manager that yields the asyncio Process.
+
+    Leaving the block normally waits for zpaqfranz and raises ZpaqFailed or ZpaqTimeout if it did not
+    succeed. Leaving it with an exception, cancellation included, kills zpaqfranz.
+    """
+
+    def __init__(self, zpaq, command, progress=None):
+        self.zpaq = zpaq
+        self.command = command
+        self.progress = progress
+        self.process = None
+        self.timed_out = False
+        self._stderr = deque(maxlen=64)
+        self._stderr_task = None
+        self._timer = None
+
+    async def __aenter__(self):
+        await self.zpaq.slots.acquire()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=STREAM_BUFFER)
+        except OSError as e:
+            self.zpaq.slots.release()
+            raise ZpaqNotFound(f"Could not start {self.command[0]}: {e}", self.command) from e
+        self._stderr_task = asyncio.ensure_future(self._drain_stderr())
+        if self.zpaq.driver.timeout is not None:
+            self._timer = asyncio.get_running_loop().call_later(self.zpaq.driver.timeout, self._time_out)
+        return self.process
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is not None and self.process.returncode is None:
+                self.process.kill()
+            await self.process.wait()
+            await self._stderr_task
+        finally:
+            if self._timer is not None:
+                self._timer.cancel()
+            self.zpaq.slots.release()
+        if exc_type is None:
+            self.check()
+
+    async def _drain_stderr(self):
+        while True:
+            chunk = await self.process.stderr.read(65536)
+            if not chunk:
+                return
+            self._stderr.append(chunk)
+            if self.progress is not None:
+                self.report_progress(chunk)
+
+    def report_progress(self, chunk):
+        percent = parse_progress(chunk)
+        if percent is not None:
+            self.progress(percent)
+
+    def _time_out(self):
+        if self.process.returncode is None:
+            self.timed_out = True
+            self.process.kill()
+
+    @property
+    def stderr(self):
+        return b"".join(self._stderr)[-STDERR_TAIL:]
+
+    def check(self):
+        if self.timed_out:
+            raise ZpaqTimeout("zpaqfranz timed out", self.command, self.process.returncode, self.stderr)
+        if self.process.returncode:
+            raise ZpaqFailed(f"zpaqfranz exited with code {self.process.returncode}", self.command,
+                             self.process.returncode, self.stderr)
+
+
+class AsyncZpaq:
+    """Async counterparts of list_archive/load_tree, read_file and extract_files in zpaqtreeview.py."""
+
+    def __init__(self, config, max_processes=DEFAULT_MAX_PROCESSES):
+        self.config = config
+        self.driver = ZpaqDriver.from_config(config)
+        self.slots = asyncio.Semaphore(max_processes)
+
+    def run(self, *args, progress=None):
+        """AsyncRun of zpaqfranz with these arguments."""
+        return AsyncRun(self, self.driver.command(*args), progress)
+
+    async def list_archive(self, zpaq_file, since=None, all_versions=False, index=None, progress=None):
+        """Lists the archive into `index` (a new ArchiveIndex by default) and returns it.
+
+        Like load_tree(), with `all_versions` the latest version is returned with its history attached.
+        `progress` is called with the number of lines parsed after each block. Blocks are parsed in a
+        worker thread, one at a time and while the next one is read, so the event loop only does the reads.
+        """
+        index = index if index is not None else ArchiveIndex()
+        history = VersionHistory(index) if all_versions else None
+        parser = ListingParser(index, history)
+        pending = None
+        parsing = None  # the previous block's parse, shielded as cancelling it would not stop its thread
+        try:
+            async with self.run(*ztv.listing_args(zpaq_file, since, all_versions)) as process:
+                while True:
+                    chunk = await process.stdout.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    lines, pending = split_lines(chunk, pending)
+                    if lines is None:
+                        continue
+                    if parsing is not None:
+                        await asyncio.shield(parsing)
+                    parsing = asyncio.ensure_future(self._parse(parser, lines, progress))
+                if parsing is not None:
+                    await asyncio.shield(parsing)
+        finally:
+            if parsing is not None and not parsing.done():
+                # let it finish before the caller sees the index again
+                await asyncio.wait([parsing])
+        if pending:
+            parser.feed([pending.decode("utf-8", errors="ignore")])
+        return await asyncio.to_thread(self._finish, parser, index, history)
+
+    @staticmethod
+    async def _parse(parser, lines, progress):
+        await asyncio.to_thread(parser.feed, lines)
+        if progress is not None:
+            progress(len(lines))
+
+    @staticmethod
+    def _finish(parser, index, history):
+        parser.close()
+        index.drop_lookup()
+        if not index.aggregated:
+            index.aggregate()
+        return history.as_of() if history is not None else index
+
+    async def read_file(self, zpaq_file, path, chunk_size=READ_CHUNK_SIZE, until=None):
+        """Yields the contents of one archived file in chunks of up to `chunk_size` bytes as zpaqfranz extracts it.
+
+        To stop early, close the iterator (e.g. with contextlib.aclosing) so zpaqfranz is killed right away.
+        """
+        args = ["x", zpaq_file, path, "-longpath", "-stdout"] + (["-until", until] if until is not None else [])
+        async with self.run(*args) as process:
+            while True:
+                chunk = await process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def extract(self, zpaq_file, selection, extract_to_path, until=None, progress=None):
+        """Extracts (path, is_directory, size) entries like extract_files(), running its batches concurrently.
+
+        Returns one (entries, bytes, seconds) tuple per zpaqfranz run. If one run fails the others are
+        cancelled and its ZpaqError is raised. `progress(percent)` gets the share of bytes done overall.
+        """
+        batches = list(ztv.extraction_batches(self.config, zpaq_file, selection, extract_to_path, until))
+        total = max(1, sum(entry[2] for _, entries in batches for entry in entries))
+        done = [0.0] * len(batches)
+
+        def batch_progress(number, size):
+            def report(percent):
+                done[number] = size * percent / 100
+                if progress is not None:
+                    progress(min(100.0, sum(done) * 100 / total))
+            return report
+
+        async def run_batch(number, command, entries):
+            size = sum(entry[2] for entry in entries)
+            started = perf_counter()
+            run = AsyncRun(self, command, batch_progress(number, size))
+            async with run as process:
+                # only read for progress, and so zpaqfranz never blocks on a full pipe
+                while True:
+                    chunk = await process.stdout.read(STREAM_BUFFER)
+                    if not chunk:
+                        break
+                    run.report_progress(chunk)
+            return len(entries), size, perf_counter() - started
+
+        tasks = [asyncio.ensure_future(run_batch(number, command, entries))
+                 for number, (command, entries) in enumerate(batches)]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
@@ -0,0 +1,865 @@
+"""On-disk caches of parsed archive listings and of extracted files, so neither needs zpaqfranz twice."""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict
+from platform import system
+from stat import S_ISREG
+from time import time
+
+from zpaq_driver import ZpaqFailed
+from zpaq_index import ArchiveIndex
+from zpaq_metrics import metrics
+
+MAGIC = b"ZTVIDX1\n"
+EXTENSION = ".ztvidx"
+CONTENT_EXTENSION = ".ztvfile"
+STALE_TEMP = 3600  # seconds after which a leftover temporary file is from a crash, not a write in progress
+TAIL_BYTES = 64 * 1024
+DEFAULT_MAX_SIZE = 2 * 1024**3  # 2 GiB
+BLOCK_SIZE = 1024 * 1024
+MAX_STREAMS = 4
+
+HIT = "hit"
+APPENDED = "appended"
+MISS = "miss"
+
+
+def default_cache_dir(name="zpaqtreeview"):
+    """Per-user cache directory `name`, each cache has its own so evicting one never touches another's files."""
+    if system() == "Windows":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, name)
+
+
+def tail_hash(path, size, tail=TAIL_BYTES):
+    """Hash of the `tail` bytes before offset `size`, zpaq only ever appends so this pins the content."""
+    with open(path, "rb") as f:
+        f.seek(max(0, size - tail))
+        data = f.read(min(size, tail))
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def archive_identity(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return {"path": path, "size": stat.st_size, "mtime": stat.st_mtime_ns, "tail": tail_hash(path, stat.st_size)}
+
+
+def save_index(index: ArchiveIndex, filename, header=None, extra=None):
+    """Writes the index columns to `filename` as raw, 8 byte aligned arrays behind a JSON header.
+
+    `extra` maps names to more arrays to store alongside, load_index() returns them in header["arrays"].
+    """
+    header = dict(header or {})
+    names = "\0".join(index.names).encode("utf-8", errors="surrogatepass")
+    saved = ArchiveIndex.COLUMNS + (ArchiveIndex.AGGREGATE_COLUMNS if index.aggregated else ())
+    extra = extra or {}
+    arrays = [getattr(index, column) for column in saved] + list(extra.values())
+    columns = []
+    offset = 0
+    for column, data in zip(saved + tuple(extra), arrays):
+        columns.append({"name": column, "typecode": data.typecode, "offset": offset, "count": len(data),
+                        "extra": column in extra})
+        offset += (len(data) * data.itemsize + 7) // 8 * 8
+    header.update({
+        "byteorder": sys.byteorder,
+        "columns": columns,
+        "names": {"offset": offset, "length": len(names)},
+        "interned": index.interned,
+        "versions": index.versions,
+        "attributes": index.attributes,
+    })
+    encoded = json.dumps(header).encode("utf-8")
+    encoded += b" " * (-(len(MAGIC) + 8 + len(encoded)) % 8)
+
+    temp = filename + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(MAGIC)
+        f.write(len(encoded).to_bytes(8, "little"))
+        f.write(encoded)
+        for data in arrays:
+            f.write(data.tobytes())
+            f.write(b"\0" * (-(len(data) * data.itemsize) % 8))
+        f.write(names)
+    os.replace(temp, filename)  # never leave a half written cache file behind
+
+
+def read_header(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not an index cache file")
+        length = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(length)), len(MAGIC) + 8 + length
+
+
+def load_index(filename):
+    """Inverse of save_index, returns (index, header)."""
+    header, start = read_header(filename)
+    header["arrays"] = {}
+    index = ArchiveIndex()
+    with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for column in header["columns"]:
+                data = array(column["typecode"])
+                begin = start + column["offset"]
+                data.frombytes(view[begin:begin + column["count"] * data.itemsize])
+                if header["byteorder"] != sys.byteorder:
+                    data.byteswap()
+                if column.get("extra"):
+                    header["arrays"][column["name"]] = data
+                else:
+                    setattr(index, column["name"], data)
+            begin = start + header["names"]["offset"]
+            names = bytes(view[begin:begin + header["names"]["length"]])
+        finally:
+            view.release()
+
+    index.names = names.decode("utf-8", errors="surrogatepass").split("\0")
+    # the name table is only rebuilt once something needs to look names up
+    index.name_table = {}
+    index.interned = False
+    index.attributes = header["attributes"]
+    index.attribute_table = {attribute: i for i, attribute in enumerate(index.attributes)}
+    index.versions = header.get("versions", 0)
+    index.drop_lookup()
+    return index, header
+
+
+class ListingCache:
+    """Directory of saved indexes, one file per archive path, evicted least recently used first."""
+
+    def __init__(self, location=None, max_size=DEFAULT_MAX_SIZE):
+        self.location = os.path.abspath(location or default_cache_dir())
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("config", "index_cache_dir", fallback=None),
+                   config.getint("config", "index_cache_max_size", fallback=DEFAULT_MAX_SIZE))
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def entry_path(self, archive_path):
+        key = hashlib.blake2b(os.path.abspath(archive_path).encode("utf-8"), digest_size=16).hexdigest()
+        return os.path.join(self.location, key + EXTENSION)
+
+    def companion_path(self, archive_path, extension):
+        """Where data derived from the archive's cached listing (e.g. a search index) is kept."""
+        return self.entry_path(archive_path)[:-len(EXTENSION)] + extension
+
+    def _remove_companions(self, filename):
+        stem = os.path.basename(filename)[:-len(EXTENSION)]
+        try:
+            names = os.listdir(self.location)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(stem) and not name.endswith(EXTENSION):
+                _remove(os.path.join(self.location, name))
+
+    def load(self, archive_path):
+        """Returns (index, header, state, identity) for the archive.
+
+        state is HIT when the archive is unchanged, APPENDED when it only grew since the cached listing
+        (the index is returned but lacks the new versions) and MISS otherwise (index is None).
+        """
+        identity = archive_identity(archive_path)
+        if not self.enabled:
+            return None, None, MISS, identity
+        filename = self.entry_path(archive_path)
+        try:
+            cached, _ = read_header(filename)
+        except (OSError, ValueError):
+            return None, None, MISS, identity
+
+        old = cached.get("identity", {})
+        if old == identity:
+            state = HIT
+        elif (old.get("path") == identity["path"] and old.get("size", 0) < identity["size"]
+              and tail_hash(archive_path, old["size"]) == old.get("tail")):
+            state = APPENDED
+        else:
+            _remove(filename)
+            return None, None, MISS, identity
+
+        try:
+            index, header = load_index(filename)
+        except (OSError, ValueError, KeyError):
+            _remove(filename)
+            return None, None, MISS, identity
+        index.identity = old  # until an APPENDED index is brought up to date and stored again
+        try:
+            os.utime(filename)  # mtime doubles as the last use time for eviction
+        except OSError:
+            pass
+        return index, header, state, identity
+
+    def store(self, archive_path, index, identity=None, **extra):
+        if not self.enabled:
+            return
+        os.makedirs(self.location, exist_ok=True)
+        filename = self.entry_path(archive_path)
+        identity = identity or archive_identity(archive_path)
+        save_index(index, filename, {"identity": identity, **extra})
+        index.identity = identity
+        self._remove_companions(filename)  # built from the old listing
+        self.evict(keep=filename)
+
+    def stored_identity(self, archive_path):
+        """Identity of the archive's cached listing, None when there is none."""
+        try:
+            header, _ = read_header(self.entry_path(archive_path))
+        except (OSError, ValueError):
+            return None
+        return header.get("identity")
+
+    def evict(self, keep=None):
+        """Deletes the least recently used entries until the cache fits in max_size.
+
+        Another process may store or evict at the same time, an entry that vanishes or cannot be removed
+        is skipped rather than failing the one being stored. Only entries and their companions count
+        towards max_size, other files in the directory are never evicted so they are not counted either.
+        """
+        entries = {}
+        companions = {}
+        try:
+            names = os.listdir(self.location)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.location, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not S_ISREG(stat.st_mode):
+                continue
+            if name.endswith(EXTENSION):
+                entries[name[:-len(EXTENSION)]] = (stat.st_mtime, path)
+            companions[name.split(".")[0]] = companions.get(name.split(".")[0], 0) + stat.st_size
+        total = sum(companions[stem] for stem in entries)
+        for stem, (_, path) in sorted(entries.items(), key=lambda item: item[1]):
+            if total <= self.max_size:
+                break
+            if path != keep and _remove(path):
+                self._remove_companions(path)
+                total -= companions[stem]
+
+
+class ContentCache:
+    """Directory of extracted files kept across sessions, so reading a file again does not run zpaqfranz.
+
+    An entry is keyed by the archive (its absolute path and first bytes, which appending never changes),
+    the file's path in it, the version it was read at and the size and date the listing gives it, so a
+    later version of the file gets an entry of its own. Entries are written to a temporary file renamed
+    into place once complete, a crash never leaves a partial one behind. The least recently used are
+    deleted once the cache is over `max_size` bytes, files over `max_file_size` are not kept at all.
+    """
+
+    def __init__(self, location=None, max_size=DEFAULT_MAX_SIZE, max_file_size=None):
+        self.location = os.path.abspath(location or default_cache_dir("zpaqtreeview-content"))
+        self.max_size = max_size
+        self.max_file_size = max_file_size  # a quarter of max_size when None
+        self.hits = 0
+        self.misses = 0
+        self.size = None  # bytes of all entries, counted when something is first stored
+        self._archives = {}  # (path, size, mtime) -> archive key
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("config", "content_cache_dir", fallback=None),
+                   config.getint("config", "content_cache_max_size", fallback=DEFAULT_MAX_SIZE))
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def cacheable(self, size):
+        limit = self.max_size // 4 if self.max_file_size is None else self.max_file_size
+        return self.enabled and size is not None and size <= limit
+
+    def archive_key(self, zpaq_file):
+        path = os.path.abspath(zpaq_file)
+        stat = os.stat(path)
+        with self._lock:
+            key = self._archives.get((path, stat.st_size, stat.st_mtime_ns))
+        if key is None:
+            with open(path, "rb") as f:
+                head = f.read(TAIL_BYTES)
+            key = hashlib.blake2b(path.encode("utf-8", errors="surrogatepass") + b"\0" + head,
+                                  digest_size=16).hexdigest()
+            with self._lock:
+                self._archives[(path, stat.st_size, stat.st_mtime_ns)] = key
+        return key
+
+    def entry_path(self, zpaq_file, path, size, date, until=None):
+        key = hashlib.blake2b(f"{self.archive_key(zpaq_file)}\0{path}\0{size}\0{date}\0{until}".encode(
+            "utf-8", errors="surrogatepass"), digest_size=16).hexdigest()
+        return os.path.join(self.location, key[:2], key + CONTENT_EXTENSION)
+
+    def __contains__(self, key):
+        """Whether (zpaq_file, path, size, date, until) is cached, without counting a hit or miss."""
+        return self.cacheable(key[2]) and os.path.exists(self.entry_path(*key))
+
+    def lookup(self, zpaq_file, path, size, date, until=None):
+        """Filename of the cached file or None, counted as a hit or miss."""
+        if not self.cacheable(size):
+            return None
+        filename = self.entry_path(zpaq_file, path, size, date, until)
+        try:
+            os.utime(filename)  # mtime doubles as the last use time for eviction
+        except OSError:
+            self.misses += 1
+            metrics.count("content_misses")
+            return None
+        self.hits += 1
+        metrics.count("content_hits")
+        return filename
+
+    def get(self, zpaq_file, path, size, date, until=None):
+        """The cached file's bytes or None."""
+        filename = self.lookup(zpaq_file, path, size, date, until)
+        if filename is not None:
+            try:
+                with open(filename, "rb") as f:
+                    return f.read()
+            except OSError:  # evicted in between
+                pass
+        return None
+
+    def put(self, zpaq_file, path, size, date, data, until=None):
+        if self.cacheable(size):
+            entry = self.writer(zpaq_file, path, size, date, until)
+            entry.write(data)
+            entry.finish(True)
+
+    def store_file(self, filename, zpaq_file, path, size, date, until=None, move=False):
+        """Adds an extracted file, copied or, with `move`, moved into the cache when it can be."""
+        if not self.cacheable(size) or not os.path.isfile(filename) or os.path.getsize(filename) != size:
+            return
+        target = self.entry_path(zpaq_file, path, size, date, until)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if move:
+            try:
+                os.replace(filename, target)
+                self._added(size)
+                return
+            except OSError:  # e.g. on another drive
+                pass
+        entry = _ContentEntry(self, target, size)
+        try:
+            with open(filename, "rb") as f:
+                shutil.copyfileobj(f, entry.file)
+            entry.written = size
+            entry.finish(True)
+        except OSError:
+            entry.finish(False)
+
+    def writer(self, zpaq_file, path, size, date, until=None):
+        """A _ContentEntry to write the file into, it only becomes an entry if finish(True) sees all of it."""
+        target = self.entry_path(zpaq_file, path, size, date, until)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        return _ContentEntry(self, target, size)
+
+    def stream(self, zpaq_file, path, size, date, start, until=None):
+        """What `start()` returns (a ZpaqProcess extracting the file to stdout) or a cached copy that reads like it.
+
+        A started extraction's output is cached as it is read, once it has been read to the end.
+        """
+        if not self.cacheable(size):
+            return start()
+        filename = self.lookup(zpaq_file, path, size, date, until)
+        if filename is not None:
+            try:
+                return _CachedFile(filename)
+            except OSError:  # evicted in between
+                pass
+        return _Tee(start(), self.writer(zpaq_file, path, size, date, until))
+
+    def _added(self, size):
+        metrics.count("content_stored_bytes", size)
+        with self._lock:
+            if self.size is None:
+                self.evict()
+                return
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries (and leftovers of crashed writes) until the cache fits."""
+        entries = []
+        total = 0
+        now = time()
+        for folder in os.scandir(self.location) if os.path.isdir(self.location) else ():
+            if not folder.is_dir():
+                continue
+            for item in os.scandir(folder.path):
+                try:
+                    stat = item.stat()
+                except OSError:
+                    continue
+                if item.name.endswith(CONTENT_EXTENSION):
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+                    total += stat.st_size
+                elif now - stat.st_mtime > STALE_TEMP:
+                    _remove(item.path)
+        entries.sort()
+        for _, size, filename in entries:
+            if total <= self.max_size:
+                break
+            if _remove(filename):  # an entry open on Windows stays until the next eviction
+                total -= size
+                metrics.count("content_evicted")
+        self.size = total
+
+    def clear(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+        with self._lock:
+            self.size = None
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+        return True
+    except OSError:
+        return False
+
+
+class _ContentEntry:
+    """A ContentCache entry being written to a temporary file next to where it goes."""
+
+    def __init__(self, cache, target, size):
+        self.cache = cache
+        self.target = target
+        self.size = size
+        self.written = 0
+        fd, self.temp = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, data):
+        if self.file is not None and data:
+            self.file.write(data)
+            self.written += len(data)
+
+    def finish(self, ok):
+        """Renames the file into place if `ok` and it has every byte, deletes it otherwise."""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if ok and self.written == self.size:
+            try:
+                os.replace(self.temp, self.target)
+                self.cache._added(self.size)
+                return
+            except OSError:
+                pass
+        _remove(self.temp)
+
+
+class _CachedFile:
+    """A ContentCache hit looking like a finished ZpaqProcess: read() like a file, stdout/poll()/wait() like a Popen."""
+
+    returncode = 0
+
+    def __init__(self, filename):
+        self.stdout = open(filename, "rb")
+
+    def read(self, size=-1):
+        return self.stdout.read(size)
+
+    def readinto(self, buffer):
+        return self.stdout.readinto(buffer)
+
+    def read1(self, size=-1):
+        return self.stdout.read1(size)
+
+    def close(self):
+        self.stdout.close()
+
+    stop = close
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def poll(self):
+        return 0
+
+    def kill(self):
+        pass
+
+    def wait(self, timeout=None):
+        return 0
+
+
+class _Tee:
+    """A ZpaqProcess whose output is also written to a _ContentEntry, kept if zpaqfranz gave all of it and succeeded."""
+
+    def __init__(self, process, entry):
+        self.process = process
+        self.entry = entry
+        self.stdout = _TeeReader(self)  # for code reading stdout like a Popen's, e.g. BlockReader
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def read(self, size=-1):
+        data = self.process.read(size)
+        self.entry.write(data)
+        return data
+
+    def readinto(self, buffer):
+        count = self.process.readinto(buffer)
+        self.entry.write(memoryview(buffer)[:count])
+        return count
+
+    def read1(self, size=-1):
+        data = self.process.read1(size)
+        self.entry.write(data)
+        return data
+
+    def close(self):
+        try:
+            self.process.close()
+        except BaseException:
+            self.entry.finish(False)
+            raise
+        self.entry.finish(self.process.returncode == 0)
+
+    def stop(self):
+        self.process.stop()
+        self.entry.finish(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.stop()
+
+    def poll(self):
+        return self.process.poll()
+
+    def check(self):
+        self.process.check()
+
+    def kill(self):
+        if self.entry.written < self.entry.size:  # with all of the file read, let zpaqfranz exit by itself
+            self.process.kill()
+
+    def wait(self, timeout=None):
+        returncode = self.process.wait(timeout)
+        self.entry.finish(returncode == 0)
+        return returncode
+
+
+class _TeeReader:
+    def __init__(self, tee):
+        self.tee = tee
+
+    def read(self, size=-1):
+        return self.tee.read(size)
+
+    def close(self):
+        self.tee.process.stdout.close()
+
+
+class BlockCache:
+    """Fixed size blocks of extracted files, kept in memory up to `max_memory` bytes.
+
+    Least recently used blocks spill to one sparse file per archived file in `location`, spill files
+    are deleted least recently used first once they take more than `max_disk` bytes.
+    """
+
+    def __init__(self, location, max_memory, max_disk=DEFAULT_MAX_SIZE, block_size=BLOCK_SIZE, namespace=""):
+        self.location = os.path.abspath(location)
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.block_size = block_size
+        self.namespace = namespace  # e.g. the archive path, so spill files of different archives never mix
+        self.memory_size = 0
+        self.disk_size = 0
+        self._memory = OrderedDict()  # (path, block) -> bytes, least recently used first
+        self._spilled = OrderedDict()  # path -> set of blocks in its spill file, least recently used first
+        self._spill_sizes = {}  # path -> bytes written to its spill file
+        self._lock = threading.RLock()  # readers of different files share the cache
+
+    def spill_path(self, path):
+        key = hashlib.blake2b(f"{self.namespace}\0{path}".encode("utf-8", errors="surrogatepass"),
+                              digest_size=16).hexdigest()
+        return os.path.join(self.location, key + ".blocks")
+
+    def __contains__(self, key):
+        path, block = key
+        with self._lock:
+            return key in self._memory or block in self._spilled.get(path, ())
+
+    def get(self, path, block):
+        """Returns the block's bytes or None, a spilled block is read back into memory."""
+        key = (path, block)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+            blocks = self._spilled.get(path)
+            if blocks is None or block not in blocks:
+                return None
+            self._spilled.move_to_end(path)
+            with open(self.spill_path(path), "rb") as f:
+                f.seek(block * self.block_size)
+                data = f.read(self.block_size)
+            self.put(path, block, data)
+            return data
+
+    def put(self, path, block, data):
+        key = (path, block)
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self.memory_size -= len(old)
+            self._memory[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.max_memory and self._memory:
+                (old_path, old_block), old = self._memory.popitem(last=False)
+                self.memory_size -= len(old)
+                self._spill(old_path, old_block, old)
+
+    def _spill(self, path, block, data):
+        blocks = self._spilled.get(path)
+        if blocks is not None and block in blocks:
+            return  # blocks never change, the copy on disk is still good
+        others = [other for other in self._spilled if other != path]  # least recently used first
+        while self.disk_size + len(data) > self.max_disk and others:
+            self.discard(others.pop(0))
+        if self.disk_size + len(data) > self.max_disk:
+            return  # the file alone fills the disk budget, the block is read again if it is needed
+        os.makedirs(self.location, exist_ok=True)
+        filename = self.spill_path(path)
+        with open(filename, "r+b" if blocks is not None else "wb") as f:
+            f.seek(block * self.block_size)
+            f.write(data)
+        if blocks is None:
+            blocks = self._spilled[path] = set()
+        blocks.add(block)
+        self._spilled.move_to_end(path)
+        self._spill_sizes[path] = self._spill_sizes.get(path, 0) + len(data)
+        self.disk_size += len(data)
+
+    def discard(self, path):
+        """Forgets the spilled blocks of `path` and deletes its spill file."""
+        with self._lock:
+            blocks = self._spilled.pop(path, None)
+            if blocks is None:
+                return
+            self.disk_size -= self._spill_sizes.pop(path, 0)
+            try:
+                os.remove(self.spill_path(path))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.memory_size = 0
+            for path in list(self._spilled):
+                self.discard(path)
+
+
+class _Stream:
+    """One file's extraction: the zpaqfranz process, the next block it will give and who is using it."""
+
+    __slots__ = ("lock", "process", "position", "users")
+
+    def __init__(self):
+        self.lock = threading.Lock()  # held while reading from the process
+        self.process = None
+        self.position = 0
+        self.users = 0  # readers holding this stream, it is never closed under them
+
+
+class BlockReader:
+    """Random access reads of archived files through a BlockCache, safe to call from many threads.
+
+    zpaqfranz can only extract a file from its start, so a missing block is read by continuing that
+    file's extraction when it has not passed the block yet, and by restarting it otherwise. Every
+    block passed on the way is cached. `open_stream(path, size, date)` has to return a ZpaqProcess (or a
+    Popen with a stdout pipe), size and date are what read() was given, e.g. for a ContentCache.
+
+    Different files are extracted in parallel. Readers of the same file share its one extraction: a
+    reader that finds it busy waits for it and then usually finds its block already cached, instead of
+    starting zpaqfranz again. Idle extractions over `max_streams` are stopped, least recently used first.
+
+    An extraction that ends before the file does (zpaqfranz failed, timed out or was killed) raises its
+    ZpaqError from read(), the short last block is never cached.
+    """
+
+    def __init__(self, cache: BlockCache, open_stream, max_streams=MAX_STREAMS):
+        self.cache = cache
+        self.open_stream = open_stream
+        self.max_streams = max_streams
+        self._lock = threading.Lock()  # guards _streams and the users counts, never held while extracting
+        self._streams = OrderedDict()  # path -> _Stream, least recently used first
+
+    def read(self, path, size, offset, length, date=0):
+        """Returns up to `length` bytes at `offset`, a memoryview into the cached block if it is in one."""
+        end = min(size, offset + length)
+        if offset >= end:
+            return b""
+        block_size = self.cache.block_size
+        first = offset // block_size
+        last = (end - 1) // block_size
+        parts = []
+        for block in range(first, last + 1):
+            data = self._block(path, block, size, date)
+            start = offset - block * block_size if block == first else 0
+            stop = end - block * block_size if block == last else block_size
+            parts.append(memoryview(data)[start:stop])
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def _block(self, path, block, size, date):
+        data = self.cache.get(path, block)
+        if data is not None:
+            metrics.count("block_hits")
+            return data
+        stream = self._acquire(path)
+        try:
+            with stream.lock:
+                # whoever had the extraction before may have passed the block already
+                data = self.cache.get(path, block)
+                if data is not None:
+                    metrics.count("block_coalesced")
+                    return data
+                metrics.count("block_misses")
+                with metrics.timer("block_extract"):
+                    return self._extract(path, stream, block, size, date)
+        finally:
+            self._release(stream)
+
+    def _acquire(self, path):
+        with self._lock:
+            stream = self._streams.get(path)
+            if stream is None:
+                stream = self._streams[path] = _Stream()
+            self._streams.move_to_end(path)
+            stream.users += 1
+            return stream
+
+    def _release(self, stream):
+        with self._lock:
+            stream.users -= 1
+            running = sum(1 for other in self._streams.values() if other.process is not None)
+            for path, other in list(self._streams.items()):
+                if other.users:
+                    continue
+                if other.process is not None:
+                    if running <= self.max_streams:
+                        continue
+                    self._stop(other)
+                    running -= 1
+                del self._streams[path]
+
+    def _extract(self, path, stream, block, size, date):
+        if stream.process is None or stream.position > block:
+            if stream.process is not None:
+                self._stop(stream)
+            stream.process = self.open_stream(path, size, date)
+            stream.position = 0
+
+        block_size = self.cache.block_size
+        data = b""
+        while stream.position <= block:
+            chunk = stream.process.stdout.read(block_size)
+            if len(chunk) < block_size and stream.position * block_size + len(chunk) < size:
+                self._fail(path, stream, stream.position * block_size + len(chunk), size)
+            if chunk and (path, stream.position) not in self.cache:
+                self.cache.put(path, stream.position, chunk)
+            if stream.position == block:
+                data = chunk
+            stream.position += 1
+            if len(chunk) < block_size:  # end of the file, nothing left to stream
+                self._stop(stream)
+                break
+        return data
+
+    def _fail(self, path, stream, got, size):
+        """zpaqfranz stopped before the end of the file, raises why rather than caching a short block."""
+        process = stream.process
+        self._stop(stream)
+        check = getattr(process, "check", None)
+        if check is not None:
+            check()
+        raise ZpaqFailed(f"zpaqfranz gave {got} of the {size} bytes of {path}", getattr(process, "command", None),
+                         process.returncode)
+
+    @staticmethod
+    def _stop(stream):
+        process = stream.process
+        stream.process = None
+        stream.position = 0
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+    def close(self):
+        with self._lock:
+            for stream in self._streams.values():
+                if stream.process is not None:
+                    self._stop(stream)
+            self._streams.clear()
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--index-cache-dir", type=str, default=None,
+                        help="where parsed listings are cached (default: user cache directory)")
+    parser.add_argument("--index-cache-max-size", type=int, default=None,
+                        help="maximum total size of cached listings in bytes, 0 disables the cache")
+
+
+def cache_from_args(args, config):
+    cache = ListingCache.from_config(config)
+    if args.index_cache_dir is not None:
+        cache.location = os.path.abspath(args.index_cache_dir)
+    if args.index_cache_max_size is not None:
+        cache.max_size = args.index_cache_max_size
+    return cache
+
+
+def add_content_cache_arguments(parser):
+    parser.add_argument("--content-cache-dir", type=str, default=None,
+                        help="where extracted files are kept for next time (default: content in the user cache directory)")
+    parser.add_argument("--content-cache-max-size", type=int, default=None,
+                        help="maximum total size of kept files in bytes, 0 disables keeping them")
+
+
+def content_cache_from_args(args, config):
+    content = ContentCache.from_config(config)
+    if args.content_cache_dir is not None:
+        content.location = os.path.abspath(args.content_cache_dir)
+    if args.content_cache_max_size is not None:
+        content.max_size = args.content_cache_max_size
+    return content
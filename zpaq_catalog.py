@@ -0,0 +1,317 @@
+"""One index across many zpaq archives, to find which archives hold a path without opening any of them.
+
+    python zpaq_catalog.py add /backups/*.zpaq -j 8
+    python zpaq_catalog.py which "C:/Users/me/thesis.tex"
+    python zpaq_catalog.py modified --from 2023-06-01 --to 2023-06-30 --under "C:/Users/me"
+    python zpaq_catalog.py find "*.pdf"
+"""
+import argparse
+import configparser
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from sys import stderr
+
+import zpaqtreeview as ztv
+from zpaq_cache import (ListingCache, archive_identity, save_index, load_index, add_cache_arguments,
+                        cache_from_args)
+from zpaq_index import ArchiveIndex, FLAG_DIRECTORY, NO_NODE, VIRTUAL_ROOT, format_date, format_size, parse_date
+from zpaq_metrics import add_metrics_arguments, metrics_from_args
+from zpaq_search import SearchIndex
+
+CATALOG_NAME = "catalog.ztvcat"
+RECORD_COLUMNS = ("record_nodes", "record_archives", "record_sizes", "record_dates", "record_previous")
+
+
+class Catalog:
+    """Every path of many archives in one ArchiveIndex, stored once however many archives hold it.
+
+    Which archives hold a path is kept as records, one per path and archive with that archive's size
+    and date for it. Like VersionHistory, `heads` points at the newest record of every node and
+    `record_previous` links each record to the next older one of the same node.
+    """
+
+    def __init__(self):
+        self.index = ArchiveIndex()
+        self.archives = []  # archive_identity() of every archive, by archive id
+        self.heads = array("i", [NO_NODE])
+        self.record_nodes = array("i")
+        self.record_archives = array("H")
+        self.record_sizes = array("q")
+        self.record_dates = array("q")
+        self.record_previous = array("i")
+
+    def archive_id(self, path):
+        path = os.path.abspath(path)
+        for archive_id, identity in enumerate(self.archives):
+            if identity["path"] == path:
+                return archive_id
+        return None
+
+    def is_current(self, identity):
+        """True when the archive is catalogued and has not changed since."""
+        archive_id = self.archive_id(identity["path"])
+        return archive_id is not None and self.archives[archive_id] == identity
+
+    # Building
+
+    def _record(self, node, archive_id, size, date):
+        self.record_nodes.append(node)
+        self.record_archives.append(archive_id)
+        self.record_sizes.append(size)
+        self.record_dates.append(date)
+        self.record_previous.append(self.heads[node])
+        self.heads[node] = len(self.record_nodes) - 1
+
+    def _drop_records(self, archive_id):
+        """Forgets what an archive held, its paths stay in the index until the catalog is rebuilt."""
+        columns = [getattr(self, column) for column in RECORD_COLUMNS[:4]]
+        kept = [record for record, owner in enumerate(self.record_archives) if owner != archive_id]
+        for name, column in zip(RECORD_COLUMNS, columns):
+            setattr(self, name, array(column.typecode, (column[record] for record in kept)))
+        self.heads = array("i", [NO_NODE]) * len(self.index)
+        self.record_previous = array("i")
+        heads = self.heads
+        for record, node in enumerate(self.record_nodes):
+            self.record_previous.append(heads[node])
+            heads[node] = record
+
+    def merge(self, identity, source: ArchiveIndex):
+        """Adds the paths of one archive's index, replacing what the catalog held for it before."""
+        archive_id = self.archive_id(identity["path"])
+        if archive_id is None:
+            archive_id = len(self.archives)
+            self.archives.append(identity)
+        else:
+            self._drop_records(archive_id)
+            self.archives[archive_id] = identity
+
+        index = self.index
+        lookup = index.lookup_table()
+        name_ids = array("i", (index.intern(name) for name in source.names))
+        attribute_ids = array("H", (index.intern_attribute(attribute) for attribute in source.attributes))
+        nodes = array("i", [NO_NODE]) * len(source)
+        nodes[VIRTUAL_ROOT] = VIRTUAL_ROOT
+        for node in range(1, len(source)):
+            parent = nodes[source.parents[node]]
+            name_id = name_ids[source.name_ids[node]]
+            size = source.sizes[node]
+            date = source.dates[node]
+            target = lookup.get(parent << 32 | name_id)
+            if target is None:
+                target = index._new_node(parent, name_id, size, date, attribute_ids[source.attribute_ids[node]],
+                                         source.flags[node])
+                self.heads.append(NO_NODE)
+            elif date > index.dates[target]:  # the index shows the newest copy of every path
+                index.sizes[target] = size
+                index.dates[target] = date
+                index.attribute_ids[target] = attribute_ids[source.attribute_ids[node]]
+            nodes[node] = target
+            self._record(target, archive_id, size, date)
+        index.drop_aggregates()
+        return archive_id
+
+    def add_archives(self, config, archive_paths, cache, jobs=None, on_done=None):
+        """Lists the archives that are new or changed, `jobs` of them at once in worker processes.
+
+        Each worker lists one archive (through the listing cache, so unchanged ones cost nothing) and
+        sends its index back, the catalog merges them one at a time as they arrive. `on_done(path, error)`
+        is called for every archive, error is None when it was catalogued. Returns the number added.
+        """
+        todo = []
+        for path in archive_paths:
+            if self.is_current(archive_identity(path)):
+                if on_done is not None:
+                    on_done(path, None)
+            else:
+                todo.append(path)
+        if not todo:
+            return 0
+        # workers rebuild the config, a ConfigParser does not pickle
+        settings = dict(config["config"]) if config.has_section("config") else {}
+        added = 0
+        with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+            futures = {pool.submit(list_for_catalog, settings, path, cache.location, cache.max_size): path
+                       for path in todo}
+            for future in as_completed(futures):
+                try:
+                    source, identity = future.result()
+                except Exception as e:  # ZpaqError, unreadable archive, broken worker
+                    if on_done is not None:
+                        on_done(futures[future], e)
+                    continue
+                self.merge(identity, source)
+                added += 1
+                if on_done is not None:
+                    on_done(futures[future], None)
+        self.index.drop_lookup()
+        return added
+
+    # Queries
+
+    def records(self, node):
+        """[(archive id, size, date)] of every archive holding node, most recently catalogued first."""
+        result = []
+        record = self.heads[node] if node < len(self.heads) else NO_NODE
+        while record != NO_NODE:
+            result.append((self.record_archives[record], self.record_sizes[record], self.record_dates[record]))
+            record = self.record_previous[record]
+        return result
+
+    def which(self, path):
+        """[(archive path, size, date)] of the archives holding `path`, oldest copy first."""
+        node = self.index.find(path.replace("\\", "/"))
+        if node is None:
+            return []
+        return [(self.archives[archive_id]["path"], size, date)
+                for archive_id, size, date in sorted(self.records(node), key=lambda record: record[2])]
+
+    def modified_between(self, start, end, under=None):
+        """Yields (node, archive path, size, date) for files dated from `start` to `end` (epoch seconds).
+
+        `under` limits it to the files below one catalogued folder.
+        """
+        index = self.index
+        root = None
+        if under is not None:
+            root = index.find(under.replace("\\", "/").rstrip("/"))
+            if root is None:
+                return
+        parents = index.parents
+        flags = index.flags
+        nodes = self.record_nodes
+        sizes = self.record_sizes
+        for record, date in enumerate(self.record_dates):
+            if not start <= date <= end:
+                continue
+            node = nodes[record]
+            if flags[node] & FLAG_DIRECTORY:
+                continue
+            if root is not None:
+                ancestor = node
+                while ancestor > root:  # ancestors have lower ids, so stop once below the folder's id
+                    ancestor = parents[ancestor]
+                if ancestor != root:
+                    continue
+            yield node, self.archives[self.record_archives[record]]["path"], sizes[record], date
+
+    # Saving
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        save_index(self.index, filename, {"archives": self.archives},
+                   {"heads": self.heads, **{column: getattr(self, column) for column in RECORD_COLUMNS}})
+
+    @classmethod
+    def load(cls, filename):
+        catalog = cls()
+        catalog.index, header = load_index(filename)
+        catalog.archives = header["archives"]
+        for name, column in header["arrays"].items():
+            setattr(catalog, name, column)
+        return catalog
+
+
+def list_for_catalog(settings, archive_path, cache_location, cache_max_size):
+    """Runs in a worker process: returns (index, identity) of one archive, as load_tree() lists it."""
+    config = configparser.ConfigParser()
+    config.read_dict({"config": {**settings, "parse_workers": "1"}})  # the pool already uses every core
+    cache = ListingCache(cache_location, cache_max_size)
+    identity = archive_identity(archive_path)
+    with open(os.devnull, "w") as quiet, redirect_stdout(quiet):  # no progress bars from every worker
+        index, _ = ztv.load_tree(config, archive_path, cache, progress=lambda lines: None)
+    index.drop_lookup()
+    index.drop_aggregates()  # rebuilt faster than pickled
+    return index, identity
+
+
+def parse_day(text, end=False):
+    """Epoch seconds of "YYYY-MM-DD[ HH:MM:SS]", a bare day meaning its start or, with `end`, its end."""
+    text = text.strip()
+    return parse_date(text + ((" 23:59:59" if end else " 00:00:00") if len(text) == 10 else ""))
+
+
+def default_catalog(cache: ListingCache):
+    """Catalog file next to the listing cache directory, never in it, where eviction would count it."""
+    return os.path.join(cache.location + "-catalog", CATALOG_NAME)
+
+
+def load_catalog(filename):
+    try:
+        return Catalog.load(filename)
+    except FileNotFoundError:
+        return Catalog()
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not read the catalog {filename}. Error: {e}", file=stderr)
+        exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Catalog many zpaq archives and search them all at once.")
+    parser.add_argument("--catalog", default=None,
+                        help=f"catalog file (default: {CATALOG_NAME} in a -catalog directory next to the listing cache)")
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="catalog archives, re-listing only the ones that changed")
+    add.add_argument("archives", nargs="+")
+    add.add_argument("-j", "--jobs", type=int, default=None,
+                     help="archives to list at once (default: one per CPU core)")
+    which = commands.add_parser("which", help="print the archives holding a path")
+    which.add_argument("path")
+    modified = commands.add_parser("modified", help="print the files dated within a range")
+    modified.add_argument("--from", dest="start", default="1970-01-01", metavar="YYYY-MM-DD")
+    modified.add_argument("--to", dest="end", default="9999-12-31", metavar="YYYY-MM-DD")
+    modified.add_argument("--under", default=None, metavar="PATH", help="only files below this folder")
+    find = commands.add_parser("find", help="print the catalogued paths matching a substring, glob or re:regex")
+    find.add_argument("query")
+    commands.add_parser("archives", help="print the catalogued archives")
+    args = parser.parse_args()
+    metrics_from_args(args)
+
+    if args.command == "add":
+        config = ztv.load_create_config()
+    else:  # queries never run zpaqfranz
+        config = configparser.ConfigParser()
+        config.read("config.ini")
+    cache = cache_from_args(args, config)
+    filename = args.catalog or default_catalog(cache)
+    catalog = load_catalog(filename)
+
+    if args.command == "add":
+        def done(path, error):
+            if error is not None:
+                print(f"Could not catalog {path}. Error: {error}", file=stderr)
+            else:
+                print(f"Catalogued {path}")
+        if catalog.add_archives(config, args.archives, cache, args.jobs, done):
+            catalog.save(filename)
+        print(f"{len(catalog.archives)} archives, {len(catalog.index) - 1:,} paths, "
+              f"{len(catalog.record_nodes):,} entries in {filename}")
+    elif args.command == "which":
+        found = catalog.which(args.path)
+        if not found:
+            print(f"Not in any catalogued archive: {args.path}", file=stderr)
+            exit(1)
+        for archive, size, date in found:
+            print(f"{archive}\t{format_size(size)}\t{format_date(date)}")
+    elif args.command == "modified":
+        try:
+            start, end = parse_day(args.start), parse_day(args.end, end=True)
+        except ValueError:
+            print("Dates are YYYY-MM-DD or YYYY-MM-DD HH:MM:SS.", file=stderr)
+            exit(1)
+        for node, archive, size, date in catalog.modified_between(start, end, args.under):
+            print(f"{format_date(date)}\t{format_size(size)}\t{catalog.index.full_path(node)}\t{archive}")
+    elif args.command == "find":
+        for node in SearchIndex(catalog.index).search(args.query):
+            print(f"{catalog.index.full_path(node)}\t{len(catalog.records(node))} archives")
+    else:
+        for archive_id, identity in enumerate(catalog.archives):
+            count = sum(1 for owner in catalog.record_archives if owner == archive_id)
+            print(f"{identity['path']}\t{format_size(identity['size'])}\t{count:,} entries")
+
+
+if __name__ == "__main__":
+    main()
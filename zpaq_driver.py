@@ -0,0 +1,264 @@
+"""Runs zpaqfranz: the one place that starts it, streams its output and turns failures into exceptions.
+
+Set the ZPAQFRANZ environment variable to use another zpaqfranz than config.ini names, e.g. a fake one
+for tests: ZPAQFRANZ="python fake_zpaqfranz.py".
+"""
+import os
+import re
+import shlex
+import threading
+from collections import deque
+from subprocess import Popen, PIPE
+
+ZPAQFRANZ_ENV = "ZPAQFRANZ"
+STREAM_BUFFER = 4 * 1024 * 1024
+DEFAULT_MAX_OUTPUT = 256 * 1024 * 1024  # run() refuses to hold more than this in memory
+STDERR_TAIL = 64 * 1024  # how much of stderr (and of discarded output) errors keep
+CHECK_TIMEOUT = 30
+PROGRESS_PATTERN = re.compile(rb"(\d{1,3}(?:[.,]\d+)?)%")
+
+
+def parse_progress(chunk):
+    """Last percentage zpaqfranz printed in a chunk of its output, None if there is none."""
+    matches = PROGRESS_PATTERN.findall(chunk)
+    if matches:
+        return min(100.0, float(matches[-1].replace(b",", b".")))
+    return None
+
+
+class ZpaqError(Exception):
+    """zpaqfranz could not do what it was asked, `stderr` holds the end of what it printed."""
+
+    def __init__(self, message, command=None, returncode=None, stderr=b""):
+        super().__init__(message)
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr.decode("utf-8", errors="replace") if isinstance(stderr, bytes) else stderr
+
+    def __str__(self):
+        text = super().__str__()
+        if self.stderr.strip():
+            text += ": " + self.stderr.strip().splitlines()[-1]
+        return text
+
+
+class ZpaqNotFound(ZpaqError):
+    """The zpaqfranz executable could not be started."""
+
+
+class ZpaqFailed(ZpaqError):
+    """zpaqfranz exited with a non zero exit code."""
+
+
+class ZpaqTimeout(ZpaqError):
+    """zpaqfranz ran longer than its timeout and was killed."""
+
+
+class ZpaqOutputTooLarge(ZpaqError):
+    """The output of a run() would not fit in its memory cap."""
+
+
+class ZpaqProcess:
+    """A running zpaqfranz whose stdout the caller reads, with stderr drained in the background.
+
+    Reads like a binary file (read(), close(), with-statement) and also looks enough like a Popen
+    (stdout, poll(), kill(), wait()) for code that manages processes itself. close() after reading
+    everything raises ZpaqFailed or ZpaqTimeout when zpaqfranz did not succeed, closing earlier just
+    stops it. `progress(percent)` is called for every percentage zpaqfranz prints on stderr.
+    """
+
+    def __init__(self, command, timeout=None, progress=None, stdout=PIPE, bufsize=STREAM_BUFFER):
+        self.command = command
+        self.progress = progress
+        self.timed_out = False
+        self._eof = stdout is not PIPE
+        try:
+            self.process = Popen(command, stdout=stdout, stderr=PIPE, bufsize=bufsize)
+        except OSError as e:
+            raise ZpaqNotFound(f"Could not start {command[0]}: {e}", command) from e
+        self.stdout = self.process.stdout
+        self._stderr = deque()
+        self._stderr_size = 0
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._time_out)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _drain_stderr(self):
+        stream = self.process.stderr
+        while True:
+            chunk = stream.read1(65536) if hasattr(stream, "read1") else stream.read(65536)
+            if not chunk:
+                break
+            self._keep_tail(chunk)
+            if self.progress is not None:
+                self.report_progress(chunk)
+        stream.close()
+
+    def _keep_tail(self, chunk):
+        self._stderr.append(chunk)
+        self._stderr_size += len(chunk)
+        while self._stderr_size - len(self._stderr[0]) >= STDERR_TAIL:
+            self._stderr_size -= len(self._stderr.popleft())
+
+    def report_progress(self, chunk):
+        """Calls `progress` with the last percentage in chunk, if there is one."""
+        percent = parse_progress(chunk)
+        if percent is not None:
+            self.progress(percent)
+
+    @property
+    def stderr(self):
+        return b"".join(self._stderr)
+
+    def _time_out(self):
+        if self.process.poll() is None:
+            self.timed_out = True
+            self.process.kill()
+
+    # file interface
+
+    def read(self, size=-1):
+        data = self.stdout.read(size)
+        if not data:
+            self._eof = True
+        return data
+
+    def readinto(self, buffer):
+        count = self.stdout.readinto(buffer)
+        if not count:
+            self._eof = True
+        return count
+
+    def read1(self, size=-1):
+        data = self.stdout.read1(size)
+        if not data:
+            self._eof = True
+        return data
+
+    def close(self):
+        """Stops zpaqfranz if its output was not read to the end, otherwise checks how it exited."""
+        if not self._eof and self.process.poll() is None:
+            self.stop()
+            return
+        if self.stdout is not None:
+            self.stdout.close()
+        self.wait()
+        self.check()
+
+    def stop(self):
+        """Kills zpaqfranz without checking how it exited."""
+        if self.stdout is not None:
+            self.stdout.close()
+        self.kill()
+        self.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:  # don't hide the original error behind zpaqfranz's
+            self.stop()
+
+    # process interface
+
+    def poll(self):
+        return self.process.poll()
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+
+    def wait(self, timeout=None):
+        returncode = self.process.wait(timeout)
+        if self._timer is not None:
+            self._timer.cancel()
+        self._stderr_thread.join()
+        return returncode
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def check(self):
+        """Raises the matching ZpaqError if zpaqfranz timed out or failed."""
+        if self.timed_out:
+            raise ZpaqTimeout("zpaqfranz timed out", self.command, self.returncode, self.stderr)
+        if self.returncode:
+            raise ZpaqFailed(f"zpaqfranz exited with code {self.returncode}", self.command, self.returncode,
+                             self.stderr)
+
+
+class ZpaqDriver:
+    """Builds zpaqfranz commands and runs them.
+
+    stream() is for output that is consumed as it arrives (listings, files read with -stdout) and run()
+    for commands whose output is small (extractions to disk, which only print a log).
+    """
+
+    def __init__(self, executable="zpaqfranz", timeout=None, max_output=DEFAULT_MAX_OUTPUT):
+        # a list for an interpreter and script, e.g. a fake zpaqfranz
+        self.executable = [executable] if isinstance(executable, str) else list(executable)
+        self.timeout = timeout
+        self.max_output = max_output
+
+    @classmethod
+    def from_config(cls, config):
+        if os.environ.get(ZPAQFRANZ_ENV):
+            # Windows keeps the quotes around e.g. "C:\Program Files\Python\python.exe"
+            executable = [part.strip('"') for part in shlex.split(os.environ[ZPAQFRANZ_ENV], posix=os.name != "nt")]
+        else:
+            executable = config.get('config', 'zpaq_path', fallback="zpaqfranz")
+        return cls(executable, config.getfloat('config', 'zpaq_timeout', fallback=None))
+
+    def command(self, *args):
+        return self.executable + [str(arg) for arg in args]
+
+    def stream(self, *args, timeout=None, progress=None):
+        """Starts zpaqfranz with stdout read by the caller, see ZpaqProcess."""
+        return self.start(self.command(*args), timeout, progress)
+
+    def start(self, command, timeout=None, progress=None):
+        """Starts an already built command, e.g. one from command() queued for later."""
+        return ZpaqProcess(command, timeout or self.timeout, progress)
+
+    def run(self, *args, timeout=None, progress=None, max_output=None, keep_tail=False):
+        """Runs zpaqfranz to the end and returns its stdout, see collect() for `max_output` and `keep_tail`."""
+        return self.execute(self.command(*args), timeout, progress, max_output, keep_tail)
+
+    def execute(self, command, timeout=None, progress=None, max_output=None, keep_tail=False):
+        """run() for an already built command."""
+        return collect(self.start(command, timeout, progress), max_output or self.max_output, keep_tail)
+
+    def check(self):
+        """Runs the bare executable once, raises a ZpaqError unless it starts and exits cleanly."""
+        return self.run(timeout=CHECK_TIMEOUT, max_output=STDERR_TAIL, keep_tail=True)
+
+
+def collect(process: ZpaqProcess, max_output=DEFAULT_MAX_OUTPUT, keep_tail=False):
+    """Reads a process to the end and returns its stdout, failures raise a ZpaqError.
+
+    Progress percentages on stdout are reported like the ones on stderr. With `keep_tail` output
+    past `max_output` is dropped from the front instead of raising ZpaqOutputTooLarge.
+    """
+    chunks = deque()
+    size = 0
+    with process:
+        while True:
+            chunk = process.read1(STREAM_BUFFER)
+            if not chunk:
+                break
+            if process.progress is not None:
+                process.report_progress(chunk)
+            chunks.append(chunk)
+            size += len(chunk)
+            while size > max_output:
+                if not keep_tail:
+                    raise ZpaqOutputTooLarge(f"zpaqfranz printed more than {max_output:,} bytes", process.command)
+                size -= len(chunks.popleft())
+    return b"".join(chunks)
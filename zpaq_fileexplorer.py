@@ -2,12 +2,18 @@ import os
 from tkinter import filedialog
 from os import getcwd
 import zpaqtreeview as ztv
+from zpaq_driver import ZpaqError
+from zpaq_cache import (add_cache_arguments, cache_from_args, add_content_cache_arguments, content_cache_from_args,
+                        BlockCache, BlockReader, DEFAULT_MAX_SIZE)
+from zpaq_metrics import metrics, add_metrics_arguments, metrics_from_args
+from zpaq_namespace import IndexNamespace
+from zpaq_prefetch import Prefetcher, DEFAULT_BUDGET, DEFAULT_FILE_SIZE
 import sys
 import logging
 import argparse
-import threading
 from functools import wraps
-from pathlib import Path, PureWindowsPath
+from pathlib import Path
+from time import perf_counter
 
 from winfspy import (
     FileSystem,
@@ -23,155 +29,77 @@ from winfspy import (
     NTStatusEndOfFile,
     NTStatusMediaWriteProtected,
 )
+try:
+    from winfspy import NTStatusIoDeviceError as NTStatusReadFailed
+except ImportError:  # winfspy releases without it
+    from winfspy import NTStatusAccessDenied as NTStatusReadFailed
 from winfspy.plumbing.win32_filetime import filetime_now
 from winfspy.plumbing.security_descriptor import SecurityDescriptor
-from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
 
 
 def operation(fn):
     """Decorator for file system operations.
 
-    Provides both logging and thread-safety
+    Provides logging and, when enabled, a latency histogram per operation. There is no lock around
+    the operations: WinFsp calls them from several threads and each is safe to run alongside the others
     """
     name = fn.__name__
+    metric = "fs." + name
 
     @wraps(fn)
     def wrapper(self, *args, **kwargs):
-        head = args[0] if args else None
-        tail = args[1:] if args else ()
+        timed = metrics.enabled
+        if timed:
+            start = perf_counter()
         try:
-            with self._thread_lock:
-                result = fn(self, *args, **kwargs)
+            result = fn(self, *args, **kwargs)
         except Exception as exc:
-            logging.info(f" NOK | {name:20} | {head!r:20} | {tail!r:20} | {exc!r}")
+            if timed:
+                metrics.record(metric, perf_counter() - start, False)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(" NOK | %-20s | %-20r | %-20r | %r", name, args[0] if args else None, args[1:], exc)
             raise
         else:
-            logging.info(f" OK! | {name:20} | {head!r:20} | {tail!r:20} | {result!r}")
+            if timed:
+                metrics.record(metric, perf_counter() - start)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(" OK! | %-20s | %-20r | %-20r | %r", name, args[0] if args else None, args[1:], result)
             return result
 
     return wrapper
 
 
-class BaseFileObj:
-    @property
-    def name(self):
-        """File name, without the path"""
-        return self.path.name
-
-    @property
-    def file_name(self):
-        """File name, including the path"""
-        return str(self.path)
-
-    def __init__(self, path, attributes, security_descriptor, file_data):
-        self.path = path
-        self.file_data = file_data
-        self.attributes = attributes
-        self.security_descriptor = security_descriptor
-        now = filetime_now()
-        self.creation_time = now
-        self.last_access_time = now
-        self.last_write_time = now
-        self.change_time = now
-        self.index_number = 0
-        self.file_size = 0
-
-    def get_file_info(self):
-        return {
-            "file_attributes": self.attributes,
-            "allocation_size": self.allocation_size,
-            "file_size": self.file_size,
-            "creation_time": self.creation_time,
-            "last_access_time": self.last_access_time,
-            "last_write_time": self.last_write_time,
-            "change_time": self.change_time,
-            "index_number": self.index_number,
-        }
-
-    def __repr__(self):
-        return f"{type(self).__name__}:{self.file_name}"
-
-
-class FileObj(BaseFileObj):
-
-    allocation_unit = 4096
-
-    def __init__(self, path, attributes, security_descriptor, file_data, allocation_size=0):
-        super().__init__(path, attributes, security_descriptor, file_data)
-        self.data = bytearray(allocation_size)
-        self.attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
-        assert not self.attributes & FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY
-
-    @property
-    def allocation_size(self):
-        return 0 if type(self.data) is not bytearray else len(self.data) #len(self.data)
-
-    def set_allocation_size(self, allocation_size):
-        if allocation_size < self.allocation_size:
-            self.data = self.data[:allocation_size]
-        if allocation_size > self.allocation_size:
-            self.data += bytearray(allocation_size - self.allocation_size)
-        assert self.allocation_size == allocation_size
-        self.file_size = min(self.file_size, allocation_size)
-
-    def adapt_allocation_size(self, file_size):
-        units = (file_size + self.allocation_unit - 1) // self.allocation_unit
-        self.set_allocation_size(units * self.allocation_unit)
-
-    def set_file_size(self, file_size):
-        if file_size < self.file_size:
-            zeros = bytearray(self.file_size - file_size)
-            self.data[file_size : self.file_size] = zeros
-        if file_size > self.allocation_size:
-            self.adapt_allocation_size(file_size)
-        self.file_size = file_size
-
-    # def read(self, offset, length):
-    #     if offset >= self.file_size:
-    #         raise NTStatusEndOfFile()
-    #     end_offset = min(self.file_size, offset + length)
-    #
-    #     if self.file_size < self.max_cache_size: # 5 MB
-    #         ex_file = ztv.extract_file(config, "B:/g_small.zpaq", self.file_data.fullPath,
-    #                          "%userprofile%/AppData/Local/", self.file_data.is_directory())
-    #
-    #     file_bytes = 0
-    #     with open(ex_file, 'rb') as f:
-    #         file_bytes = f.read()
-    #
-    #     self.data = file_bytes
-    #     return file_bytes #self.data[offset:end_offset]
-
-
-class FolderObj(BaseFileObj):
-    def __init__(self, path, attributes, security_descriptor, file_data):
-        super().__init__(path, attributes, security_descriptor, file_data)
-        self.allocation_size = 0
-        assert self.attributes & FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY
-
-
 class OpenedObj:
     def __init__(self, file_obj):
         self.file_obj = file_obj
 
     def __repr__(self):
-        return f"{type(self).__name__}:{self.file_obj.file_name}"
+        return f"{type(self).__name__}:{self.file_obj.path}"
 
 
 class ZpaqFileSystemOperations(BaseFileSystemOperations):
+    """Read-only volume of an archive, paths are resolved against its index as WinFsp asks for them.
+
+    Mounts empty, set_index() shows the archive once it is listed. Nothing is made per archived entry,
+    an open handle gets an Entry (see zpaq_namespace.py) that goes away on close.
 
-    def __init__(self, volume_label, input_file, cache_location, max_cache_size, config, read_only=False):
+    Metadata operations only read the index, so they never wait for reads. Reads of different files
+    run in parallel and reads of the same file share one zpaqfranz extraction, see BlockReader. The
+    small files of the folder being looked at are extracted ahead in the background, see Prefetcher.
+    """
+
+    def __init__(self, volume_label, input_file, cache_location, max_cache_size, config,
+                 max_spill_size=DEFAULT_MAX_SIZE, prefetch_budget=DEFAULT_BUDGET, prefetch_file_size=DEFAULT_FILE_SIZE,
+                 content=None):
         super().__init__()
         if len(volume_label) > 31:
             raise ValueError("`volume_label` must be 31 characters long max")
 
-        max_file_nodes = 1024
-        max_file_size = 16 * 1024 * 1024
-        file_nodes = 1
-
         self._volume_info = {
-            "total_size": max_file_nodes * max_file_size,
-            "free_size": 0, #(max_file_nodes - file_nodes) * max_file_size,
+            "total_size": 0,
+            "free_size": 0,
             "volume_label": volume_label,
         }
 
@@ -179,39 +107,36 @@ class ZpaqFileSystemOperations(BaseFileSystemOperations):
         self.max_cache_size = max_cache_size
         self.config = config
         self.cache_location = os.path.abspath(cache_location)
-        self.read_only = read_only
-        self._root_path = PureWindowsPath("/")
-        self._root_obj = FolderObj(
-            self._root_path,
-            FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY,
-            SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"), None
-        )
-        self._entries = {self._root_path: self._root_obj}
-        self._thread_lock = threading.Lock()
-
-    # Debugging helpers
-
-    def _create_directory(self, path, file_data):
-        path = self._root_path / path
-        obj = FolderObj(
-            path,
-            FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY,
-            self._root_obj.security_descriptor,
-            file_data
-        )
-        self._entries[path] = obj
-
-    def _import_files(self, file_path, file_data):
-        file_path = Path(file_path)
-        path = self._root_path / file_path.name
-        obj = FileObj(
-            path,
-            FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE,
-            file_data,
-            self._root_obj.security_descriptor,
-        )
-        self._entries[path] = obj
-        obj.write(file_path.read_bytes(), 0, False)
+        # max_cache_size bounds the extracted blocks held in memory, the rest spill to cache_location
+        self._block_cache = BlockCache(os.path.join(self.cache_location, "zpaqtreeview-blocks"), max_cache_size,
+                                       max_spill_size, namespace=os.path.abspath(input_file) if input_file else "")
+        # files read to the end are kept in the ContentCache, later mounts (and the CLI) read them from there
+        self._content = content
+        self._reader = BlockReader(self._block_cache, self._open_stream)
+        # listing a folder or reading a file in it extracts the folder's small files in one go
+        self._prefetcher = Prefetcher(config, input_file, self._block_cache,
+                                      os.path.join(self.cache_location, "zpaqtreeview-prefetch"),
+                                      prefetch_budget, prefetch_file_size, content)
+        self._security_descriptor = SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)")
+        self._namespace = IndexNamespace()
+
+    def set_index(self, index):
+        """Shows the archive's index, handles opened before keep showing the old one until they are closed.
+
+        The index must not change afterwards, operations read it without locking.
+        """
+        self._volume_info["total_size"] = index.total_size(index.root)
+        self._namespace = IndexNamespace(index)
+
+    def _open_stream(self, path, size, date):
+        return ztv.stream_file(self.config, self.input_file, path, content=self._content, size=size, date=date)
+
+    @staticmethod
+    def _resolve(namespace, file_name):
+        node = namespace.resolve(file_name)
+        if node is None:
+            raise NTStatusObjectNameNotFound()
+        return node
 
     # Winfsp operations
 
@@ -225,18 +150,12 @@ class ZpaqFileSystemOperations(BaseFileSystemOperations):
 
     @operation
     def get_security_by_name(self, file_name):
-        file_name = PureWindowsPath(file_name)
-
-        # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
-
+        namespace = self._namespace  # read once, set_index() may replace it meanwhile
+        node = self._resolve(namespace, file_name)
         return (
-            file_obj.attributes,
-            file_obj.security_descriptor.handle,
-            file_obj.security_descriptor.size,
+            namespace.attributes(node),
+            self._security_descriptor.handle,
+            self._security_descriptor.size,
         )
 
     @operation
@@ -250,70 +169,29 @@ class ZpaqFileSystemOperations(BaseFileSystemOperations):
         allocation_size,
         file_data,
     ):
-        if self.read_only:
-            raise NTStatusMediaWriteProtected()
-
-        file_name = PureWindowsPath(file_name)
-
-        # `granted_access` is already handle by winfsp
-        # `allocation_size` useless for us
-
-        # Retrieve file
-        try:
-            parent_file_obj = self._entries[file_name.parent]
-            if isinstance(parent_file_obj, FileObj):
-                raise NTStatusNotADirectory()
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
-
-        # File/Folder already exists
-        if file_name in self._entries:
-            raise NTStatusObjectNameCollision()
-
-        if create_options & CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE:
-            file_obj = self._entries[file_name] = FolderObj(
-                file_name, file_attributes, security_descriptor, file_data
-            )
-        else:
-            file_obj = self._entries[file_name] = FileObj(
-                file_name,
-                file_attributes,
-                security_descriptor,
-                file_data,
-                allocation_size,
-            )
-
-        return OpenedObj(file_obj)
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def get_security(self, file_context):
-        return file_context.file_obj.security_descriptor
+        return self._security_descriptor
 
     @operation
     def set_security(self, file_context, security_information, modification_descriptor):
-        raise NotImplementedError()
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def rename(self, file_context, file_name, new_file_name, replace_if_exists):
-        raise NotImplementedError()
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def open(self, file_name, create_options, granted_access):
-        file_name = PureWindowsPath(file_name)
-
         # `granted_access` is already handle by winfsp
-
-        # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
-
-        return OpenedObj(file_obj)
+        namespace = self._namespace
+        return OpenedObj(namespace.open(self._resolve(namespace, file_name)))
 
     @operation
     def close(self, file_context):
-        pass
+        file_context.file_obj.namespace.close(file_context.file_obj)
 
     @operation
     def get_file_info(self, file_context):
@@ -330,137 +208,62 @@ class ZpaqFileSystemOperations(BaseFileSystemOperations):
         change_time,
         file_info,
     ) -> dict:
-        if self.read_only:
-            raise NTStatusMediaWriteProtected()
-
-        file_obj = file_context.file_obj
-        if file_attributes != FILE_ATTRIBUTE.INVALID_FILE_ATTRIBUTES:
-            file_obj.attributes = file_attributes
-        if creation_time:
-            file_obj.creation_time = creation_time
-        if last_access_time:
-            file_obj.last_access_time = last_access_time
-        if last_write_time:
-            file_obj.last_write_time = last_write_time
-        if change_time:
-            file_obj.change_time = change_time
-
-        return file_obj.get_file_info()
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def set_file_size(self, file_context, new_size, set_allocation_size):
-        if self.read_only:
-            raise NTStatusMediaWriteProtected()
-
-        if set_allocation_size:
-            file_context.file_obj.set_allocation_size(new_size)
-        else:
-            file_context.file_obj.set_file_size(new_size)
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def can_delete(self, file_context, file_name: str) -> None:
-        raise NotImplementedError()
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def read_directory(self, file_context, marker):
-        entries = []
         file_obj = file_context.file_obj
-
-        # Not a directory
-        if isinstance(file_obj, FileObj):
+        if not file_obj.is_directory:
             raise NTStatusNotADirectory()
-
-        # The "." and ".." should ONLY be included if the queried directory is not root
-        if file_obj.path != self._root_path:
-            parent_obj = self._entries[file_obj.path.parent]
-            entries.append({"file_name": ".", **file_obj.get_file_info()})
-            entries.append({"file_name": "..", **parent_obj.get_file_info()})
-
-        # Loop over all entries
-        for entry_path, entry_obj in self._entries.items():
-            try:
-                relative = entry_path.relative_to(file_obj.path)
-            # Filter out unrelated entries
-            except ValueError:
-                continue
-            # Filter out ourself or our grandchildren
-            if len(relative.parts) != 1:
-                continue
-            # Add direct chidren to the entry list
-            entries.append({"file_name": entry_path.name, **entry_obj.get_file_info()})
-
-        # Sort the entries
-        entries = sorted(entries, key=lambda x: x["file_name"])
-
-        # No filtering to apply
         if marker is None:
-            return entries
-
-        # Filter out all results before the marker
-        for i, entry in enumerate(entries):
-            if entry["file_name"] == marker:
-                return entries[i + 1 :]
+            self._prefetcher.request(file_obj.namespace, file_obj.node)
+        return file_obj.namespace.read_directory(file_obj.node, marker)
 
     @operation
     def get_dir_info_by_name(self, file_context, file_name):
-        path = file_context.file_obj.path / file_name
-        try:
-            entry_obj = self._entries[path]
-        except KeyError:
+        namespace = file_context.file_obj.namespace
+        node = namespace.child(file_context.file_obj.node, file_name)
+        if node is None:
             raise NTStatusObjectNameNotFound()
-
-        return {"file_name": file_name, **entry_obj.get_file_info()}
-
-    # @operation
-    # def read(self, file_context, offset, length):
-    #     if len(file_context.file_obj.data) == 0:
-    #         ex_file = None
-    #         if file_context.file_obj.file_size < self.max_cache_size: # 30 MB deafult
-    #             ex_file = ztv.extract_file(self.config, self.input_file, file_context.file_obj.file_data.fullPath,
-    #                              self.cache_location, file_context.file_obj.file_data.is_directory())
-    #             if ex_file is not None:
-    #                 with open(ex_file, 'rb') as f:
-    #                     file_context.file_obj.data = bytearray(f.read())
-    #
-    #             end_offset = min(file_context.file_obj.file_size, offset + length)
-    #             return file_context.file_obj.data[offset:end_offset]
-    #         else:
-    #             file_context.file_obj.data = bytearray(1)
-    #             return file_context.file_obj.data
-    #
-    #     if len(file_context.file_obj.data) > 1:
-    #         end_offset = min(file_context.file_obj.file_size, offset + length)
-    #         return file_context.file_obj.data[offset:end_offset]
-    #
-    #     return bytearray(1)
+        return {"file_name": file_name, **namespace.file_info(node)}
 
     @operation
     def read(self, file_context, offset, length):
-        if len(file_context.file_obj.data) == 0:
-            if file_context.file_obj.file_size < self.max_cache_size: # 30MB default
-                file_context.file_obj.data = bytearray(
-                    ztv.read_file(self.config, self.input_file, file_context.file_obj.file_data.fullPath))
-            else:
-                file_context.file_obj.data = bytearray(1)
-
-
-        return file_context.file_obj.data[offset:offset + length]
-
-
+        file_obj = file_context.file_obj
+        if offset >= file_obj.file_size:
+            raise NTStatusEndOfFile()
+        self._prefetcher.request(file_obj.namespace, file_obj.namespace.parent(file_obj.node))
+        self._prefetcher.wait(file_obj.path)
+        try:
+            data = self._reader.read(file_obj.path, file_obj.file_size, offset, length,
+                                     file_obj.namespace.index.dates[file_obj.node])
+        except ZpaqError as e:
+            logger.error("Reading %s failed: %s", file_obj.path, e)
+            raise NTStatusReadFailed()
+        metrics.count("fs.read_bytes", len(data))
+        return data
 
     @operation
     def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
-        raise NotImplementedError()
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def cleanup(self, file_context, file_name, flags) -> None:
-        raise NotImplementedError()
+        pass
 
     @operation
     def overwrite(
         self, file_context, file_attributes, replace_file_attributes: bool, allocation_size: int
     ) -> None:
-        raise NotImplementedError()
+        raise NTStatusMediaWriteProtected()
 
     @operation
     def flush(self, file_context) -> None:
@@ -469,7 +272,8 @@ class ZpaqFileSystemOperations(BaseFileSystemOperations):
 
 def create_memory_file_system(
     mountpoint, label="memfs", prefix="", verbose=True, debug=False, testing=False,
-        input_file="", cache_location="%userprofile%/AppData/Local/", max_cache_size = 30 * 10**6 , config=None):
+        input_file="", cache_location="%userprofile%/AppData/Local/", max_cache_size = 30 * 10**6 , config=None,
+        max_spill_size=DEFAULT_MAX_SIZE, prefetch_budget=DEFAULT_BUDGET, content=None):
     if debug:
         enable_debug_log()
 
@@ -482,7 +286,9 @@ def create_memory_file_system(
     is_drive = mountpoint.parent == mountpoint
     reject_irp_prior_to_transact0 = not is_drive and not testing
 
-    operations = ZpaqFileSystemOperations(label, input_file, cache_location, max_cache_size, config)
+    operations = ZpaqFileSystemOperations(label, input_file, cache_location, max_cache_size, config,
+                                          max_spill_size=max_spill_size, prefetch_budget=prefetch_budget,
+                                          content=content)
     fs = FileSystem(
         str(mountpoint),
         operations,
@@ -501,75 +307,38 @@ def create_memory_file_system(
         prefix=prefix,
         debug=debug,
         reject_irp_prior_to_transact0=reject_irp_prior_to_transact0,
+        read_only_volume=True,
         # security_timeout_valid=1,
         # security_timeout=10000,
     )
     return fs
 
-def convert_filetree(config, file_path, fs):
-    tl_tree = ztv.main(config, file_path)
-    tl_node_stack = [tl_tree.get_node(tl_tree.root)]
-
-    new_path = tl_tree.get_node(tl_tree.root).data.fullPath.replace(tl_tree.root, fs.mountpoint) + "/"
-    print("In convert before first create.")
-    # fs_root = fs.operations.create(new_path, CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE, None,
-    #                      FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY, None, 0, tl_tree.get_node(tl_tree.root).data)
-    # fs_stack = [fs_root]
-    # fs_root = fs.operations._create_directory(new_path, tl_tree.get_node(tl_tree.root).data)
-
-    print("Converting file tree to winfspy structure...")
-    bar = tqdm(total=tl_tree.size(), unit="nodes", colour="green", leave=False)
-    c1 = 0
-    while len(tl_node_stack) > 0:
-        tl_node = tl_node_stack.pop()
-        # fs_node = fs_stack.pop()
-
-        #children_sorted = tl_tree.children(tl_node.tag)
-        #children_sorted.sort(key=lambda x: (x.is_leaf(), x.data.name.lower()))  # TODO: check if necessary to sort
-        if (tl_node.data.is_directory()):
-            for tl_child_node in tl_tree.children(tl_node.tag):  # children_sorted:
-                new_path = tl_child_node.data.fullPath.replace(tl_tree.root, "")
-                if (tl_child_node.data.is_directory()): # is directory
-                    tl_node_stack.append(tl_child_node)
-                    fs.operations._create_directory(new_path, tl_child_node.data)
-                else: # is file
-                    fileobj = fs.operations.create(new_path, CREATE_FILE_CREATE_OPTIONS.FILE_NON_DIRECTORY_FILE, None,
-                        FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL, fs.operations._root_obj.security_descriptor, 0, tl_child_node.data)
-                    fileobj.file_obj.file_size = tl_child_node.data.size
-
-        bar.update()
-
-
-    bar.close()
-
-def create_filesystem(mountpoint, label, prefix, verbose, debug, input_file, cache_location, max_cache_size):
-    config = ztv.load_create_config()
+def load_filetree(config, file_path, fs, cache=None):
+    """Lists the archive (or loads it from the cache) and shows it on the mounted volume."""
+    fs.operations.set_index(ztv.main(config, file_path, cache))
+
+def create_filesystem(mountpoint, label, prefix, verbose, debug, input_file, cache_location, max_cache_size,
+                      config=None, index_cache=None, max_spill_size=DEFAULT_MAX_SIZE, prefetch_budget=DEFAULT_BUDGET,
+                      content=None):
+    if config is None:
+        config = ztv.load_create_config()
     print(f"Input file: {input_file}")
     fs = create_memory_file_system(mountpoint, label, prefix, verbose, debug, True,
-                                   input_file, cache_location, max_cache_size, config,)
+                                   input_file, cache_location, max_cache_size, config, max_spill_size, prefetch_budget,
+                                   content)
     try:
         print("Starting FS")
         fs.start()
         print("FS started, keep it running forever")
-        # while True:
-        #     result = input("Set read-only flag (y/n/q)? ").lower()
-        #     if result == "y":
-        #         fs.operations.read_only = True
-        #         fs.restart(read_only_volume=True)
-        #     elif result == "n":
-        #         fs.operations.read_only = False
-        #         fs.restart(read_only_volume=False)
-        #     elif result == "q":
-        #         break
-        print(f"Input file: {fs.operations.input_file}")
-        convert_filetree(config, fs.operations.input_file, fs)
-        fs.read_only = True
-        fs.restart(read_only_volume=True)
+        load_filetree(config, fs.operations.input_file, fs, index_cache)
         input("press enter to exit")
 
     finally:
         print("Stopping FS")
         fs.stop()
+        fs.operations._prefetcher.close()
+        fs.operations._reader.close()
+        fs.operations._block_cache.clear()
         print("FS stopped")
 
 
@@ -582,8 +351,18 @@ def main():
     parser.add_argument("-l", "--label", type=str, default="memfs")
     parser.add_argument("-p", "--prefix", type=str, default="")
     parser.add_argument("-c", "--cache-location", type=str, default=(os.environ["USERPROFILE"] + "/AppData/local/temp"))
-    parser.add_argument("-s", "--cache-size-limit", type=int, default=30 * 10**6) # 30 MB
+    parser.add_argument("-s", "--cache-size-limit", type=int, default=30 * 10**6,
+                        help="memory for extracted file blocks in bytes")  # 30 MB
+    parser.add_argument("--spill-size-limit", type=int, default=DEFAULT_MAX_SIZE,
+                        help="disk space in the cache location for blocks that do not fit in memory, in bytes")
+    parser.add_argument("--prefetch-budget", type=int, default=DEFAULT_BUDGET,
+                        help="bytes of a browsed folder's small files to extract ahead in one zpaqfranz run, 0 disables")
+    add_cache_arguments(parser)
+    add_content_cache_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    metrics_from_args(args)
+    config = ztv.load_create_config()
 
     if args.zpaq is None:
         input_file = None
@@ -593,7 +372,9 @@ def main():
         args.zpaq = input_file
 
     create_filesystem(args.mountpoint, args.label, args.prefix, args.verbose,
-                      args.debug, args.zpaq, args.cache_location, args.cache_size_limit)
+                      args.debug, args.zpaq, args.cache_location, args.cache_size_limit,
+                      config, cache_from_args(args, config), args.spill_size_limit, args.prefetch_budget,
+                      content_cache_from_args(args, config))
 
 
 
@@ -0,0 +1,534 @@
+from array import array
+from calendar import timegm
+from heapq import heapify, heappop, heappush
+from time import gmtime, strftime
+import json
+import sys
+
+FLAG_DIRECTORY = 1
+NO_NODE = -1
+VIRTUAL_ROOT = 0
+
+
+def parse_date(datetime):
+    """Converts a zpaqfranz 'YYYY-MM-DD HH:MM:SS' (or 'YYYY-MM-DD') timestamp into epoch seconds."""
+    datetime = datetime.strip("'")
+    if len(datetime) < 10:
+        return 0
+    date = (int(datetime[0:4]), int(datetime[5:7]), int(datetime[8:10]))
+    if len(datetime) >= 19:
+        time = (int(datetime[11:13]), int(datetime[14:16]), int(datetime[17:19]))
+    else:
+        time = (0, 0, 0)
+    return timegm(date + time)
+
+
+def format_date(epoch):
+    """Inverse of parse_date, only keeps the day as that is what the tree views show."""
+    if epoch == 0:
+        return 0
+    return strftime("%Y-%m-%d", gmtime(epoch))
+
+
+def format_size(size):
+    """Size in the largest binary unit that keeps it above 1, e.g. "1.5 GiB"."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:,.0f} {unit}" if unit == "B" else f"{size:,.1f} {unit}"
+        size /= 1024
+    return f"{size:,.1f} TiB"
+
+
+# Windows attribute letters as zpaqfranz prints them, and their bit in File.flags
+ATTRIBUTE_BITS = {"D": FLAG_DIRECTORY, "R": 2, "H": 4, "S": 8, "A": 16}
+
+
+def attribute_flags(attribute):
+    """Bitmask of the attribute letters in `attribute`, FLAG_DIRECTORY set for folders."""
+    flags = 0
+    for letter in attribute:
+        flags |= ATTRIBUTE_BITS.get(letter, 0)
+    return flags
+
+
+class File:
+    """One listing entry: path, size, date and attributes.
+
+    Compact enough to make one per entry: no instance dict, the name is an offset into the path, the
+    date is kept as epoch seconds and the attributes as a bitmask (plus the interned string zpaqfranz
+    printed, shared by every entry with the same attributes). `lastModified` and `name` are derived
+    when asked for, so it reads like the plain record it replaced.
+    """
+
+    __slots__ = ("_path", "_name_start", "size", "date", "flags", "attribute")
+
+    def __init__(self, full_path, size, last_modified, attribute):
+        self.fullPath = full_path
+        self.size = size if type(size) is int else int(size.replace(".", ""))
+        self.lastModified = last_modified
+        self.attribute = sys.intern(attribute)
+        self.flags = attribute_flags(attribute)
+
+    @property
+    def fullPath(self):
+        return self._path
+
+    @fullPath.setter
+    def fullPath(self, full_path):
+        self._path = full_path.rstrip("/")
+        self._name_start = self._path.rfind("/") + 1
+
+    @property
+    def name(self):
+        return self._path[self._name_start:]
+
+    @property
+    def lastModified(self):
+        """Day of the entry's date like the listing shows it, 0 when it has none."""
+        return format_date(self.date)
+
+    @lastModified.setter
+    def lastModified(self, last_modified):
+        self.date = last_modified if type(last_modified) is int else parse_date(last_modified)
+
+    def __str__(self):
+        return f"{self.lastModified}\t{self.size:>14} {self.attribute:10}\t {self.fullPath}"
+
+    def is_directory(self):
+        return bool(self.flags & FLAG_DIRECTORY)
+
+
+class FileView:
+    """A File that reads one node of an ArchiveIndex instead of holding copies of its fields.
+
+    Two slots per entry whatever its path's length, for code that keeps a record per entry (the file
+    explorer's tree). Folders get the size of their contents once the index is aggregated.
+    """
+
+    __slots__ = ("index", "node")
+
+    def __init__(self, index, node):
+        self.index = index
+        self.node = node
+
+    @property
+    def fullPath(self):
+        return self.index.full_path(self.node)
+
+    @property
+    def name(self):
+        return self.index.name(self.node)
+
+    @property
+    def size(self):
+        return self.index.total_size(self.node)
+
+    @property
+    def date(self):
+        return self.index.dates[self.node]
+
+    @property
+    def lastModified(self):
+        return format_date(self.index.dates[self.node])
+
+    @property
+    def attribute(self):
+        return self.index.attributes[self.index.attribute_ids[self.node]]
+
+    @property
+    def flags(self):
+        return attribute_flags(self.attribute)
+
+    __str__ = File.__str__
+
+    def is_directory(self):
+        return bool(self.index.flags[self.node] & FLAG_DIRECTORY)
+
+
+class ArchiveIndex:
+    """Array-backed tree of every path in an archive listing.
+
+    Nodes are plain integers. Every path component is interned once and the tree is stored as
+    parent/first-child/next-sibling columns, so memory per entry is a few dozen bytes instead of a
+    treelib Node, a File and a full path string per ancestor.
+
+    Node 0 is a virtual root above the archive's top level entries ("C:", "D:" or "" for POSIX "/").
+    """
+
+    COLUMNS = ("name_ids", "parents", "first_child", "next_sibling", "sizes", "dates", "attribute_ids", "flags")
+    AGGREGATE_COLUMNS = ("total_sizes", "file_counts", "newest_dates")
+
+    def __init__(self):
+        self.names = [""]
+        self.name_table = {"": 0}
+        # False while some names were appended to `names` without going through the table
+        self.interned = True
+        self.attributes = ["D"]
+        self.attribute_table = {"D": 0}
+
+        self.name_ids = array("i", [0])
+        self.parents = array("i", [NO_NODE])
+        # children are chained newest first so appending one is O(1), children() restores listing order
+        self.first_child = array("i", [NO_NODE])
+        self.next_sibling = array("i", [NO_NODE])
+        self.sizes = array("q", [0])
+        self.dates = array("q", [0])
+        self.attribute_ids = array("H", [0])
+        self.flags = array("B", [FLAG_DIRECTORY])
+
+        # recursive size, number of files and newest date below every node, empty until aggregate()
+        self.total_sizes = array("q")
+        self.file_counts = array("q")
+        self.newest_dates = array("q")
+
+        # (parent << 32 | name id) -> node, only needed while building or looking up paths
+        self._lookup = {}
+        # folders whose children are in a partial _lookup, see partial_lookup(), None when it has every node
+        self._indexed = None
+        # number of archive versions the index reflects, 0 when unknown (e.g. loaded from a .txt listing)
+        self.versions = 0
+        # for an index of an earlier version, see VersionHistory.as_of(), the version and the full history
+        self.until = None
+        self.history = None
+        # archive identity of the listing cache entry holding this very index, see ListingCache
+        self.identity = None
+
+    # Building
+
+    def intern(self, name):
+        name_id = self.name_table.get(name)
+        if name_id is None:
+            name_id = self.name_table[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def intern_attribute(self, attribute):
+        attribute_id = self.attribute_table.get(attribute)
+        if attribute_id is None:
+            attribute_id = self.attribute_table[attribute] = len(self.attributes)
+            self.attributes.append(attribute)
+        return attribute_id
+
+    def _new_node(self, parent, name_id, size, date, attribute_id, flags):
+        node = len(self.parents)
+        self.name_ids.append(name_id)
+        self.parents.append(parent)
+        self.first_child.append(NO_NODE)
+        self.next_sibling.append(self.first_child[parent])
+        self.sizes.append(size)
+        self.dates.append(date)
+        self.attribute_ids.append(attribute_id)
+        self.flags.append(flags)
+
+        self.first_child[parent] = node
+        if self._lookup is not None:
+            self._lookup[parent << 32 | name_id] = node
+            if self._indexed is not None:
+                self._indexed.add(node)  # every child it gets from now on is added to the table
+        return node
+
+    def reintern(self):
+        """Merges duplicate entries in `names`, e.g. file names the parser stored without interning."""
+        names = []
+        table = {}
+        remap = array("i")
+        for name in self.names:
+            name_id = table.get(name)
+            if name_id is None:
+                name_id = table[name] = len(names)
+                names.append(name)
+            remap.append(name_id)
+        self.names = names
+        self.name_table = table
+        self.name_ids = array("i", (remap[name_id] for name_id in self.name_ids))
+        self.interned = True
+
+    def lookup_table(self):
+        """(parent << 32 | name id) -> node table of every node, rebuilt if drop_lookup() freed it or it is partial."""
+        if self._lookup is None or self._indexed is not None:
+            if not self.interned:
+                self.reintern()
+            self._lookup = {parent << 32 | name_id: node
+                            for node, (parent, name_id) in enumerate(zip(self.parents, self.name_ids)) if node}
+            self._indexed = None
+        return self._lookup
+
+    def partial_lookup(self):
+        """Lookup table that only holds the children of folders passed to index_children().
+
+        Merging a few entries into a large index, e.g. an archive's new versions into its cached listing,
+        only looks up paths in the folders they go into. Building the whole table (and reinterning every
+        name for it) would cost as much as parsing the full listing again. The complete table is kept
+        when there already is one.
+        """
+        if self._lookup is None:
+            self._lookup = {}
+            self._indexed = set()
+        return self._lookup
+
+    def index_children(self, parent):
+        """Adds the children of `parent` to a partial lookup table, see partial_lookup()."""
+        indexed = self._indexed
+        if indexed is None or parent in indexed:
+            return
+        indexed.add(parent)
+        lookup = self._lookup
+        name_table = self.name_table
+        names = self.names
+        name_ids = self.name_ids
+        next_sibling = self.next_sibling
+        node = self.first_child[parent]
+        while node != NO_NODE:
+            # without interning a name can have several ids, keys use the one the table gives new entries
+            name_id = name_table.setdefault(names[name_ids[node]], name_ids[node])
+            lookup.setdefault(parent << 32 | name_id, node)  # newest first, like the complete table
+            node = next_sibling[node]
+
+    def _table_for(self, parent):
+        """The lookup table, with the children of `parent` in it if it is partial."""
+        if self._indexed is None:
+            return self.lookup_table()
+        self.index_children(parent)
+        return self._lookup
+
+    def directory(self, parent, name):
+        """Returns the child directory `name` of `parent`, creating it if needed."""
+        lookup = self._table_for(parent)  # may reintern, so before taking a name id
+        name_id = self.intern(name)
+        node = lookup.get(parent << 32 | name_id)
+        if node is None:
+            node = self._new_node(parent, name_id, 0, 0, 0, FLAG_DIRECTORY)
+        return node
+
+    def add_child(self, parent, name, size, date, attribute):
+        """Adds (or replaces) the entry `name` directly below `parent`."""
+        lookup = self._table_for(parent)
+        name_id = self.intern(name)
+        node = lookup.get(parent << 32 | name_id)
+        flags = FLAG_DIRECTORY if "D" in attribute else 0
+        if node is None:
+            return self._new_node(parent, name_id, size, date, self.intern_attribute(attribute), flags)
+        self.drop_aggregates()  # unlike new nodes, changes are not noticed by `aggregated`
+        self.sizes[node] = size
+        self.dates[node] = date
+        self.attribute_ids[node] = self.intern_attribute(attribute)
+        self.flags[node] = flags
+        return node
+
+    def add(self, full_path, size, date, attribute):
+        """Adds (or replaces) a listing entry, creating any missing parent directories."""
+        parts = full_path.rstrip("/").split("/")
+        parent = VIRTUAL_ROOT
+        for part in parts[:-1]:
+            parent = self.directory(parent, part)
+        return self.add_child(parent, parts[-1], size, date, attribute)
+
+    # Aggregates
+
+    @property
+    def aggregated(self):
+        return len(self.total_sizes) == len(self)
+
+    def drop_aggregates(self):
+        self.total_sizes = array("q")
+        self.file_counts = array("q")
+        self.newest_dates = array("q")
+
+    def aggregate(self):
+        """Computes the recursive size, file count and newest date of every node in one sweep.
+
+        Parents always get lower node ids than their children, so walking the ids backwards visits
+        every node after everything below it (a post-order without the recursion).
+        """
+        count = len(self)
+        totals = array("q", self.sizes)
+        files = array("q", [0]) * count
+        newest = array("q", self.dates)
+        parents = self.parents
+        flags = self.flags
+        for node in range(count - 1, VIRTUAL_ROOT, -1):
+            if not flags[node] & FLAG_DIRECTORY:
+                files[node] += 1
+            parent = parents[node]
+            totals[parent] += totals[node]
+            files[parent] += files[node]
+            if newest[node] > newest[parent]:
+                newest[parent] = newest[node]
+        self.total_sizes = totals
+        self.file_counts = files
+        self.newest_dates = newest
+
+    def update_aggregates(self, first_new, changes=()):
+        """Folds nodes added since `first_new` and (node, old size, old date, old flags) changes into the aggregates.
+
+        Only the new nodes and the ancestors of what changed are touched. Newest dates only ever move
+        forward, a file replaced by an older one leaves its folders' newest date as it was.
+        """
+        count = len(self)
+        parents = self.parents
+        flags = self.flags
+        totals = self.total_sizes
+        files = self.file_counts
+        newest = self.newest_dates
+        totals.extend(self.sizes[first_new:])
+        files.extend(array("q", [0]) * (count - first_new))
+        newest.extend(self.dates[first_new:])
+
+        pending = {}  # existing node -> [size, files, newest] to add to it and all of its ancestors
+        for node in range(count - 1, first_new - 1, -1):
+            if not flags[node] & FLAG_DIRECTORY:
+                files[node] += 1
+            parent = parents[node]
+            if parent >= first_new:
+                totals[parent] += totals[node]
+                files[parent] += files[node]
+                if newest[node] > newest[parent]:
+                    newest[parent] = newest[node]
+            else:
+                delta = pending.setdefault(parent, [0, 0, 0])
+                delta[0] += totals[node]
+                delta[1] += files[node]
+                delta[2] = max(delta[2], newest[node])
+        for node, size, date, old_flags in changes:
+            if node >= first_new:
+                continue
+            delta = pending.setdefault(node, [0, 0, 0])
+            delta[0] += self.sizes[node] - size
+            delta[1] += (not flags[node] & FLAG_DIRECTORY) - (not old_flags & FLAG_DIRECTORY)
+            delta[2] = max(delta[2], self.dates[node])
+
+        # deepest first, so every ancestor is updated once with the sum of everything below it
+        heap = [-node for node in pending]
+        heapify(heap)
+        while heap:
+            node = -heappop(heap)
+            size, file_count, date = pending.pop(node)
+            totals[node] += size
+            files[node] += file_count
+            if date > newest[node]:
+                newest[node] = date
+            if node != VIRTUAL_ROOT:
+                parent = parents[node]
+                delta = pending.get(parent)
+                if delta is None:
+                    pending[parent] = [size, file_count, date]
+                    heappush(heap, -parent)
+                else:
+                    delta[0] += size
+                    delta[1] += file_count
+                    delta[2] = max(delta[2], date)
+
+    def total_size(self, node):
+        """Size of the node and everything below it, the node's own size if aggregate() was not run."""
+        return self.total_sizes[node] if self.aggregated else self.sizes[node]
+
+    def children_by_size(self, node):
+        """Children of node largest first, folders counting everything below them."""
+        if not self.aggregated:
+            self.aggregate()
+        return sorted(self.children(node), key=self.total_sizes.__getitem__, reverse=True)
+
+    # Tree API
+
+    def __len__(self):
+        return len(self.parents)
+
+    @property
+    def root(self):
+        """The archive's top level node, or the virtual root when there is more than one."""
+        first = self.first_child[VIRTUAL_ROOT]
+        if first != NO_NODE and self.next_sibling[first] == NO_NODE:
+            return first
+        return VIRTUAL_ROOT
+
+    def children(self, node):
+        children = []
+        child = self.first_child[node]
+        while child != NO_NODE:
+            children.append(child)
+            child = self.next_sibling[child]
+        children.reverse()
+        return children
+
+    def parent(self, node):
+        if node == self.root:
+            return None
+        parent = self.parents[node]
+        return None if parent == NO_NODE else parent
+
+    def is_leaf(self, node):
+        return self.first_child[node] == NO_NODE
+
+    def is_directory(self, node):
+        return bool(self.flags[node] & FLAG_DIRECTORY)
+
+    def name(self, node):
+        return self.names[self.name_ids[node]]
+
+    def full_path(self, node):
+        parts = []
+        while node > VIRTUAL_ROOT:
+            parts.append(self.names[self.name_ids[node]])
+            node = self.parents[node]
+        return "/".join(reversed(parts))
+
+    def file(self, node):
+        """File record of the node, a FileView reading the index, folders get the size of their contents."""
+        return FileView(self, node)
+
+    def find(self, full_path):
+        """Returns the node for `full_path` or None."""
+        lookup = self.lookup_table()
+        node = VIRTUAL_ROOT
+        for part in full_path.rstrip("/").split("/"):
+            name_id = self.name_table.get(part)
+            if name_id is None:
+                return None
+            node = lookup.get(node << 32 | name_id)
+            if node is None:
+                return None
+        return node
+
+    def drop_lookup(self):
+        """Frees the path lookup table once building is done, it is rebuilt on demand."""
+        self._lookup = None
+        self._indexed = None
+
+    def walk(self, node=None):
+        """Yields node ids depth first, parents before their children."""
+        stack = [self.root if node is None else node]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(self.children(node)))
+
+    # Saving
+
+    def show(self, node=None):
+        lines = []
+        stack = [(self.root if node is None else node, "", True, True)]
+        while stack:
+            node, prefix, is_last, is_top = stack.pop()
+            if is_top:
+                lines.append(self.name(node))
+                child_prefix = ""
+            else:
+                lines.append(prefix + ("└── " if is_last else "├── ") + self.name(node))
+                child_prefix = prefix + ("    " if is_last else "│   ")
+            children = self.children(node)
+            for i, child in enumerate(reversed(children)):
+                stack.append((child, child_prefix, i == 0, False))
+        return "\n".join(lines) + "\n"
+
+    def save2file(self, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(self.show())
+
+    def to_dict(self, node=None):
+        node = self.root if node is None else node
+        if self.is_leaf(node):
+            return self.name(node)
+        return {self.name(node): {"children": [self.to_dict(child) for child in self.children(node)]}}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
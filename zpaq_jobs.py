@@ -0,0 +1,172 @@
+"""Runs zpaqfranz extraction commands concurrently, with progress, per-job status and cancellation."""
+import os
+import threading
+from queue import Queue
+from time import perf_counter
+
+from zpaq_driver import ZpaqProcess, ZpaqError, STDERR_TAIL, collect
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+DEFAULT_JOBS = min(4, os.cpu_count() or 1)
+
+
+def partition_selection(selection, parts, by_directory=False):
+    """Splits (path, is_directory, size) entries into at most `parts` groups of similar total size.
+
+    With `by_directory` everything below the same top level directory (e.g. "C:/Users") stays in one
+    group, so each extraction only touches one part of the archive. Groups are balanced greedily,
+    largest first onto the currently smallest group.
+    """
+    units = {}
+    for entry in selection:
+        if by_directory:
+            key = "/".join(entry[0].split("/")[:2])
+        else:
+            key = entry[0]
+        units.setdefault(key, []).append(entry)
+
+    groups = [[] for _ in range(max(1, min(parts, len(units))))]
+    sizes = [0] * len(groups)
+    for unit in sorted(units.values(), key=lambda entries: sum(entry[2] for entry in entries), reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].extend(unit)
+        sizes[smallest] += sum(entry[2] for entry in unit)
+    return [group for group in groups if group]
+
+
+class ExtractionJob:
+    def __init__(self, command, entries):
+        self.command = command
+        self.entries = entries
+        self.size = sum(entry[2] for entry in entries)
+        self.status = PENDING
+        self.percent = 0  # as last reported by zpaqfranz while running
+        self.output = ""
+        self.started = None
+        self.finished = None
+        self.process = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or perf_counter()) - self.started
+
+    def __str__(self):
+        text = f"{self.status:>9}: {len(self.entries)} entries, {self.size / 1024**2:,.1f} MiB"
+        if self.status == DONE:
+            text += f" in {self.elapsed:.1f} s ({self.size / 1024**2 / max(self.elapsed, 1e-6):,.1f} MiB/s)"
+        elif self.started is not None:
+            text += f", {self.percent:.0f}% after {self.elapsed:.1f} s"
+        return text
+
+
+class ExtractionQueue:
+    """Runs submitted ExtractionJobs on `max_jobs` worker threads, one zpaqfranz process each.
+
+    `on_update(job)` is called whenever a job changes status, from the worker threads (or from the
+    thread calling cancel()).
+    """
+
+    def __init__(self, max_jobs=DEFAULT_JOBS, on_update=None):
+        self.max_jobs = max_jobs
+        self.on_update = on_update
+        self.jobs = []
+        self._queue = Queue()
+        self._lock = threading.RLock()  # on_update may call back into the queue
+        self._workers = []
+
+    def submit(self, jobs):
+        with self._lock:
+            self.jobs.extend(jobs)
+            for job in jobs:
+                self._queue.put(job)
+            while len(self._workers) < min(self.max_jobs, self._queue.qsize()):
+                worker = threading.Thread(target=self._work, daemon=True)
+                self._workers.append(worker)
+                worker.start()
+        return jobs
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if self._queue.empty():
+                    self._workers.remove(threading.current_thread())
+                    return
+                job = self._queue.get()
+                if job.status == CANCELLED:
+                    continue
+                job.status = RUNNING
+                job.started = perf_counter()
+                try:
+                    job.process = ZpaqProcess(job.command, progress=lambda percent, job=job: self._progress(job, percent))
+                except ZpaqError as e:  # zpaqfranz missing
+                    job.process = None
+                    job.output = str(e)
+            self._update(job)
+
+            ok = False
+            if job.process is not None:
+                try:
+                    # only the end of the log is kept, an extraction of many files prints a line for each
+                    job.output = collect(job.process, STDERR_TAIL, keep_tail=True).decode("utf-8", errors="replace")
+                    ok = True
+                except ZpaqError as e:
+                    job.output = str(e)
+            with self._lock:
+                job.finished = perf_counter()
+                if job.status != CANCELLED:
+                    job.status = DONE if ok else FAILED
+                    job.percent = 100 if ok else job.percent
+            self._update(job)
+
+    def _progress(self, job, percent):
+        if int(percent) != int(job.percent):  # one update per percent is plenty
+            job.percent = percent
+            self._update(job)
+
+    def _update(self, job):
+        if self.on_update is not None:
+            self.on_update(job)
+
+    def cancel(self, job=None):
+        """Cancels one job, or every job that has not finished yet."""
+        with self._lock:
+            for each in self.jobs if job is None else [job]:
+                if each.status == PENDING:
+                    each.status = CANCELLED
+                    self._update(each)
+                elif each.status == RUNNING:
+                    each.status = CANCELLED
+                    if each.process is not None and each.process.poll() is None:
+                        each.process.kill()
+
+    def progress(self):
+        """(extracted bytes, total bytes, finished jobs, total jobs), failed and cancelled jobs are finished too.
+
+        Running jobs count with the share zpaqfranz last reported.
+        """
+        with self._lock:
+            finished = [job for job in self.jobs if job.status in (DONE, FAILED, CANCELLED)]
+            extracted = sum(job.size for job in finished if job.status == DONE)
+            extracted += sum(job.size * job.percent // 100 for job in self.jobs if job.status == RUNNING)
+            return extracted, sum(job.size for job in self.jobs), len(finished), len(self.jobs)
+
+    @property
+    def busy(self):
+        with self._lock:
+            return any(job.status in (PENDING, RUNNING) for job in self.jobs)
+
+    def wait(self):
+        while True:
+            with self._lock:
+                workers = list(self._workers)
+            if not workers:
+                return
+            for worker in workers:
+                worker.join(0.5)  # a timeout keeps Ctrl+C working on Windows
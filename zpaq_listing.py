@@ -0,0 +1,636 @@
+"""Single pass parser for zpaqfranz `l -longpath -terse -csv` listings."""
+import io
+import os
+import re
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+from zpaq_index import ArchiveIndex, FLAG_DIRECTORY, NO_NODE, VIRTUAL_ROOT
+from zpaq_versions import DELETED, VERSION_PREFIX
+
+CHUNK_SIZE = 4 * 1024 * 1024
+PARALLEL_CHUNK_SIZE = 8 * 1024 * 1024
+PARALLEL_MIN_SIZE = 32 * 1024 * 1024  # smaller listings parse faster than worker processes start
+MAX_WORKERS = 8
+EPOCH = datetime(1970, 1, 1)
+SECOND = timedelta(seconds=1)
+DATE_CACHE_SIZE = 65536
+VERSIONS_PATTERN = re.compile(r"([0-9][0-9.]*)\s+versions?\b")
+
+
+class ListingParser:
+    """Feeds listing lines into an ArchiveIndex.
+
+    Listings are sorted by path, so consecutive entries nearly always share a directory. The parser
+    keeps the components and nodes of the last directory it saw on a stack, so the parent of a run
+    of sibling files is found with one string comparison, and a change of directory only looks up
+    the components that differ from the previous one.
+    """
+
+    def __init__(self, index: ArchiveIndex, history=None):
+        self.index = index
+        # for `l -all` listings, every path is prefixed with its version and recorded in the VersionHistory
+        self.history = history
+        self.lines = 0
+        self.entries = 0
+        self.versions = None
+        self._dir_path = None
+        self._dir_node = VIRTUAL_ROOT
+        self._stack_parts = []
+        self._stack_nodes = [VIRTUAL_ROOT]
+        self._attributes = {}
+        self._dates = {}  # date field -> epoch seconds, files of one archive share far fewer dates than there are
+        # merging into an existing index always needs the duplicate check
+        self._in_order = len(index) == 1
+        self._previous = ""
+        self.unindexed = 0
+        # when merging into an aggregated index, (node, old size, old date, old flags) of updated entries
+        self._first_new = len(index)
+        self.changes = [] if index.aggregated else None
+
+    def _resolve_directory(self, dir_path):
+        parts = dir_path.split("/")
+        stack_parts = self._stack_parts
+        stack_nodes = self._stack_nodes
+
+        common = 0
+        for old, new in zip(stack_parts, parts):
+            if old != new:
+                break
+            common += 1
+        del stack_parts[common:]
+        del stack_nodes[common + 1:]
+
+        directory = self.index.directory
+        node = stack_nodes[-1]
+        for part in parts[common:]:
+            node = directory(node, part)
+            stack_parts.append(part)
+            stack_nodes.append(node)
+
+        self._dir_path = dir_path
+        self._dir_node = node
+        return node
+
+    def _read_versions(self, line):
+        """Picks the archive's version count out of the summary zpaqfranz prints around the listing."""
+        match = VERSIONS_PATTERN.search(line)
+        if match:
+            self.versions = int(match.group(1).replace(".", ""))
+            self.index.versions = self.versions
+
+    @staticmethod
+    def _epoch(date):
+        try:
+            return (datetime.fromisoformat(date.strip("'")) - EPOCH) // SECOND
+        except ValueError:
+            return 0
+
+    def feed(self, lines):
+        """Parses a list of listing lines, anything that is not an entry is skipped."""
+        index = self.index
+        in_order = self._in_order
+        # merging into a built index only indexes the folders the listing touches
+        lookup = index.lookup_table() if in_order else index.partial_lookup()  # may reintern, so first
+        index_children = index.index_children
+        indexed = NO_NODE
+        intern = index.intern
+        intern_attribute = index.intern_attribute
+        name_table = index.name_table
+        names = index.names
+        names_append = names.append
+        resolve = self._resolve_directory
+        name_ids = index.name_ids
+        parents = index.parents
+        first_child = index.first_child
+        next_sibling = index.next_sibling
+        sizes = index.sizes
+        dates = index.dates
+        attribute_ids = index.attribute_ids
+        flags = index.flags
+        attribute_cache = self._attributes
+        changes = self.changes
+        history = self.history
+        version = 0
+        deleted = False
+        previous = self._previous
+        fromisoformat = datetime.fromisoformat
+        date_cache = self._dates
+
+        if in_order:
+            index.interned = False
+
+        skipped = 0
+        unindexed = 0
+        for line in lines:
+            # path is the last field and may itself contain commas
+            fields = line.split(",", 5)
+            if len(fields) != 6 or "-csv" in line:
+                if "version" in line:
+                    self._read_versions(line)
+                skipped += 1
+                continue
+            path = fields[5].strip("'\r\n")
+            if history is not None:
+                match = VERSION_PREFIX.match(path)
+                if match is None:
+                    skipped += 1
+                    continue
+                version = int(match.group(1))
+                path = path[match.end():]
+                if not path:  # the version itself, dated when it was made
+                    history.set_version_date(version, self._epoch(fields[0]))
+                    skipped += 1
+                    continue
+
+            # While paths arrive strictly increasing, every entry is new (a folder always sorts before
+            # its contents), so plain files can skip the duplicate check and the lookup table.
+            if in_order:
+                if path > previous:
+                    previous = path
+                else:
+                    in_order = False
+                    index.drop_lookup()
+                    lookup = index.lookup_table()
+                    name_table = index.name_table
+                    names = index.names
+                    names_append = names.append
+                    name_ids = index.name_ids
+
+            if path[-1:] == "/":
+                path = path.rstrip("/")
+            size = fields[2].strip("'")
+            try:
+                size = int(size)
+            except ValueError:
+                try:
+                    size = int(size.replace(".", ""))
+                except ValueError:
+                    skipped += 1
+                    continue
+
+            slash = path.rfind("/")
+            if slash == -1:
+                parent = VIRTUAL_ROOT
+            else:
+                dir_path = path[:slash]
+                parent = self._dir_node if dir_path == self._dir_path else resolve(dir_path)
+            if parent != indexed and not in_order:
+                index_children(parent)  # before interning the name, so it gets the id the table uses
+                indexed = parent
+
+            attribute = fields[1]
+            cached = attribute_cache.get(attribute)
+            if cached is None:
+                stripped = attribute.strip("'")
+                cached = attribute_cache[attribute] = (intern_attribute(stripped),
+                                                      FLAG_DIRECTORY if "D" in stripped else 0)
+            attribute_id, flag = cached
+
+            name = path[slash + 1:]
+            if in_order and not flag:
+                # file names are nearly all unique, a table entry per name costs more than it saves
+                name_id = len(names)
+                names_append(name)
+            else:
+                name_id = name_table.get(name)
+                if name_id is None:
+                    name_id = intern(name)
+
+            epoch = date_cache.get(fields[0])
+            if epoch is None:
+                try:
+                    epoch = (fromisoformat(fields[0].strip("'")) - EPOCH) // SECOND
+                except ValueError:
+                    epoch = 0
+                if len(date_cache) >= DATE_CACHE_SIZE:
+                    date_cache.clear()
+                date_cache[fields[0]] = epoch
+
+            if history is not None:
+                deleted = epoch == 0  # zpaq lists the version that removed a path without a date
+
+            node = None if in_order else lookup.get(parent << 32 | name_id)
+            if node is None:
+                node = len(parents)
+                name_ids.append(name_id)
+                parents.append(parent)
+                first_child.append(NO_NODE)
+                next_sibling.append(first_child[parent])
+                sizes.append(size)
+                dates.append(epoch)
+                attribute_ids.append(attribute_id)
+                flags.append(flag)
+                first_child[parent] = node
+                if flag or not in_order:
+                    lookup[parent << 32 | name_id] = node
+                else:
+                    unindexed += 1
+            elif not deleted:
+                if changes is not None:
+                    changes.append((node, sizes[node], dates[node], flags[node]))
+                sizes[node] = size
+                dates[node] = epoch
+                attribute_ids[node] = attribute_id
+                flags[node] = flag
+            if history is not None:
+                history.record(node, version, DELETED if deleted else size, epoch)
+
+        self._in_order = in_order
+        self.unindexed += unindexed
+        self._previous = previous
+        self.lines += len(lines)
+        self.entries += len(lines) - skipped
+
+    def close(self):
+        """Finishes parsing, the index's lookup table is dropped if files were left out of it.
+
+        Aggregates the index already had are brought up to date with what was merged.
+        """
+        if self.unindexed:
+            self.index.drop_lookup()
+        if self.history is not None:
+            self.history.close()
+        if self.changes is not None:
+            self.index.update_aggregates(self._first_new, self.changes)
+            self.changes = []
+            self._first_new = len(self.index)
+
+
+def parse_listing(index: ArchiveIndex, contents, chunk_size=CHUNK_SIZE, progress=None, lock=None, history=None):
+    """Parses a listing stream (or any iterable of lines) into `index`.
+
+    Streams with a read() method are consumed in `chunk_size` blocks rather than line by line.
+    `progress` is called with the number of lines handled after each block. When the index is read
+    from another thread while it is built, `lock` is held around each block (but not while waiting
+    for the stream). With a VersionHistory the listing is read as `l -all` output.
+    """
+    lock = lock or nullcontext()
+    parser = ListingParser(index, history)
+    if not hasattr(contents, "read"):
+        batch = []
+        for line in contents:
+            batch.append(line)
+            if len(batch) == 65536:
+                with lock:
+                    parser.feed(batch)
+                batch = []
+                if progress is not None:
+                    progress(65536)
+        with lock:
+            parser.feed(batch)
+            parser.close()
+        if progress is not None:
+            progress(len(batch))
+        return parser
+
+    pending = None
+    while True:
+        chunk = contents.read(chunk_size)
+        if not chunk:
+            break
+        lines, pending = split_lines(chunk, pending)
+        if lines is None:
+            continue
+        with lock:
+            parser.feed(lines)
+        if progress is not None:
+            progress(len(lines))
+    if pending:
+        if isinstance(pending, bytes):
+            pending = pending.decode("utf-8", errors="ignore")
+        with lock:
+            parser.feed([pending])
+        if progress is not None:
+            progress(1)
+    with lock:
+        parser.close()
+    return parser
+
+
+def split_lines(chunk, pending=None):
+    """Returns (lines, rest) for a block read from a listing, rest goes in front of the next block.
+
+    Only splits at the last newline so neither lines nor utf-8 sequences are cut in half, lines is
+    None while no newline has come yet.
+    """
+    if pending:
+        chunk = pending + chunk
+    binary = isinstance(chunk, bytes)
+    cut = chunk.rfind(b"\n" if binary else "\n")
+    if cut == -1:
+        return None, chunk
+    block = chunk[:cut].decode("utf-8", errors="ignore") if binary else chunk[:cut]
+    return block.split("\n"), chunk[cut + 1:]
+
+
+def default_workers():
+    return max(1, min(MAX_WORKERS, os.cpu_count() or 1))
+
+
+class PartialListing:
+    """The columns of one block of a listing, parsed into an index of its own by a worker process.
+
+    `chain` counts the run of nodes 0, 1, 2, ... each the parent of the next: the folders of the
+    block's first entry, the only nodes a sorted block can share with the blocks before it.
+    `before[c]` is the child of chain node c that is chained just ahead of chain node c + 1.
+    """
+
+    def __init__(self, index: ArchiveIndex, parser: ListingParser, first_path):
+        self.names = index.names
+        self.attributes = index.attributes
+        for column in ArchiveIndex.COLUMNS:
+            setattr(self, column, getattr(index, column))
+        self.lines = parser.lines
+        self.entries = parser.entries
+        self.versions = parser.versions
+        self.in_order = parser._in_order
+        self.first_path = first_path
+        self.last_path = parser._previous
+
+        parents = index.parents
+        chain = 1
+        while chain < len(parents) and parents[chain] == chain - 1:
+            chain += 1
+        self.chain = chain
+        self.before = array("i", [NO_NODE]) * chain
+        for node in range(chain - 1):
+            child = index.first_child[node]
+            while child != NO_NODE and index.next_sibling[child] != node + 1:
+                child = index.next_sibling[child]
+            self.before[node] = child
+
+    def __len__(self):
+        return len(self.parents)
+
+
+def parse_block(block):
+    """Worker side of parse_listing_parallel(): parses a block of whole lines into a PartialListing."""
+    lines = block.decode("utf-8", errors="ignore").split("\n")
+    index = ArchiveIndex()
+    parser = ListingParser(index)
+    parser.feed(lines)
+    parser.close()
+    first_path = None
+    for line in lines:
+        fields = line.split(",", 5)
+        if len(fields) == 6 and "-csv" not in line:
+            first_path = fields[5].strip("'\r\n")
+            break
+    return PartialListing(index, parser, first_path)
+
+
+def renumber_block(columns, table, name_offset, attribute_map):
+    """Worker side of parse_listing_parallel(): moves a block's node, name and attribute ids to their merged values.
+
+    `table[local node + 1]` is the merged node, slot 0 keeps NO_NODE as it is.
+    """
+    name_ids, parents, first_child, next_sibling, attribute_ids = columns
+    return (array("i", [name_id + name_offset for name_id in name_ids]),
+            array("i", [table[node + 1] for node in parents]),
+            array("i", [table[node + 1] for node in first_child]),
+            array("i", [table[node + 1] for node in next_sibling]),
+            array("H", [attribute_map[attribute_id] for attribute_id in attribute_ids]))
+
+
+class ParallelMerge:
+    """Merges PartialListings into one index in listing order, the same index parse_listing() builds.
+
+    While the blocks are sorted, a block only shares the folders of its first entry with what came
+    before, and those are folders of the previous block's last entry. Matching the two paths name by
+    name tells where every node of the block ends up before anything is merged, so the renumbering
+    runs in a worker too and merging is just appending columns. A block that is out of order is merged
+    one node at a time through the lookup table instead, and so are all after it.
+    """
+
+    def __init__(self, index: ArchiveIndex, pool=None):
+        self.index = index
+        self.pool = pool
+        self.ordered = len(index) == 1
+        self.last_path = ""
+        self.size = len(index)  # nodes and names once everything planned so far is merged
+        self.name_count = len(index.names)
+        self.spine = []  # (name, merged node, is folder) from the top level down to the last planned entry
+        self.lines = 0
+        self.entries = 0
+        self.versions = None
+        self.parsed = deque()
+        self.renumbering = deque()
+
+    # Pipeline
+
+    def submit(self, block):
+        self.parsed.append(self.pool.submit(parse_block, block))
+
+    def plan_next(self, progress=None, lock=nullcontext()):
+        """Takes the next parsed block and starts renumbering it, or merges it right away when it is out of order."""
+        part = self.parsed.popleft().result()
+        if part.versions is not None:
+            self.versions = part.versions
+        if len(part) == 1:  # nothing but lines around the listing
+            self.renumbering.append((part, None, 0, None))
+            return
+        plan = self._plan(part) if self.ordered else None
+        if plan is not None:
+            table, shared, name_offset, attribute_map = plan
+            columns = tuple(getattr(part, column)[shared:] for column in
+                            ("name_ids", "parents", "first_child", "next_sibling", "attribute_ids"))
+            future = self.pool.submit(renumber_block, columns, table, name_offset, attribute_map)
+            self.renumbering.append((part, table, shared, future))
+            return
+        self.ordered = False
+        while self.renumbering:
+            self.append_next(progress, lock)
+        with lock:
+            self._merge_nodes(part)
+            self._count(part)
+        if progress is not None:
+            progress(part.lines)
+
+    def append_next(self, progress=None, lock=nullcontext()):
+        part, table, shared, future = self.renumbering.popleft()
+        columns = future.result() if future is not None else None
+        with lock:
+            if columns is not None:
+                self._append(part, table, shared, columns)
+            self._count(part)
+        if progress is not None:
+            progress(part.lines)
+
+    def finish(self, progress=None, lock=nullcontext()):
+        while self.parsed:
+            self.plan_next(progress, lock)
+        while self.renumbering:
+            self.append_next(progress, lock)
+
+    def _count(self, part):
+        self.lines += part.lines
+        self.entries += part.entries
+        if self.versions is not None:
+            self.index.versions = self.versions
+
+    # Merging
+
+    def _plan(self, part: PartialListing):
+        """Returns (renumbering table, shared nodes, name offset, attribute map), None when the block is out of order."""
+        if not part.in_order or part.first_path is None or part.first_path <= self.last_path:
+            return None
+        # folders of the block's first entry that were already merged
+        matched = array("i", [VIRTUAL_ROOT])
+        for node, (name, existing, folder) in zip(range(1, part.chain), self.spine):
+            if not folder or not part.flags[node] & FLAG_DIRECTORY or part.names[part.name_ids[node]] != name:
+                break
+            matched.append(existing)
+        shared = len(matched)
+        base = self.size
+        table = array("i", [NO_NODE]) + matched + array("i", range(base, base + len(part) - shared))
+        attribute_map = array("H", (self.index.intern_attribute(attribute) for attribute in part.attributes))
+        name_offset = self.name_count
+
+        spine = []
+        node = len(part) - 1
+        while node > VIRTUAL_ROOT:
+            spine.append((part.names[part.name_ids[node]], table[node + 1], bool(part.flags[node] & FLAG_DIRECTORY)))
+            node = part.parents[node]
+        spine.reverse()
+        self.spine = spine
+        self.size += len(part) - shared
+        self.name_count += len(part.names)
+        self.last_path = part.last_path
+        return table, shared, name_offset, attribute_map
+
+    def _append(self, part: PartialListing, table, shared, columns):
+        index = self.index
+        new = slice(shared, None)
+        name_ids, parents, first_child, next_sibling, attribute_ids = columns
+        index.names.extend(part.names)
+        index.name_ids.extend(name_ids)
+        index.parents.extend(parents)
+        index.first_child.extend(first_child)
+        index.next_sibling.extend(next_sibling)
+        index.sizes.extend(part.sizes[new])
+        index.dates.extend(part.dates[new])
+        index.attribute_ids.extend(attribute_ids)
+        index.flags.extend(part.flags[new])
+
+        # put the block's new children of every shared folder in front of the ones it already had
+        first_child = index.first_child
+        next_sibling = index.next_sibling
+        for node in range(shared):
+            newest = part.first_child[node]
+            if node + 1 < shared:
+                if newest == node + 1:
+                    continue  # only the shared child
+                oldest = part.before[node]
+            else:
+                if newest == NO_NODE:
+                    continue
+                # the chain's next node is the first child the block gave this folder
+                oldest = node + 1 if node + 1 < part.chain else self._oldest_child(part, node)
+            existing = table[node + 1]
+            next_sibling[table[oldest + 1]] = first_child[existing]
+            first_child[existing] = table[newest + 1]
+
+        index.interned = False
+        index.drop_lookup()
+
+    @staticmethod
+    def _oldest_child(part, node):
+        child = part.first_child[node]
+        while part.next_sibling[child] != NO_NODE:
+            child = part.next_sibling[child]
+        return child
+
+    def _merge_nodes(self, part: PartialListing):
+        index = self.index
+        lookup = index.lookup_table()
+        nodes = array("i", [NO_NODE]) * len(part)
+        nodes[VIRTUAL_ROOT] = VIRTUAL_ROOT
+        for node in range(1, len(part)):
+            parent = nodes[part.parents[node]]
+            name_id = index.intern(part.names[part.name_ids[node]])
+            attribute_id = part.attribute_ids[node]
+            size = part.sizes[node]
+            date = part.dates[node]
+            flag = part.flags[node]
+            existing = lookup.get(parent << 32 | name_id)
+            if existing is None:
+                existing = index._new_node(parent, name_id, size, date,
+                                           index.intern_attribute(part.attributes[attribute_id]), flag)
+            elif not (flag and attribute_id == 0 and size == 0 and date == 0):  # not just a folder on the way
+                index.sizes[existing] = size
+                index.dates[existing] = date
+                index.attribute_ids[existing] = index.intern_attribute(part.attributes[attribute_id])
+                index.flags[existing] = flag
+            nodes[node] = existing
+
+
+def line_blocks(contents, chunk_size, buffered=()):
+    """Yields blocks of whole lines from a binary stream, starting with the already read `buffered` chunks."""
+    pending = b""
+    chunks = iter(buffered)
+    while True:
+        chunk = next(chunks, None)
+        if chunk is None:
+            chunk = contents.read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        cut = pending.rfind(b"\n")
+        if cut != -1:
+            yield pending[:cut + 1]
+            pending = pending[cut + 1:]
+    if pending:
+        yield pending
+
+
+def parse_listing_parallel(index: ArchiveIndex, contents, workers=None, chunk_size=PARALLEL_CHUNK_SIZE,
+                           progress=None, lock=None):
+    """parse_listing() for large listings, with the parsing split over `workers` processes.
+
+    The stream is cut into blocks of whole lines that workers parse into columns of their own, and the
+    blocks are merged in listing order, so the index comes out the same however the work was split.
+    Listings under PARALLEL_MIN_SIZE, merges into a non empty index and text streams are parsed here.
+    """
+    workers = workers or default_workers()
+    if workers <= 1 or len(index) != 1:
+        return parse_listing(index, contents, progress=progress, lock=lock)
+    buffered = []
+    size = 0
+    while size < PARALLEL_MIN_SIZE:
+        chunk = contents.read(chunk_size)
+        if not chunk:
+            break
+        buffered.append(chunk)
+        size += len(chunk)
+    if size < PARALLEL_MIN_SIZE or not isinstance(buffered[0], bytes):
+        empty = buffered[0][:0] if buffered else b""
+        read = io.BytesIO(empty.join(buffered)) if isinstance(empty, bytes) else io.StringIO(empty.join(buffered))
+        return parse_listing(index, _Chained(read, contents), progress=progress, lock=lock)
+
+    lock = lock or nullcontext()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        merger = ParallelMerge(index, pool)
+        for block in line_blocks(contents, chunk_size, buffered):
+            merger.submit(block)
+            # enough blocks in flight to keep every worker busy, without reading far ahead of them
+            if len(merger.parsed) >= workers:
+                merger.plan_next(progress, lock)
+            if len(merger.renumbering) >= workers:
+                merger.append_next(progress, lock)
+        merger.finish(progress, lock)
+    return merger
+
+
+class _Chained:
+    """Reads one stream to its end, then another."""
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    def read(self, size=-1):
+        return self.first.read(size) or self.second.read(size)
@@ -0,0 +1,263 @@
+"""Counters, latency histograms and opt-in profilers for finding out where the time goes.
+
+Everything is off unless asked for, and a disabled timer costs one attribute check:
+
+    with metrics.timer("parse"):
+        ...
+    metrics.count("read_bytes", len(data))
+
+Turn it on with --metrics [SECONDS] (or ZTV_METRICS=1 / ZTV_METRICS=SECONDS) to get a table of calls,
+errors and latency percentiles per operation when the program exits, or every SECONDS while it runs.
+--profile FILE runs cProfile over the whole program (ZTV_PROFILE=FILE), --sample FILE samples the
+stacks of every thread instead and writes them collapsed for flame graph tools (ZTV_SAMPLE=FILE).
+"""
+import atexit
+import cProfile
+import os
+import sys
+import threading
+import traceback
+from collections import Counter
+from contextlib import nullcontext
+from functools import wraps
+from time import perf_counter
+
+METRICS_ENV = "ZTV_METRICS"
+PROFILE_ENV = "ZTV_PROFILE"
+SAMPLE_ENV = "ZTV_SAMPLE"
+BUCKETS = 48  # bucket b holds latencies below 2**b microseconds
+SAMPLE_INTERVAL = 0.005
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+    """Call count, errors and a power of two latency histogram of one operation."""
+
+    __slots__ = ("calls", "errors", "total", "max", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds, ok=True):
+        self.calls += 1
+        if not ok:
+            self.errors += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(BUCKETS - 1, int(seconds * 1e6).bit_length())] += 1
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the percentile, in seconds."""
+        rank = self.calls * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(self.max, 2 ** bucket / 1e6)
+        return self.max
+
+
+class Metrics:
+    """Per operation histograms and plain counters, shared by every thread."""
+
+    def __init__(self):
+        self.enabled = False
+        self.operations = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        self._started = perf_counter()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self._lock:
+            self.operations = {}
+            self.counters = Counter()
+            self._started = perf_counter()
+
+    def record(self, name, seconds, ok=True):
+        with self._lock:
+            histogram = self.operations.get(name)
+            if histogram is None:
+                histogram = self.operations[name] = Histogram()
+            histogram.add(seconds, ok)
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += amount
+
+    def timer(self, name):
+        """Context manager recording how long its block takes, and whether it raised."""
+        return _Timer(self, name) if self.enabled else nullcontext()
+
+    def timed(self, name=None):
+        """Decorator form of timer(), named after the function by default."""
+        def decorate(fn):
+            label = name or fn.__name__
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start = perf_counter()
+                ok = False
+                try:
+                    result = fn(*args, **kwargs)
+                    ok = True
+                    return result
+                finally:
+                    self.record(label, perf_counter() - start, ok)
+            return wrapper
+        return decorate
+
+    def report(self):
+        with self._lock:
+            operations = sorted(self.operations.items(), key=lambda item: -item[1].total)
+            counters = sorted(self.counters.items())
+        lines = [f"Metrics after {perf_counter() - self._started:,.1f} s"]
+        if operations:
+            lines.append(f"{'operation':<24} {'calls':>9} {'errors':>7} {'total s':>9} "
+                         + " ".join(f"{f'p{percent} ms':>9}" for percent in PERCENTILES) + f" {'max ms':>9}")
+        for name, histogram in operations:
+            lines.append(f"{name:<24} {histogram.calls:>9,} {histogram.errors:>7,} {histogram.total:>9.3f} "
+                         + " ".join(f"{histogram.percentile(percent) * 1e3:>9.3f}" for percent in PERCENTILES)
+                         + f" {histogram.max * 1e3:>9.3f}")
+        for name, value in counters:
+            lines.append(f"{name:<24} {value:>9,}")
+        return "\n".join(lines)
+
+    def dump(self, file=None):
+        print(self.report(), file=file or sys.stderr, flush=True)
+
+    def dump_every(self, seconds, file=None):
+        """Dumps the report every `seconds` from a daemon thread, returns an Event that stops it."""
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(seconds):
+                self.dump(file)
+
+        threading.Thread(target=run, daemon=True, name="metrics").start()
+        return stop
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self.name, perf_counter() - self.start, exc_type is None)
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread every `interval` seconds from a background thread.
+
+    Unlike cProfile it adds no cost to the calls themselves, so it suits finding hot spots in a whole
+    session (e.g. a mounted archive). write() saves "frame;frame;frame count" lines, the collapsed
+    format flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="sampler")
+        self._thread.start()
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == own:
+                    continue
+                stack = ";".join(f"{os.path.basename(entry.filename)}:{entry.name}"
+                                 for entry in traceback.extract_stack(frame))
+                self.stacks[stack] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+metrics = Metrics()
+
+
+def start_profiler(filename):
+    """Runs cProfile until the program exits, then saves its stats to `filename` (see pstats)."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def save():
+        profiler.disable()
+        profiler.dump_stats(filename)
+        print(f"Profile written to {filename}", file=sys.stderr)
+
+    atexit.register(save)
+    return profiler
+
+
+def start_sampler(filename, interval=SAMPLE_INTERVAL):
+    sampler = SamplingProfiler(interval).start()
+
+    def save():
+        sampler.stop()
+        sampler.write(filename)
+        print(f"Stack samples written to {filename}", file=sys.stderr)
+
+    atexit.register(save)
+    return sampler
+
+
+def start_metrics(every=None, file=None):
+    """Enables metrics and dumps them at exit, and every `every` seconds when given."""
+    metrics.enable()
+    if every:
+        metrics.dump_every(every, file)
+    atexit.register(metrics.dump, file)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics", nargs="?", type=float, const=0, default=None, metavar="SECONDS",
+                        help="print calls and latency percentiles per operation at exit (and every SECONDS)")
+    parser.add_argument("--profile", default=None, metavar="FILE", help="write a cProfile of the whole run to FILE")
+    parser.add_argument("--sample", default=None, metavar="FILE",
+                        help="sample every thread's stack and write them collapsed to FILE, for flame graphs")
+
+
+def metrics_from_args(args=None):
+    """Starts whatever --metrics/--profile/--sample or the ZTV_* environment variables ask for."""
+    every = getattr(args, "metrics", None)
+    if every is None and os.environ.get(METRICS_ENV):
+        every = float(os.environ[METRICS_ENV]) if os.environ[METRICS_ENV] != "1" else 0
+    if every is not None:
+        start_metrics(every)
+    profile = getattr(args, "profile", None) or os.environ.get(PROFILE_ENV)
+    if profile:
+        start_profiler(profile)
+    sample = getattr(args, "sample", None) or os.environ.get(SAMPLE_ENV)
+    if sample:
+        start_sampler(sample)
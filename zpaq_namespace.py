@@ -0,0 +1,186 @@
+"""Resolves the paths WinFsp asks about against an ArchiveIndex, for zpaq_fileexplorer.py.
+
+Nothing is created per archived entry up front: a folder's children are sorted by name the first time
+it is looked into (and only the most recently used folders are kept that way), and an Entry exists
+only while a handle to it is open. Independent of winfspy, so it can be used and tested anywhere.
+"""
+from bisect import bisect_left, bisect_right
+import threading
+from collections import OrderedDict
+from time import time
+
+from zpaq_index import ArchiveIndex, VIRTUAL_ROOT
+
+# Win32 FILE_ATTRIBUTE_* values, the same as winfspy's FILE_ATTRIBUTE enum
+FILE_ATTRIBUTE_READONLY = 0x1
+FILE_ATTRIBUTE_DIRECTORY = 0x10
+FILE_ATTRIBUTE_ARCHIVE = 0x20
+EPOCH_AS_FILETIME = 116444736000000000  # 1970-01-01 in 100 ns intervals since 1601-01-01
+MAX_FOLDERS = 4096
+
+
+def filetime(epoch):
+    return EPOCH_AS_FILETIME + epoch * 10**7
+
+
+def split_path(file_name):
+    r"""Path components of a WinFsp file name like "\Users\me\file.txt", the volume root is []."""
+    return [part for part in file_name.replace("\\", "/").split("/") if part]
+
+
+class Entry:
+    """What an open handle needs of one node, made on open and dropped on close."""
+
+    __slots__ = ("namespace", "node", "path", "is_directory", "file_size", "info", "handles")
+
+    def __init__(self, namespace, node, path, is_directory, file_size, info):
+        self.namespace = namespace  # node is a node of this namespace's index
+        self.node = node
+        self.path = path  # path in the archive, what zpaqfranz extracts
+        self.is_directory = is_directory
+        self.file_size = file_size
+        self.info = info
+        self.handles = 0
+
+    def get_file_info(self):
+        return self.info
+
+    def __repr__(self):
+        return f"{type(self).__name__}:{self.path}"
+
+
+class IndexNamespace:
+    """The archive's folders and files as a read-only volume, the index's root at the volume root.
+
+    When the archive has several top level entries (drives) each becomes a folder at the volume root,
+    named without its colon ("C:" shows as "C", a POSIX "/" as "_") since Windows names cannot hold one.
+
+    Safe to use from many threads at once: the index is only read, and the folder cache and open
+    entries are guarded by a lock held just long enough to look them up or change them.
+    """
+
+    def __init__(self, index: ArchiveIndex = None, max_folders=MAX_FOLDERS):
+        self.index = index if index is not None else ArchiveIndex()
+        self.root = self.index.root
+        self.max_folders = max_folders
+        self.mounted = int(time())  # shown for entries without a date, e.g. folders zpaqfranz did not list
+        self._folders = OrderedDict()  # node -> (sorted names, their nodes), least recently used first
+        self._open = {}  # node -> Entry, for every node with an open handle
+        self._lock = threading.Lock()
+
+    # Looking up
+
+    def display_name(self, node):
+        name = self.index.name(node)
+        if self.index.parents[node] == VIRTUAL_ROOT and self.root == VIRTUAL_ROOT:
+            return name.replace(":", "") or "_"
+        return name
+
+    def folder(self, node):
+        """(names, nodes) of the folder's children sorted by name, kept for the most recently used folders."""
+        with self._lock:
+            listing = self._folders.get(node)
+            if listing is not None:
+                self._folders.move_to_end(node)
+                return listing
+        # sorted outside the lock, two threads sorting the same folder at once both get a correct listing
+        children = sorted((self.display_name(child), child) for child in self.index.children(node))
+        listing = [name for name, _ in children], [child for _, child in children]
+        with self._lock:
+            self._folders[node] = listing
+            while len(self._folders) > self.max_folders:
+                self._folders.popitem(last=False)
+        return listing
+
+    def child(self, node, name):
+        names, nodes = self.folder(node)
+        position = bisect_left(names, name)
+        if position < len(names) and names[position] == name:
+            return nodes[position]
+        return None
+
+    def resolve(self, file_name):
+        """Node of a WinFsp file name, None when the archive has no such path."""
+        node = self.root
+        for part in split_path(file_name):
+            if not self.is_directory(node):
+                return None
+            node = self.child(node, part)
+            if node is None:
+                return None
+        return node
+
+    def parent(self, node):
+        return node if node == self.root else self.index.parents[node]
+
+    def is_directory(self, node):
+        return self.index.is_directory(node)
+
+    # What WinFsp is told
+
+    def file_size(self, node):
+        return 0 if self.is_directory(node) else self.index.sizes[node]
+
+    def attributes(self, node):
+        if self.is_directory(node):
+            return FILE_ATTRIBUTE_DIRECTORY | FILE_ATTRIBUTE_READONLY
+        return FILE_ATTRIBUTE_ARCHIVE | FILE_ATTRIBUTE_READONLY
+
+    def file_info(self, node):
+        date = self.index.dates[node] or self.mounted
+        stamp = filetime(date)
+        return {
+            "file_attributes": self.attributes(node),
+            "allocation_size": 0,
+            "file_size": self.file_size(node),
+            "creation_time": stamp,
+            "last_access_time": stamp,
+            "last_write_time": stamp,
+            "change_time": stamp,
+            "index_number": node,
+        }
+
+    def read_directory(self, node, marker=None):
+        """File info dicts of the folder's entries after `marker` (a name, "." or ".."), see WinFsp's ReadDirectory."""
+        entries = []
+        # "." and ".." only below the volume root
+        if node != self.root:
+            entries.append({"file_name": ".", **self.file_info(node)})
+            entries.append({"file_name": "..", **self.file_info(self.parent(node))})
+        names, nodes = self.folder(node)
+        if marker is None:
+            start = 0
+        elif marker == ".":
+            entries = entries[1:]
+            start = 0
+        elif marker == "..":
+            entries = []
+            start = 0
+        else:
+            entries = []
+            start = bisect_right(names, marker)
+        for position in range(start, len(names)):
+            entries.append({"file_name": names[position], **self.file_info(nodes[position])})
+        return entries
+
+    # Handles
+
+    def open(self, node):
+        """Entry for a new handle to node, shared by every handle open on it."""
+        with self._lock:
+            entry = self._open.get(node)
+            if entry is None:
+                entry = self._open[node] = Entry(self, node, self.index.full_path(node), self.is_directory(node),
+                                                 self.file_size(node), self.file_info(node))
+            entry.handles += 1
+            return entry
+
+    def close(self, entry):
+        with self._lock:
+            entry.handles -= 1
+            if entry.handles <= 0:
+                del self._open[entry.node]
+
+    def open_handles(self):
+        with self._lock:
+            return sum(entry.handles for entry in self._open.values())
@@ -0,0 +1,220 @@
+"""Background extraction of the small files in the folder being browsed on a mounted archive.
+
+Opening a folder of photos makes Explorer read every file for its thumbnail, one `zpaqfranz x -stdout`
+each. The Prefetcher extracts the folder's small files with a few batched `zpaqfranz x` runs instead and
+puts them in the BlockCache, where the reads then find them. A read of a file in the batch being
+extracted waits for it rather than starting a zpaqfranz of its own, files of later batches are read the
+usual way until their batch starts. With a ContentCache the extracted files are also kept there for
+later sessions.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import zpaqtreeview as ztv
+from zpaq_cache import BlockCache
+from zpaq_driver import ZpaqError, STDERR_TAIL, collect
+from zpaq_metrics import metrics
+
+DEFAULT_BUDGET = 64 * 1024**2
+DEFAULT_FILE_SIZE = 4 * 1024**2
+DEFAULT_BATCH_SIZE = 16 * 1024**2
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """Extracts the small files of the most recently requested folder on one background thread.
+
+    Files up to `max_file_size` are taken in name order as long as they fit in `budget` bytes, skipping
+    ones already cached, and extracted `batch_size` bytes per zpaqfranz run. Requesting another folder
+    kills the running zpaqfranz, only the newest folder is worth it.
+    """
+
+    def __init__(self, config, zpaq_file, cache: BlockCache, location, budget=DEFAULT_BUDGET,
+                 max_file_size=DEFAULT_FILE_SIZE, content=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.config = config
+        self.zpaq_file = zpaq_file
+        self.cache = cache
+        self.content = content
+        self.location = location  # extracted files wait here until they are in the cache
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._extracted = threading.Condition(self._lock)  # notified when _pending shrinks
+        self._wake = threading.Event()
+        self._wanted = None  # (namespace, folder node) of the newest request
+        self._selection = []  # what select() chose for it
+        self._dates = {}  # path -> listed date of the selected files
+        self._pending = set()  # paths of the running batch not in the cache yet
+        self._process = None  # zpaqfranz extracting for it
+        self._thread = None
+        self._closed = False
+
+    def request(self, namespace, folder):
+        """Prefetches the folder's small files, instead of whatever folder was requested before."""
+        if self.budget <= 0:
+            return
+        with self._lock:
+            if self._closed or self._wanted == (namespace, folder):
+                return
+        selection, dates = self.select(namespace, folder)
+        with self._lock:
+            if self._closed or self._wanted == (namespace, folder):
+                return
+            self._wanted = (namespace, folder)
+            self._selection = selection
+            self._dates = dates
+            self._set_pending(())
+            self._cancel()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="prefetch")
+                self._thread.start()
+        self._wake.set()
+
+    def wait(self, path):
+        """Waits until the running batch, if `path` is in it, has put the file in the cache or given up."""
+        with self._lock:
+            if path not in self._pending:
+                return
+            metrics.count("prefetch_waits")
+            while path in self._pending:
+                self._extracted.wait()
+
+    def _set_pending(self, paths):
+        self._pending = set(paths)
+        self._extracted.notify_all()
+
+    def _cancel(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            metrics.count("prefetch_cancelled")
+        self._process = None
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._set_pending(())
+            self._cancel()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                if self._closed:
+                    return
+                wanted = self._wanted
+                selection = self._selection
+                dates = self._dates
+            try:
+                self._prefetch(wanted, selection, dates)
+            except Exception as e:  # a failed prefetch only means slower reads
+                logger.error("Prefetching failed: %s", e)
+            finally:
+                with self._lock:
+                    if self._wanted == wanted:
+                        self._set_pending(())
+
+    def select(self, namespace, folder):
+        """(path, False, size) entries of the folder's files worth prefetching (see extraction_batches()) and their dates."""
+        index = namespace.index
+        selection = []
+        dates = {}
+        total = 0
+        for node in namespace.folder(folder)[1]:
+            size = index.sizes[node]
+            if index.is_directory(node) or not 0 < size <= self.max_file_size or total + size > self.budget:
+                continue
+            path = index.full_path(node)
+            if (path, 0) in self.cache or (self.content is not None
+                                           and (self.zpaq_file, path, size, index.dates[node], None) in self.content):
+                continue
+            selection.append((path, False, size))
+            dates[path] = index.dates[node]
+            total += size
+        return selection, dates
+
+    def _current(self, wanted):
+        with self._lock:
+            return not self._closed and self._wanted == wanted
+
+    def _prefetch(self, wanted, selection, dates):
+        if not selection:
+            return
+        os.makedirs(self.location, exist_ok=True)
+        directory = tempfile.mkdtemp(prefix="prefetch-", dir=self.location)
+        try:
+            for command, entries in self._batches(selection, directory):
+                with self._lock:
+                    if self._closed or self._wanted != wanted:
+                        return  # moved on to another folder
+                    self._set_pending(path for path, _, _ in entries)
+                    self._process = process = ztv.zpaq(self.config).start(command)
+                metrics.count("prefetch_runs")
+                try:
+                    with metrics.timer("prefetch"):
+                        collect(process, STDERR_TAIL, keep_tail=True)
+                except ZpaqError:
+                    if not self._current(wanted):
+                        return  # killed by request() or close()
+                    raise
+                finally:
+                    with self._lock:
+                        self._process = None
+                self._load(directory, entries, dates, wanted)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _batches(self, selection, directory):
+        """extraction_batches() of `batch_size` bytes of the selection at a time."""
+        start = total = 0
+        for end, (_, _, size) in enumerate(selection):
+            if total + size > self.batch_size and end > start:
+                yield from ztv.extraction_batches(self.config, self.zpaq_file, selection[start:end], directory)
+                start, total = end, 0
+            total += size
+        yield from ztv.extraction_batches(self.config, self.zpaq_file, selection[start:], directory)
+
+    def _loaded(self, path, wanted):
+        with self._lock:
+            if self._wanted == wanted:
+                self._pending.discard(path)
+                self._extracted.notify_all()
+
+    def _load(self, directory, entries, dates, wanted):
+        """Moves the extracted files into the cache, block by block like BlockReader reads them, and the ContentCache.
+
+        Each file stops being pending as soon as it is in, a read waiting for it goes on without the rest of the batch.
+        """
+        for path, _, size in entries:
+            try:
+                self._load_file(os.path.join(directory, path.split("/")[-1]), path, size, dates)
+            finally:
+                self._loaded(path, wanted)
+
+    def _load_file(self, filename, path, size, dates):
+        block_size = self.cache.block_size
+        try:
+            f = open(filename, "rb")
+        except OSError:
+            return  # not extracted, it is read the usual way
+        with f:
+            block = 0
+            while True:
+                chunk = f.read(block_size)
+                if chunk and (path, block) not in self.cache:
+                    self.cache.put(path, block, chunk)
+                metrics.count("prefetch_bytes", len(chunk))
+                if len(chunk) < block_size:
+                    break
+                block += 1
+        if self.content is not None:
+            self.content.store_file(filename, self.zpaq_file, path, size, dates[path], move=True)
+        metrics.count("prefetch_files")
@@ -0,0 +1,232 @@
+"""Substring, glob and regex search over the paths of an ArchiveIndex."""
+import json
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_right
+
+from zpaq_index import ArchiveIndex, NO_NODE, VIRTUAL_ROOT
+
+MAGIC = b"ZTVSRCH1"
+EXTENSION = ".ztvsrch"
+REGEX_PREFIX = "re:"
+GLOB_CHARACTERS = "*?["
+
+
+def glob_to_regex(pattern):
+    """Translates a glob into a regex for one line of a search buffer.
+
+    `*` and `?` stay within one path component and `**` crosses them. A pattern with a `/` may start at
+    any component boundary, so "docs/*.pdf" finds ".../docs/a.pdf".
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**", i):
+            parts.append("[^\n]*")
+            i += 2
+            continue
+        if char == "*":
+            parts.append("[^/\n]*")
+        elif char == "?":
+            parts.append("[^/\n]")
+        elif char == "[":
+            end = pattern.find("]", i + 2 if pattern[i + 1:i + 2] in ("!", "]") else i + 1)
+            if end == -1:
+                parts.append(re.escape(char))
+            else:
+                body = pattern[i + 1:end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                parts.append(f"[{body}]")
+                i = end
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    start = "(?:^|/)" if "/" in pattern else "^"
+    return re.compile(start + "".join(parts) + "$", re.MULTILINE)
+
+
+def glob_literal(pattern):
+    """Longest run of plain characters in a glob, found with str.find before the regex has to run."""
+    return max(re.split(r"\*+|\?|\[!?\]?[^]]*\]", pattern), key=len)
+
+
+class SearchIndex:
+    """Lowercased names of every node in one contiguous buffer, one line per node id.
+
+    Plain substring queries run str.find over the buffer, which scans at memchr speed and needs no
+    posting lists, and skip straight to the next line after each hit. Queries that involve directories
+    (a `/`, a glob with a `/` or a regex) scan a second buffer of full paths, built the first time one
+    is needed.
+    """
+
+    def __init__(self, index: ArchiveIndex):
+        self.index = index
+        self.nodes = len(index)
+        names = index.names
+        name_ids = index.name_ids
+        lines = [names[name_ids[node]].lower() for node in range(self.nodes)]
+        self.starts = self._starts(lines)
+        self.text = "\n".join(lines) + "\n"
+        self._path_text = None
+        self._path_starts = None
+
+    @staticmethod
+    def _starts(lines):
+        starts = array("q", [0])
+        offset = 0
+        for line in lines:
+            offset += len(line) + 1
+            starts.append(offset)
+        return starts
+
+    @property
+    def stale(self):
+        """True once the index has grown past what was indexed, e.g. while a listing is still loading."""
+        return len(self.index) != self.nodes
+
+    def _paths(self):
+        if self._path_text is None:
+            names = self.index.names
+            name_ids = self.index.name_ids
+            parents = self.index.parents
+            # parents always get lower node ids than their children, so one pass builds every path
+            paths = [""] * self.nodes
+            for node in range(1, self.nodes):
+                parent = parents[node]
+                name = names[name_ids[node]].lower()
+                paths[node] = name if parent == VIRTUAL_ROOT or parent == NO_NODE else paths[parent] + "/" + name
+            self._path_starts = self._starts(paths)
+            self._path_text = "\n".join(paths) + "\n"
+        return self._path_text, self._path_starts
+
+    def search(self, query, limit=None):
+        """Yields matching node ids in index order as they are found.
+
+        `query` is a case insensitive substring, a glob when it contains any of `*?[`, or a regex when
+        it starts with "re:". Everything but a plain substring without a `/` matches against full paths.
+        """
+        if query.startswith(REGEX_PREFIX):
+            matches = self._scan(re.compile(query[len(REGEX_PREFIX):], re.MULTILINE | re.IGNORECASE), *self._paths())
+        elif any(char in query for char in GLOB_CHARACTERS):
+            pattern = glob_to_regex(query.lower())
+            literal = glob_literal(query.lower())
+            if "/" in query:
+                matches = self._scan(pattern, *self._paths(), literal)
+            else:
+                matches = self._scan(pattern, self.text, self.starts, literal)
+        elif "/" in query:
+            matches = self._find(query.lower(), *self._paths())
+        else:
+            matches = self._find(query.lower(), self.text, self.starts)
+
+        for count, node in enumerate(matches, 1):
+            yield node
+            if count == limit:
+                return
+
+    def _find(self, query, text, starts):
+        if not query or "\n" in query:
+            return
+        position = text.find(query)
+        while position != -1:
+            node = bisect_right(starts, position) - 1
+            if node != VIRTUAL_ROOT:
+                yield node
+            position = text.find(query, starts[node + 1])
+
+    def _scan(self, pattern, text, starts, literal=""):
+        """Yields the nodes whose line matches pattern, only trying lines that contain `literal`."""
+        position = 0
+        end = len(text)
+        while position < end:
+            if literal:
+                found = text.find(literal, position)
+                if found == -1:
+                    return
+                node = bisect_right(starts, found) - 1
+                match = pattern.search(text, starts[node], starts[node + 1] - 1)
+            else:
+                match = pattern.search(text, position)
+                if match is None:
+                    return
+                node = bisect_right(starts, match.start()) - 1
+                if node >= self.nodes:  # an empty match after the last line
+                    return
+                if match.end() >= starts[node + 1]:
+                    # the match ran on into the next line, only count it if the line matches by itself
+                    match = pattern.search(text, starts[node], starts[node + 1] - 1)
+            if match is not None and node != VIRTUAL_ROOT:
+                yield node
+            position = starts[node + 1]
+
+    # Saving
+
+    def save(self, filename, identity=None):
+        """Writes the index to `filename`, `identity` is that of the cached listing it was built from."""
+        text = self.text.encode("utf-8", errors="surrogatepass")
+        header = json.dumps({"nodes": self.nodes, "text": len(text), "byteorder": sys.byteorder,
+                             "identity": identity}).encode("utf-8")
+        temp = filename + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, "little"))
+            f.write(header)
+            f.write(text)
+            f.write(self.starts.tobytes())
+        os.replace(temp, filename)
+
+    @classmethod
+    def load(cls, filename, index: ArchiveIndex, identity=None):
+        """Inverse of save, returns None when the file is missing, corrupt or was built for another listing."""
+        try:
+            with open(filename, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    return None
+                header = json.loads(f.read(int.from_bytes(f.read(8), "little")))
+                if header.get("identity") != identity or header["nodes"] != len(index):
+                    return None
+                text = f.read(header["text"]).decode("utf-8", errors="surrogatepass")
+                starts = array("q")
+                starts.frombytes(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+        if header["byteorder"] != sys.byteorder:
+            starts.byteswap()
+        if len(starts) != header["nodes"] + 1:
+            return None
+        search = cls.__new__(cls)
+        search.index = index
+        search.nodes = header["nodes"]
+        search.text = text
+        search.starts = starts
+        search._path_text = None
+        search._path_starts = None
+        return search
+
+
+def load_search_index(index: ArchiveIndex, cache=None, archive_path=None):
+    """Returns a SearchIndex for index, read from next to the archive's cached listing when it is current.
+
+    Only the index the listing cache holds has its search index kept there. Any other, e.g. a version
+    snapshot or an --all-versions listing, numbers its nodes differently and is searched from memory.
+    """
+    filename = None
+    identity = index.identity
+    if (cache is not None and cache.enabled and archive_path is not None and identity is not None
+            and index.until is None and index.history is None):
+        filename = cache.companion_path(archive_path, EXTENSION)
+        search = SearchIndex.load(filename, index, identity)
+        if search is not None:
+            return search
+    search = SearchIndex(index)
+    # store() deletes it whenever the cached listing is replaced
+    if filename is not None and cache.stored_identity(archive_path) == identity:
+        try:
+            search.save(filename, identity)
+        except OSError:
+            pass
+    return search
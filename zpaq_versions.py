@@ -0,0 +1,186 @@
+"""Every version of every path in an archive, for browsing it as it was at any earlier version."""
+import re
+from array import array
+
+from zpaq_index import ArchiveIndex, FLAG_DIRECTORY, NO_NODE, VIRTUAL_ROOT, format_date, parse_date
+
+DATE_BASE = 946684800  # 2000-01-01, the first record of a path stores its date relative to this
+DELETED = -1
+VERSION_PREFIX = re.compile(r"(\d{4,})(?:/|$)")
+
+
+class VersionHistory:
+    """Version chains of the paths in `index`, as listed by `zpaqfranz l -all`.
+
+    Each record is one path at one version: a version id, a size (DELETED once the path is gone) and
+    its date as a delta to the previous record of the same path, which mostly fits in a few bits
+    even though it is kept in a 32 bit column. A delta that does not fit (e.g. a bogus year 9999 date)
+    widens the column to 64 bits rather than being cut short. `heads` points at the newest record of every node,
+    `previous` links each record to the next older one, and dates are decoded walking back from
+    `last_dates`.
+
+    `index` holds every path that ever existed, as_of() cuts it down to what a version contained.
+    """
+
+    def __init__(self, index: ArchiveIndex):
+        self.index = index
+        self.heads = array("i")
+        self.versions = array("I")
+        self.sizes = array("q")
+        self.date_deltas = array("i")
+        self.previous = array("i")
+        self.version_dates = array("q", [0])  # by version id, 0 when unknown
+        self._listed_dates = set()  # versions whose date came from the listing rather than their files
+        self.last_dates = array("q")  # date of each node's newest record, where decoding starts
+
+    # Building
+
+    def _grow(self):
+        missing = len(self.index) - len(self.heads)
+        if missing > 0:
+            self.heads.extend(array("i", [NO_NODE]) * missing)
+            self.last_dates.extend(array("q", [DATE_BASE]) * missing)
+
+    def set_version_date(self, version, date):
+        if version >= len(self.version_dates):
+            self.version_dates.extend(array("q", [0]) * (version + 1 - len(self.version_dates)))
+        self.version_dates[version] = date
+        self._listed_dates.add(version)
+
+    def record(self, node, version, size, date):
+        """Adds the newest record of node, size DELETED records that the path was removed."""
+        if node >= len(self.heads):
+            self._grow()
+        # a deletion keeps the date of what was removed
+        delta = 0 if size == DELETED else date - self.last_dates[node]
+        if not -2**31 <= delta < 2**31 and self.date_deltas.typecode == "i":
+            self.date_deltas = array("q", self.date_deltas)
+        self.last_dates[node] += delta
+        self.versions.append(version)
+        self.sizes.append(size)
+        self.date_deltas.append(delta)
+        self.previous.append(self.heads[node])
+        self.heads[node] = len(self.versions) - 1
+
+        if version >= len(self.version_dates):
+            self.version_dates.extend(array("q", [0]) * (version + 1 - len(self.version_dates)))
+        if version not in self._listed_dates and date > self.version_dates[version]:
+            # without a date from the listing, the newest file of a version stands in for it
+            self.version_dates[version] = date
+
+    def close(self):
+        self._grow()
+
+    # Queries
+
+    @property
+    def latest(self):
+        return len(self.version_dates) - 1
+
+    def version_at(self, date):
+        """Newest version made at or before `date` (epoch seconds), 0 if there is none."""
+        # not bisected, dates taken from a version's files need not be in order
+        return max((version for version, made in enumerate(self.version_dates) if 0 < made <= date), default=0)
+
+    def resolve(self, text):
+        """Version for "N" or a "YYYY-MM-DD[ HH:MM:SS]" date as typed by the user, None if it is neither."""
+        text = text.strip()
+        if text.isdigit():
+            return min(int(text), self.latest)
+        try:
+            return self.version_at(parse_date(text + (" 23:59:59" if len(text) == 10 else "")))
+        except ValueError:
+            return None
+
+    def history(self, node):
+        """[(version, size, date)] of node, newest first, size DELETED for versions that removed it."""
+        records = []
+        record = self.heads[node] if node < len(self.heads) else NO_NODE
+        while record != NO_NODE:
+            records.append(record)
+            record = self.previous[record]
+        date = self.last_dates[node] if node < len(self.last_dates) else DATE_BASE
+        result = []
+        for record in records:
+            result.append((self.versions[record], self.sizes[record], date))
+            date -= self.date_deltas[record]
+        return result
+
+    def as_of(self, version=None):
+        """Returns a new ArchiveIndex of the archive as it was at `version` (default the latest).
+
+        Folders are kept when they were listed at that version or still hold something that was.
+        Names and attributes are shared with the full index, so the snapshot must not be added to.
+        """
+        if version is None:
+            version = self.latest
+        index = self.index
+        count = len(index)
+        parents = index.parents
+        flags = index.flags
+        sizes = self.sizes
+
+        # newest record at `version` of every node, then keep its ancestors, children before parents
+        versions = self.versions
+        previous = self.previous
+        deltas = self.date_deltas
+        heads = self.heads
+        last_dates = self.last_dates
+        records = array("i", [NO_NODE]) * count
+        dates = array("q", [0]) * count
+        keep = bytearray(count)
+        keep[VIRTUAL_ROOT] = 1
+        for node in range(count - 1, VIRTUAL_ROOT, -1):
+            record = heads[node]
+            date = last_dates[node]
+            while record != NO_NODE and versions[record] > version:
+                date -= deltas[record]  # undo the newer records' deltas on the way back
+                record = previous[record]
+            records[node] = record
+            dates[node] = date
+            listed = record != NO_NODE and sizes[record] != DELETED
+            if listed or (keep[node] and (flags[node] & FLAG_DIRECTORY)):
+                keep[node] = 1
+                keep[parents[node]] = 1
+            else:
+                keep[node] = 0
+
+        kept = [node for node in range(1, count) if keep[node]]
+        new_ids = array("i", [NO_NODE]) * count
+        new_ids[VIRTUAL_ROOT] = VIRTUAL_ROOT
+        for new_id, node in enumerate(kept, 1):
+            new_ids[node] = new_id
+        name_ids = index.name_ids
+        attribute_ids = index.attribute_ids
+
+        snapshot = ArchiveIndex()
+        snapshot.names = index.names
+        snapshot.name_table = index.name_table
+        snapshot.interned = index.interned
+        snapshot.attributes = index.attributes
+        snapshot.attribute_table = index.attribute_table
+        snapshot._lookup = None
+        snapshot.name_ids.extend(name_ids[node] for node in kept)
+        snapshot.parents.extend(new_ids[parents[node]] for node in kept)
+        snapshot.sizes.extend(sizes[records[node]] if records[node] != NO_NODE and sizes[records[node]] != DELETED else 0
+                              for node in kept)
+        snapshot.dates.extend(dates[node] for node in kept)
+        snapshot.attribute_ids.extend(attribute_ids[node] for node in kept)
+        snapshot.flags.extend(flags[node] for node in kept)
+        # chain the children newest first like _new_node() does
+        first_child = snapshot.first_child
+        next_sibling = snapshot.next_sibling
+        first_child.extend(array("i", [NO_NODE]) * len(kept))
+        next_sibling.extend(array("i", [NO_NODE]) * len(kept))
+        for node, parent in enumerate(snapshot.parents):
+            if node:
+                next_sibling[node] = first_child[parent]
+                first_child[parent] = node
+        snapshot.until = version  # versions stays 0, a snapshot is never merged into
+        snapshot.history = self
+        snapshot.aggregate()
+        return snapshot
+
+    def describe(self, version):
+        date = self.version_dates[version] if version < len(self.version_dates) else 0
+        return f"version {version} ({format_date(date) if date else 'unknown date'})"
@@ -1,30 +1,30 @@
+import argparse
 import configparser
+import os
+from contextlib import nullcontext, redirect_stdout
 
 from treelib import Tree
+from zpaq_index import ArchiveIndex, File, format_date
+from zpaq_listing import parse_listing, parse_listing_parallel, default_workers
+from zpaq_cache import (ListingCache, ContentCache, HIT, APPENDED, add_cache_arguments, cache_from_args,
+                        add_content_cache_arguments, content_cache_from_args)
+from zpaq_search import load_search_index
+from zpaq_jobs import ExtractionJob, ExtractionQueue, partition_selection, DEFAULT_JOBS, DONE
+from zpaq_versions import VersionHistory, DELETED
+from zpaq_driver import ZpaqDriver, ZpaqError, ZPAQFRANZ_ENV
+from zpaq_metrics import metrics, add_metrics_arguments, metrics_from_args
 import re
-from subprocess import check_output, Popen, PIPE, CalledProcessError
+import shutil
 import tqdm
-from sys import stderr
+from sys import stderr, stdout
 from platform import system
+from time import perf_counter
 import traceback
 
-
-class File:
-    def __init__(self, full_path, size, last_modified, attribute):
-        self.fullPath = full_path.rstrip("/")
-        self.size = size if type(size) is int else int(size.replace(".", ""))
-        self.lastModified = last_modified
-        self.attribute = attribute
-        if full_path[-1] != "/":  # not a folder
-            self.name = full_path.split("/")[-1]
-        else:
-            self.name = full_path.split("/")[-2]
-
-    def __str__(self):
-        return f"{self.lastModified}\t{self.size:>14} {self.attribute:10}\t {self.fullPath}"
-
-    def is_directory(self):
-        return "D" in self.attribute
+# zpaqfranz is started without a shell, Windows still caps a command line at 32767 characters
+MAX_COMMAND_LENGTH = 30000 if system() == "Windows" else 120000
+FIND_LIMIT = 200
+READ_CHUNK_SIZE = 1024 * 1024
 
 
 def build_parent_nodes(tree: Tree, path: str):
@@ -80,35 +80,126 @@ def create_filetree(tree: Tree, contents):
     print("Creating file tree...")
     bar = tqdm.tqdm(contents, total=num_files, unit="files", colour="green", leave=False)
     for line in bar:
-        try:
-            if "," in line and "-csv" not in line:
-                line = line.rstrip()
-                #date, _, __, attribute, fullpath = re.search(pattern, line).groups()
-                #size = re.search(pattern, line).group("size")
-                datetime, attribute, size, ratio, _, fullpath = line.split(",")
-                date = datetime.split(" ")[0]
-
-                date = date.strip("'")
-                attribute = attribute.strip("'")
-                size = size.strip("'")
-                ratio = ratio.strip("'")
-                fullpath = fullpath.strip("'")
-
-                testfile = File(fullpath, size, date, attribute)
-                add_node_new(tree, testfile)
-            else:
-                # num_files -= 1
-                # bar.total = num_files
-                # bar.refresh()
-                pass
-        except IndexError:  # sometimes line[0] is invalid
-            pass
+        entry = parse_line(line)
+        if entry is not None:
+            fullpath, size, datetime, attribute = entry
+            add_node_new(tree, File(fullpath, size, datetime, attribute))
 
     # Ideally would update bar total here instead of just closing and hiding it with leave=False
     bar.close()
 
 
-def extract_file(config, zpaq_file, extract_from_path, extract_to_path, is_directory=False):
+def parse_line(line):
+    """Splits a zpaqfranz -csv listing line into (fullpath, size, datetime, attribute), None if not an entry."""
+    if "," not in line or "-csv" in line:
+        return None
+    try:
+        # path is the last field and may itself contain commas
+        datetime, attribute, size, ratio, _, fullpath = line.rstrip().split(",", 5)
+        return fullpath.strip("'"), int(size.strip("'").replace(".", "")), datetime.strip("'"), attribute.strip("'")
+    except ValueError:  # not enough fields or size is not a number
+        return None
+
+
+def create_index(index: ArchiveIndex, contents, progress=None, lock=None, history=None, workers=1):
+    """Parses the listing into index, with a console progress bar unless a `progress` callback is given.
+
+    With workers > 1 a large listing is parsed by that many processes, see parse_listing_parallel().
+    """
+    @metrics.timed("parse")
+    def parse(progress):
+        if workers > 1 and history is None:
+            return parse_listing_parallel(index, contents, workers, progress=progress, lock=lock)
+        return parse_listing(index, contents, progress=progress, lock=lock, history=history)
+
+    if progress is not None:
+        return parse(progress)
+    print("Creating file tree...")
+    bar = tqdm.tqdm(unit="lines", colour="green", leave=False)
+    parser = parse(bar.update)
+    bar.close()
+    return parser
+
+
+def parse_workers(config):
+    """Processes that parse large listings, `parse_workers` in config.ini (default: a core each, up to 8)."""
+    return config.getint('config', 'parse_workers', fallback=default_workers())
+
+
+def zpaq(config):
+    """ZpaqDriver for the zpaqfranz in config.ini, or the one named by the ZPAQFRANZ environment variable."""
+    return ZpaqDriver.from_config(config)
+
+
+def listing_args(zpaq_file, since=None, all_versions=False):
+    """zpaqfranz arguments listing the archive, only versions >= `since` when given.
+
+    With `all_versions` every version of every path is listed, each prefixed with its version number.
+    """
+    args = ["l", zpaq_file, "-longpath", "-terse", "-csv", "','"]
+    if since is not None:
+        args += ["-since", since]
+    if all_versions:
+        args.append("-all")
+    return args
+
+
+def list_archive(config, zpaq_file, since=None, all_versions=False):
+    """Starts `zpaqfranz l` on the archive, see listing_args().
+
+    Returns a ZpaqProcess to read the listing from, closing it raises a ZpaqError if zpaqfranz failed.
+    """
+    return zpaq(config).stream(*listing_args(zpaq_file, since, all_versions))
+
+
+def update_index(config, zpaq_file, tree: ArchiveIndex, progress=None, lock=None):
+    """Merges the entries of versions added since `tree.versions` into tree."""
+    print(f"Indexing versions after {tree.versions}...")
+    contents = list_archive(config, zpaq_file, since=tree.versions + 1)
+    try:
+        create_index(tree, contents, progress, lock)
+    finally:
+        contents.close()
+    tree.drop_lookup()
+    if not tree.aggregated:  # merging keeps existing aggregates current by itself
+        with metrics.timer("aggregate"):
+            tree.aggregate()
+
+
+def refresh_tree(config, zpaq_file, tree: ArchiveIndex, cache=None):
+    """Brings an already loaded tree up to date after new versions were appended to the archive.
+
+    Returns False when the tree does not know which version it was built from and needs a full reload.
+    """
+    if not tree.versions:
+        return False
+    update_index(config, zpaq_file, tree)
+    if cache is not None:
+        store_cached_tree(cache, zpaq_file, tree, None)
+    return True
+
+
+def extract_file(config, zpaq_file, extract_from_path, extract_to_path, is_directory=False, until=None,
+                 content=None, size=None, date=None):
+    """Extracts a file or directory into extract_to_path, a file kept in `content` (a ContentCache) is copied from there.
+
+    `size` and `date` are the file's in the listing, they pick its entry in `content`.
+    """
+    if not is_directory and content is not None:
+        # where zpaqfranz puts it below
+        name = extract_from_path.split("/")[-1]
+        target = extract_to_path.rstrip("/") + "/" + name if system() == "Windows" else extract_to_path + name
+        cached = content.lookup(zpaq_file, extract_from_path, size, date, until)
+        if cached is not None:
+            try:
+                shutil.copyfile(cached, target)
+                print(f"Copied {extract_from_path} from the content cache.")
+                return target
+            except OSError:  # evicted in between, or the target is not writable, let zpaqfranz try
+                pass
+    else:
+        content = None
+
     if is_directory: #len(tree.children(node)) != 0:  # assumes all folders have 0 children
         # must include trailing /
         if extract_to_path[-1] != "/":
@@ -117,16 +208,16 @@ def extract_file(config, zpaq_file, extract_from_path, extract_to_path, is_direc
             extract_from_path += "/"
 
         if system() == "Windows":
-            command = [config.get('config', 'zpaq_path'), "x", zpaq_file, extract_from_path, "-to", extract_to_path, "-longpath",
-                       "-find", extract_from_path]
+            command = zpaq(config).command("x", zpaq_file, extract_from_path, "-to", extract_to_path, "-longpath",
+                                         "-find", extract_from_path)
         else:
-            command = [config.get('config', 'zpaq_path'), "x", zpaq_file, extract_from_path, "-to", extract_to_path]
+            command = zpaq(config).command("x", zpaq_file, extract_from_path, "-to", extract_to_path)
     else:  # is file or empty directory
         if system() == "Windows":
             if extract_to_path[-1] == "/":  # must drop trailing /
                 extract_to_path = extract_to_path[:-1]
-            command = [config.get('config', 'zpaq_path'), "x", zpaq_file, extract_from_path, "-to", extract_to_path, "-longpath",
-                       "-find", '/'.join(extract_from_path.split('/')[:-1]) + "/"]
+            command = zpaq(config).command("x", zpaq_file, extract_from_path, "-to", extract_to_path, "-longpath",
+                                         "-find", '/'.join(extract_from_path.split('/')[:-1]) + "/")
             if extract_to_path[-1] == ":":  # when extracting to directory root, -space is required for some reason
                 command.append("-space")
         else:
@@ -135,45 +226,230 @@ def extract_file(config, zpaq_file, extract_from_path, extract_to_path, is_direc
                 extract_to_path += extract_from_path.split("/")[-2]
             else:
                 extract_to_path += extract_from_path.split("/")[-1]
-            command = [config.get('config', 'zpaq_path'), "x", zpaq_file, extract_from_path, "-to", extract_to_path]
+            command = zpaq(config).command("x", zpaq_file, extract_from_path, "-to", extract_to_path)
+    if until is not None:  # as the archive was at that version
+        command += ["-until", str(until)]
 
     print(f"Command: {command}")
     try:
-        print(check_output(command).decode("utf-8"))
-    except Exception as e:  # CalledProcessError as e:
-        print(f"Something went wrong with extracting. Error: {traceback.format_exc()}")
+        with metrics.timer("extract"):
+            print(zpaq(config).execute(command, keep_tail=True).decode("utf-8", errors="replace"))
+        if content is not None:
+            content.store_file(target, zpaq_file, extract_from_path, size, date, until)
+    except ZpaqError as e:
+        print(f"Something went wrong with extracting. Error: {e}", file=stderr)
 
     return extract_to_path + "/" + extract_from_path.split("/")[-1]
 
 
-def read_file(config, zpaq_file, extract_from_path):
-    try:
-        command = [config.get('config', 'zpaq_path'), "x", zpaq_file, extract_from_path, "-longpath", "-stdout"]
-        print(f"Command: {command}")
-        return check_output(command)
-    except Exception as e:  # CalledProcessError as e:
-        print(f"Something went wrong with extracting. Error: {traceback.format_exc()}")
+def selection_entry(tree: ArchiveIndex, node):
+    """(path, is_directory, size) of a node for extract_files, a folder's size is that of everything below it."""
+    if tree.is_directory(node):
+        size = tree.total_sizes[node] if tree.aggregated else sum(tree.sizes[child] for child in tree.walk(node))
+        return tree.full_path(node), True, size
+    return tree.full_path(node), False, tree.sizes[node]
 
 
+def normalize_selection(selection):
+    """Sorts the selection and drops whatever a selected directory already covers."""
+    entries = []
+    covered = None
+    for path, is_directory, size in sorted(selection):
+        path = path.rstrip("/")
+        if covered is not None and path.startswith(covered):
+            continue
+        entries.append((path, is_directory, size))
+        covered = path + "/" if is_directory else None
+    return entries
+
+
+def extraction_batches(config, zpaq_file, selection, extract_to_path, until=None):
+    """Yields (command, entries) pairs, as few as the command line length limit allows.
+
+    zpaqfranz renames each listed path to the matching -to name, so one call extracts any number of
+    scattered files and directories. Paths are sorted so neighbours in the archive share a batch, and
+    anything already covered by a selected parent directory is dropped. With `until` the files are
+    extracted as they were at that version.
+    """
+    if extract_to_path[-1] != "/":
+        extract_to_path += "/"
+    entries = normalize_selection(selection)
+
+    base = zpaq(config).command("x", zpaq_file)
+    options = ["-longpath"] if system() == "Windows" else []
+    if until is not None:
+        options += ["-until", str(until)]
+    base_length = sum(len(arg) + 3 for arg in base + options) + len(" -to")
+    batch = []
+    length = base_length
+    for entry in entries:
+        path, is_directory, _ = entry
+        name = path.split("/")[-1]
+        source, target = (path + "/", extract_to_path + name + "/") if is_directory else (path, extract_to_path + name)
+        added = len(source) + len(target) + 6  # quotes and separators
+        if batch and length + added > MAX_COMMAND_LENGTH:
+            yield batch_command(base, options, batch), [entry for entry, _, _ in batch]
+            batch = []
+            length = base_length
+        batch.append((entry, source, target))
+        length += added
+    if batch:
+        yield batch_command(base, options, batch), [entry for entry, _, _ in batch]
+
+
+def batch_command(base, options, batch):
+    return base + [source for _, source, _ in batch] + ["-to"] + [target for _, _, target in batch] + options
+
+
+def extract_files(config, zpaq_file, selection, extract_to_path, until=None):
+    """Extracts many (path, is_directory, size) entries, see selection_entry(), into extract_to_path.
+
+    Every entry ends up as extract_to_path/<name> like with extract_file, but the whole selection takes
+    a single zpaqfranz run unless it is too long for one command line. Returns one
+    (entries, bytes, seconds, ok) tuple per run.
+    """
+    reports = []
+    driver = zpaq(config)
+    batches = list(extraction_batches(config, zpaq_file, selection, extract_to_path, until))
+    for number, (command, entries) in enumerate(batches, 1):
+        size = sum(entry[2] for entry in entries)
+        started = perf_counter()
+        try:
+            driver.execute(command, keep_tail=True)
+            ok = True
+        except ZpaqError as e:
+            print(f"Something went wrong with extracting. Error: {e}", file=stderr)
+            ok = False
+        elapsed = perf_counter() - started
+        if metrics.enabled:
+            metrics.record("extract", elapsed, ok)
+            metrics.count("extract_bytes", size)
+        print(f"Batch {number}/{len(batches)}: {len(entries)} entries, {size / 1024**2:,.1f} MiB in {elapsed:.1f} s "
+              f"({size / 1024**2 / max(elapsed, 1e-6):,.1f} MiB/s){'' if ok else ' FAILED'}")
+        reports.append((len(entries), size, elapsed, ok))
+    return reports
+
+
+def extraction_jobs(config, zpaq_file, selection, extract_to_path, parts=1, by_directory=False, until=None):
+    """Splits the selection into ExtractionJobs for an ExtractionQueue, see partition_selection()."""
+    jobs = []
+    for group in partition_selection(normalize_selection(selection), parts, by_directory):
+        for command, entries in extraction_batches(config, zpaq_file, group, extract_to_path, until):
+            jobs.append(ExtractionJob(command, entries))
+    return jobs
+
+
+def read_file(config, zpaq_file, extract_from_path, content=None, size=None, date=None):
+    """Returns the contents of one archived file, None if it could not be read or is over the output cap.
+
+    Holds the whole file in memory, iter_file() and copy_file() don't. With a ContentCache and the
+    file's listed size and date, a file kept there is read from it and a newly read one is kept.
+    """
+    if content is not None:
+        data = content.get(zpaq_file, extract_from_path, size, date)
+        if data is not None:
+            return data
+    try:
+        with metrics.timer("read_file"):
+            data = zpaq(config).run("x", zpaq_file, extract_from_path, "-longpath", "-stdout")
+    except ZpaqError as e:
+        print(f"Something went wrong with extracting. Error: {e}", file=stderr)
+        return None
+    if content is not None:
+        content.put(zpaq_file, extract_from_path, size, date, data)
+    return data
+
+
+def stream_file(config, zpaq_file, extract_from_path, until=None, content=None, size=None, date=None):
+    """Starts extracting one file to stdout, the caller reads (and closes) the returned ZpaqProcess as it needs.
+
+    With a ContentCache (and the file's listed size and date) a kept copy is read instead, see ContentCache.stream().
+    """
+    args = ["x", zpaq_file, extract_from_path, "-longpath", "-stdout"]
+    if until is not None:
+        args += ["-until", until]
+    if content is not None:
+        return content.stream(zpaq_file, extract_from_path, size, date, lambda: zpaq(config).stream(*args), until)
+    return zpaq(config).stream(*args)
+
+
+def iter_file(config, zpaq_file, extract_from_path, chunk_size=READ_CHUNK_SIZE, until=None, content=None, size=None,
+              date=None):
+    """Yields one archived file in chunks of up to `chunk_size` bytes straight from zpaqfranz's stdout.
+
+    Memory use stays at about one chunk whatever the file's size. Failures raise a ZpaqError once the
+    output is read, and closing the generator early stops zpaqfranz.
+    """
+    with stream_file(config, zpaq_file, extract_from_path, until, content, size, date) as process:
+        while True:
+            chunk = process.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def copy_file(config, zpaq_file, extract_from_path, out, chunk_size=READ_CHUNK_SIZE, until=None, content=None,
+              size=None, date=None):
+    """Writes one archived file into the binary file object `out` through a single reused buffer.
+
+    Returns the number of bytes written, failures raise a ZpaqError.
+    """
+    buffer = memoryview(bytearray(chunk_size))
+    written = 0
+    with metrics.timer("read_file"), stream_file(config, zpaq_file, extract_from_path, until, content, size,
+                                                 date) as process:
+        while True:
+            count = process.readinto(buffer)
+            if not count:
+                break
+            out.write(buffer[:count])
+            written += count
+    metrics.count("read_bytes", written)
+    return written
+
+
+def print_matches(tree: ArchiveIndex, search, query, limit=None, numbered=False):
+    """Prints matches as they are found, returns the matching nodes."""
+    started = perf_counter()
+    matches = []
+    try:
+        for node in search.search(query, limit):
+            matches.append(node)
+            print(f"{len(matches):>4}: {tree.full_path(node)}" if numbered else tree.full_path(node))
+    except re.error as e:
+        print(f"Invalid regex: {e}", file=stderr)
+    print(f"{len(matches):,} matches in {(perf_counter() - started) * 1000:,.0f} ms", file=stderr)
+    return matches
 
-def explore_tree(tree: Tree, config, zpaq_file: str = None):
+
+def explore_tree(tree: ArchiveIndex, config, zpaq_file: str = None, cache=None, content=None):
     user_input = "0"
     curr_node = tree.root
+    marked = set()
+    search = None
+    by_size = False
     while user_input != 'q' and user_input != 'Q':
-        print(f"Current node: {curr_node}")
-        if not tree.get_node(curr_node).data.is_directory():
+        children = tree.children_by_size(curr_node) if by_size else tree.children(curr_node)
+        print(f"Current node: {tree.full_path(curr_node)}")
+        if not tree.is_directory(curr_node):
             print("Is file.")
             print("Enter .. to go back a directory. Enter root to go back to "
-                  "root.\nEnter s to save tree to file.\nEnter x to extract file/directory.\nEnter q to quit")
-        elif len(tree.children(curr_node)) == 0:
+                  "root.\nEnter s to save tree to file.\nEnter x to extract file/directory.\nEnter m to mark or unmark it "
+                  "and X to extract everything marked.\nEnter f to find.\nEnter l to sort largest first or back.\nEnter v to go "
+                  "to another version and h for the versions of this entry.\nEnter q to quit")
+        elif len(children) == 0:
             print("Directory empty.")
             print("Enter .. to go back a directory. Enter root to go back to "
-                  "root.\nEnter s to save tree to file.\nEnter x to extract file/directory.\nEnter q to quit")
+                  "root.\nEnter s to save tree to file.\nEnter x to extract file/directory.\nEnter m to mark or unmark it "
+                  "and X to extract everything marked.\nEnter f to find.\nEnter l to sort largest first or back.\nEnter v to go "
+                  "to another version and h for the versions of this entry.\nEnter q to quit")
         else:
-            for index, node in enumerate(tree.children(curr_node)):
-                print(f"{index + 1:>4}: {node.data}")
+            for index, node in enumerate(children):
+                print(f"{index + 1:>4}:{'*' if node in marked else ' '}{tree.file(node)}")
             print("Enter a node number to explore it.\nEnter .. to go back a directory. Enter root to go back to "
-                  "root.\nEnter s to save tree to file.\nEnter x to extract file/directory.\nEnter q to quit")
+                  "root.\nEnter s to save tree to file.\nEnter x to extract file/directory.\nEnter m to mark or unmark it "
+                  "and X to extract everything marked.\nEnter f to find.\nEnter l to sort largest first or back.\nEnter v to go "
+                  "to another version and h for the versions of this entry.\nEnter q to quit")
 
         user_input = input()
         if user_input == 'q' or user_input == 'Q':
@@ -191,12 +467,12 @@ def explore_tree(tree: Tree, config, zpaq_file: str = None):
             except Exception as e:  # FileNotFoundError, OSError Invalid argument,
                 print(f"Something went wrong with the file path. Error: {traceback.format_exc()}", file=stderr)
             continue
-        elif user_input.isnumeric() and 0 < int(user_input) <= len(tree.children(curr_node)):
-            curr_node = tree.children(curr_node)[int(user_input) - 1].identifier
+        elif user_input.isnumeric() and 0 < int(user_input) <= len(children):
+            curr_node = children[int(user_input) - 1]
             continue
         elif user_input == '..':
             if tree.parent(curr_node) is not None:
-                curr_node = tree.parent(curr_node).identifier
+                curr_node = tree.parent(curr_node)
             else:
                 print("Already at root.")
             continue
@@ -207,8 +483,59 @@ def explore_tree(tree: Tree, config, zpaq_file: str = None):
             if zpaq_file is None:
                 zpaq_file = input("Please specify path to zpaq file: ")
             extract_path = input("Enter extract path (not including file/directory name): ").replace("\\", "/")
-            node = tree.get_node(curr_node)
-            extract_file(config, zpaq_file, node.data.fullPath, extract_path, not node.is_leaf())
+            is_file = not tree.is_directory(curr_node)
+            extract_file(config, zpaq_file, tree.full_path(curr_node), extract_path, not tree.is_leaf(curr_node),
+                         tree.until, content, tree.sizes[curr_node] if is_file else None, tree.dates[curr_node])
+        elif user_input == 'f':
+            query = input("Find (text, glob like *.pdf or docs/*.txt, re:regex): ")
+            if search is None:
+                search = load_search_index(tree, cache, zpaq_file)
+            matches = print_matches(tree, search, query, FIND_LIMIT, numbered=True)
+            choice = input("Enter a match number to go to it: ") if matches else ""
+            if choice.isnumeric() and 0 < int(choice) <= len(matches):
+                curr_node = matches[int(choice) - 1]
+        elif user_input == 'v' or user_input == 'h':
+            if tree.history is None:
+                print("Only archives opened with --all-versions keep their versions.")
+                continue
+            history = tree.history
+            if user_input == 'v':
+                print(f"Showing {history.describe(tree.until)}, the latest is {history.describe(history.latest)}.")
+                version = history.resolve(input("Enter a version number or date (YYYY-MM-DD): "))
+                if version is None:
+                    print("Not a version or date.")
+                    continue
+                path = tree.full_path(curr_node)
+                tree = history.as_of(version)
+                marked.clear()
+                search = None
+                node = tree.find(path) if path else None
+                curr_node = tree.root if node is None else node
+                print(f"Now showing {history.describe(version)}.")
+            else:
+                node = history.index.find(tree.full_path(curr_node))
+                for version, size, date in history.history(node) if node is not None else []:
+                    change = "deleted" if size == DELETED else f"{size:>14}"
+                    print(f"{history.describe(version):>32}  {format_date(date)}  {change}")
+        elif user_input == 'l':
+            by_size = not by_size
+            print("Largest first." if by_size else "Archive order.")
+        elif user_input == 'm':
+            if curr_node in marked:
+                marked.remove(curr_node)
+            else:
+                marked.add(curr_node)
+            print(f"{len(marked)} marked.")
+        elif user_input == 'X':
+            if not marked:
+                print("Nothing marked.")
+                continue
+            if zpaq_file is None:
+                zpaq_file = input("Please specify path to zpaq file: ")
+            extract_path = input("Enter extract path: ").replace("\\", "/")
+            extract_files(config, zpaq_file, [selection_entry(tree, node) for node in marked], extract_path,
+                          tree.until)
+            marked.clear()
         else:
             print("Invalid input. Please try again.")
             continue
@@ -221,34 +548,22 @@ def load_create_config():
     if not config.has_section('config'):
         config.add_section('config')
         needToWrite = True
-    if not config.has_option('config', 'zpaq_path'):
-        try:
-            check_output(["zpaqfranz"])
-            config.set('config', 'zpaq_path', 'zpaqfranz')
-            print("zpaqfranz found.")
-        except CalledProcessError:
-            zpaq_path = input("Enter zpaqfranz path (no quotes): ")
-            # retry until valid
-            valid_path = False
-            while not valid_path:
-                try:
-                    check_output([zpaq_path])
-                    valid_path = True
-                except CalledProcessError:
-                    zpaq_path = input("Path was invalid, please try again. Enter zpaqfranz path (no quotes): ")
-            config.set('config', 'zpaq_path', zpaq_path)
-        needToWrite = True
-    if config.has_option('config', 'zpaq_path'):
-        valid_path = False
-        while not valid_path:
+    # a zpaqfranz named by the environment (e.g. a fake one for tests) is used as is
+    if not os.environ.get(ZPAQFRANZ_ENV):
+        # run it once to see that it works, retrying until a path that does is entered
+        zpaq_path = config.get('config', 'zpaq_path', fallback='zpaqfranz')
+        while True:
             try:
-                check_output([config.get('config', 'zpaq_path')])
-                valid_path = True
-                needToWrite = True
-            except Exception as e:
-                print(f"Something went wrong with zpaqfranz.\nError: {e.with_traceback()}", file=stderr)
+                ZpaqDriver(zpaq_path).check()
+                break
+            except ZpaqError as e:
+                print(f"Something went wrong with zpaqfranz.\nError: {e}", file=stderr)
                 zpaq_path = input("Path was invalid, please try again. Enter zpaqfranz path (no quotes): ")
-                config.set('config', 'zpaq_path', zpaq_path)
+        if not config.has_option('config', 'zpaq_path'):
+            print("zpaqfranz found.")
+        if config.get('config', 'zpaq_path', fallback=None) != zpaq_path:
+            config.set('config', 'zpaq_path', zpaq_path)
+            needToWrite = True
     if needToWrite:
         with open('config.ini', 'w') as configfile:
             config.write(configfile)
@@ -257,47 +572,181 @@ def load_create_config():
 
 def linux_tests():
     # zpaqfranz x "/mnt/b/g_drive.zpaq" "G:/.minecraft/screenshots/2019-05-09_21.57.51.png" -to "/mnt/b/tempout/2019-05-09_21.57.51.png"
-    print(check_output(["zpaqfranz", "x", "/mnt/b/g_drive.zpaq", "G:/.minecraft/screenshots/2019-05-09_21.57.51.png", "-to", "/mnt/b/tempout/2019-05-09_21.57.51.png"]).decode("utf-8"))
+    print(ZpaqDriver().run("x", "/mnt/b/g_drive.zpaq", "G:/.minecraft/screenshots/2019-05-09_21.57.51.png", "-to", "/mnt/b/tempout/2019-05-09_21.57.51.png").decode("utf-8"))
+
+
+def load_cached_tree(config, cache, file_path, progress=None):
+    """Returns (tree, identity), tree is None unless the cache holds a listing of the archive.
+
+    A cached listing of an archive that has since been appended to is brought up to date by only
+    listing the new versions.
+    """
+    try:
+        with metrics.timer("cache_load"):
+            tree, _, state, identity = cache.load(file_path)
+    except Exception as e:  # OSError, corrupt cache file
+        print(f"Could not read the listing cache. Error: {traceback.format_exc()}", file=stderr)
+        return None, None
+    metrics.count("listing_cache_" + state)
+    if state == HIT:
+        print("Loaded file tree from cache.")
+        if not tree.aggregated:  # cached before folder sizes were kept
+            tree.aggregate()
+            store_cached_tree(cache, file_path, tree, identity)
+        return tree, identity
+    if state == APPENDED and tree.versions:
+        print("Archive was appended to since it was cached.")
+        try:
+            update_index(config, file_path, tree, progress)
+        except Exception as e:
+            print(f"Something went wrong indexing the new versions. Error: {traceback.format_exc()}", file=stderr)
+            return None, identity
+        store_cached_tree(cache, file_path, tree, identity)
+        return tree, identity
+    return None, identity
+
+
+def store_cached_tree(cache, file_path, tree, identity):
+    try:
+        cache.store(file_path, tree, identity)
+    except Exception as e:  # OSError, cache directory not writable
+        print(f"Could not write the listing cache. Error: {traceback.format_exc()}", file=stderr)
+
+
+def load_tree(config, file_path, cache, tree=None, progress=None, lock=None, all_versions=False):
+    """Returns (tree, zpaq_file) for an archive or a saved .txt listing, from the cache when possible.
+
+    A listing that has to be parsed goes into `tree` (a new ArchiveIndex by default) as it streams in,
+    so another thread can show it while it loads, see parse_listing() for `progress` and `lock`.
+    A cached listing is always returned as its own index.
+
+    With `all_versions` every version is listed (not cached) into `tree`, and the latest version is
+    returned as its own index whose `history` can show any other, see VersionHistory.as_of().
+    """
+    ext = file_path.split('.')[-1]
+    zpaq_file = None
+    identity = None
+    if ext == 'zpaq' and not all_versions:
+        zpaq_file = file_path
+        cached, identity = load_cached_tree(config, cache, file_path, progress)
+        if cached is not None:
+            return cached, zpaq_file
+
+    if ext == 'zpaq':
+        zpaq_file = file_path
+        contents = list_archive(config, file_path, all_versions=all_versions)
+    elif ext == 'txt':
+        contents = open(file_path, 'rb')
+    else:
+        raise ValueError("Invalid file type.")
+
+    if tree is None:
+        tree = ArchiveIndex()
+    history = VersionHistory(tree) if all_versions else None
+    # listing: from starting zpaqfranz until the tree is ready, parse and aggregate are parts of it
+    with metrics.timer("listing"):
+        try:
+            create_index(tree, contents, progress, lock, history, parse_workers(config))
+            with lock or nullcontext(), metrics.timer("aggregate"):
+                tree.drop_lookup()
+                tree.aggregate()
+        finally:
+            contents.close()
+    if history is not None:
+        return history.as_of(), zpaq_file
+
+    if ext == 'zpaq' and identity is not None:
+        store_cached_tree(cache, file_path, tree, identity)
+    return tree, zpaq_file
+
 
+def extract_paths(config, zpaq_file, tree: ArchiveIndex, paths, extract_to_path, jobs=1, by_directory=False):
+    """Batch extracts archive paths given on the command line, unknown paths are reported and skipped.
 
-def main(config=None, file_path=None):
+    With jobs > 1 the selection is split into that many zpaqfranz runs going at the same time.
+    """
+    selection = []
+    for path in paths:
+        node = tree.find(path.replace("\\", "/"))
+        if node is None:
+            print(f"Not in archive: {path}", file=stderr)
+        else:
+            selection.append(selection_entry(tree, node))
+    if not selection:
+        return
+
+    queue = ExtractionQueue(jobs, on_update=lambda job: print(f"Job {queue.jobs.index(job) + 1}/{len(queue.jobs)} {job}"))
+    queue.submit(extraction_jobs(config, zpaq_file, selection, extract_to_path.replace("\\", "/"), jobs, by_directory,
+                                 tree.until))
+    try:
+        queue.wait()
+    except KeyboardInterrupt:
+        print("Cancelling extraction...")
+        queue.cancel()
+        queue.wait()
+    for job in queue.jobs:
+        if job.status != DONE and job.output:
+            print(job.output, file=stderr)
+    done, total, _, _ = queue.progress()
+    print(f"Extracted {done / 1024**2:,.1f} of {total / 1024**2:,.1f} MiB.")
+
+
+def main(config=None, file_path=None, cache=None, extract=None, extract_to=None, jobs=None, by_directory=False,
+         find=None, all_versions=False, as_of=None, cat=None, content=None):
     if config is None:
         config = load_create_config()
     if file_path is None:
         file_path = input("Enter file path to load: ")
+    if cache is None:
+        cache = ListingCache.from_config(config)
+    if content is None:
+        content = ContentCache.from_config(config)
 
-    ext = file_path.split('.')[-1]
-    zpaqpath = config.get('config', 'zpaq_path')
-    zpaq_file = None
     try:
-        if ext == 'zpaq':
-            contents = Popen([zpaqpath, "l", file_path, "-longpath", "-terse", "-csv", "','"], stdout=PIPE, encoding="utf-8",
-                             errors="ignore").stdout
-            zpaq_file = file_path
-        elif ext == 'txt':
-            contents = open(file_path, 'r', encoding="utf-8")
-        else:
-            print("Invalid file type.", file=stderr)
-            exit(1)
-    except Exception as e:
-        print(f"Something went wrong getting the file list. Error: {traceback.format_exc()}", file=stderr)
+        # with --cat stdout is the file's contents, status messages go to stderr
+        with redirect_stdout(stderr) if cat is not None else nullcontext():
+            tree, zpaq_file = load_tree(config, file_path, cache, all_versions=all_versions or as_of is not None)
+    except ValueError as e:
+        print(e, file=stderr)
+        exit(1)
+    except ZpaqError as e:
+        print(f"zpaqfranz could not list the archive. Error: {e}", file=stderr)
         exit(1)
-
-    tree = Tree()
-    try:
-        create_filetree(tree, contents)
     except Exception as e:
         print(f"Something went wrong creating the file tree. Error: {traceback.format_exc()}", file=stderr)
-        if ext == 'txt':
-            contents.close()
         exit(1)
-
-    if ext == 'txt':
-        contents.close()
-
-    if __name__ == "__main__":
+    if as_of is not None:
+        version = tree.history.resolve(as_of)
+        if version is None:
+            print(f"{as_of} is not a version or date.", file=stderr)
+            exit(1)
+        tree = tree.history.as_of(version)
+        print(f"Showing {tree.history.describe(version)}.", file=stderr)
+
+    if find is not None:
+        print_matches(tree, load_search_index(tree, cache, zpaq_file), find)
+    elif cat is not None:
+        node = tree.find(cat.replace("\\", "/"))
+        if zpaq_file is None or node is None or tree.is_directory(node):
+            print(f"Not a file in a zpaq archive: {cat}", file=stderr)
+            exit(1)
+        try:
+            copy_file(config, zpaq_file, tree.full_path(node), stdout.buffer, until=tree.until, content=content,
+                      size=tree.sizes[node], date=tree.dates[node])
+            stdout.buffer.flush()
+        except ZpaqError as e:
+            print(f"Something went wrong with extracting. Error: {e}", file=stderr)
+            exit(1)
+    elif extract:
+        if zpaq_file is None:
+            print("Extracting needs a zpaq file, not a listing.", file=stderr)
+            exit(1)
+        if jobs is None:
+            jobs = config.getint('config', 'extract_jobs', fallback=DEFAULT_JOBS)
+        extract_paths(config, zpaq_file, tree, extract, extract_to or ".", jobs, by_directory)
+    elif __name__ == "__main__":
         try:
-            explore_tree(tree, config, zpaq_file)
+            explore_tree(tree, config, zpaq_file, cache, content)
         except Exception as e:
             print(f"Something went wrong exploring the file tree. Error: {traceback.format_exc()}", file=stderr)
             exit(1)
@@ -306,4 +755,28 @@ def main(config=None, file_path=None):
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", nargs="?", default=None, help="zpaq archive or saved .txt listing")
+    parser.add_argument("-x", "--extract", nargs="+", default=None, metavar="PATH",
+                        help="extract these archive paths with as few zpaqfranz runs as possible, then exit")
+    parser.add_argument("--to", default=None, help="directory to extract into (default: current directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help=f"zpaqfranz extractions to run at once (default: extract_jobs in config.ini or {DEFAULT_JOBS})")
+    parser.add_argument("--by-directory", action="store_true",
+                        help="split the work by top level directory instead of by size")
+    parser.add_argument("-f", "--find", default=None, metavar="QUERY",
+                        help="print the paths matching a substring, glob (*.pdf, docs/*.txt) or re:regex, then exit")
+    parser.add_argument("--cat", default=None, metavar="PATH",
+                        help="write one archived file to stdout as it is extracted, then exit")
+    parser.add_argument("--all-versions", action="store_true",
+                        help="list every version (slower, not cached) so older versions can be browsed with 'v'")
+    parser.add_argument("--as-of", default=None, metavar="VERSION|DATE",
+                        help="show the archive as it was at a version number or YYYY-MM-DD date, implies --all-versions")
+    add_cache_arguments(parser)
+    add_content_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics_from_args(args)
+    config = load_create_config()
+    main(config, args.file, cache_from_args(args, config), args.extract, args.to, args.jobs, args.by_directory,
+         args.find, args.all_versions, args.as_of, args.cat, content_cache_from_args(args, config))